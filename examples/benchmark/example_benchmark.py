@@ -0,0 +1,147 @@
+# This is an example of a script that measures how many muons per second MUTE propagates.
+# With --backend proposal, it compares the propagation loop used by mtp.propagate_muons(), which only reads the final state of every track, with a loop that reads the full track of every muon, as older versions of MUTE did.
+# Both loops use the same random seed, so they should find the same number of surviving muons.
+# With --backend numpy, it times the analytic NumPy backend, which does not need PROPOSAL.
+# The muons per second, and the speed-up for PROPOSAL, are printed and appended to a JSON-lines results file (--results).
+# Make sure proposal is installed to benchmark the PROPOSAL backend, as the propagation needs it to run the Monte Carlo.
+
+# Import packages
+
+import argparse
+import json
+import platform
+import time
+
+import numpy as np
+
+import mute.constants as mtc
+import mute.propagation as mtp
+
+# Parse the benchmark settings from the command line
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--n_muon", type=int, default=1000)
+parser.add_argument("--energy", type=float, default=1e6)  # [MeV]
+parser.add_argument("--slant_depth", type=float, default=3)  # [km.w.e.]
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--backend", choices=["proposal", "numpy"], default="proposal")
+parser.add_argument("--results", default="benchmark_results.jsonl")
+args = parser.parse_args()
+
+if args.backend == "proposal":
+    import proposal as pp
+
+# Set the constants
+
+mtc.set_verbose(0)
+mtc.set_output(False)
+mtc.set_n_muon(args.n_muon)
+
+if args.backend == "proposal":
+    mtp._create_propagator(force=True)
+
+# Propagate the muons by reading the full track of every muon
+
+
+def full_track_loop(energy, slant_depth):
+
+    mtc.check_constants(force=True)
+
+    distance = slant_depth * 1e5 * 0.997 / mtc.get_density()
+
+    mu_initial = pp.particle.ParticleState()
+    mu_initial.energy = energy + mtc.MU_MASS
+    mu_initial.position = pp.Cartesian3D(0, 0, 0)
+    mu_initial.direction = pp.Cartesian3D(0, 0, -1)
+
+    u_energies = []
+
+    for _ in range(mtc.get_n_muon()):
+
+        track = mtp.propagator.propagate(mu_initial, distance)
+
+        if (
+            track.track_energies()[-1] != mtc.MU_MASS
+            and track.track_types()[-1] != pp.particle.Interaction_Type.decay
+        ):
+
+            u_energies.append(track.track_energies()[-1])
+
+    return u_energies
+
+
+# Propagate the muons with the NumPy backend
+
+
+def numpy_loop(energy, slant_depth):
+
+    rng = np.random.default_rng(0)
+
+    return mtp._propagation_loop_numpy(energy, [slant_depth], rng)[0]
+
+
+# Time the loops
+# Every loop is run several times, and the fastest run is used, to reduce the noise from other processes
+
+if args.backend == "proposal":
+
+    loops = [
+        ("Before (full track)", full_track_loop),
+        ("After (final state)", mtp._propagation_loop),
+    ]
+
+else:
+
+    loops = [("NumPy", numpy_loop)]
+
+muons_per_second = {}
+
+for name, loop in loops:
+
+    elapsed = []
+
+    for _ in range(args.repeat):
+
+        if args.backend == "proposal":
+            pp.RandomGenerator.get().set_seed(0)
+
+        start = time.perf_counter()
+        u_energies = loop(args.energy, args.slant_depth)
+        elapsed.append(time.perf_counter() - start)
+
+    muons_per_second[name] = mtc.get_n_muon() / min(elapsed)
+
+    print(
+        "{0}: {1:.0f} muons/s, {2} survived".format(
+            name, muons_per_second[name], len(u_energies)
+        )
+    )
+
+if args.backend == "proposal":
+
+    print(
+        "Speed-up: {0:.2f}".format(
+            muons_per_second["After (final state)"]
+            / muons_per_second["Before (full track)"]
+        )
+    )
+
+# Record the measurement, so that the numbers of different machines and versions can be compared
+
+with open(args.results, "a") as file:
+
+    file.write(
+        json.dumps(
+            {
+                "backend": args.backend,
+                "proposal": pp.__version__ if args.backend == "proposal" else None,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "n_muon": args.n_muon,
+                "energy": args.energy,
+                "slant_depth": args.slant_depth,
+                "muons_per_second": muons_per_second,
+            }
+        )
+        + "\n"
+    )
@@ -0,0 +1,145 @@
+##########################
+##########################
+###                    ###
+###  MUTE              ###
+###  William Woodley   ###
+###  19 December 2021  ###
+###                    ###
+##########################
+##########################
+
+# Import packages
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import mute.constants as constants
+
+# Products loaded from files in this process, from the least to the most recently used
+# Keyed by the resolved file name, the modification time and size of the file, the loading function, and its arguments
+
+_cache = OrderedDict()
+
+# Load a file through the cache
+
+
+def _size(value):
+
+    """Return the number of bytes of memory that the arrays in value take up. Memory-mapped arrays are backed by their files, so they are not counted."""
+
+    if isinstance(value, tuple):
+
+        return sum(_size(element) for element in value)
+
+    if isinstance(value, np.ndarray) and not isinstance(value, np.memmap):
+
+        return value.nbytes
+
+    return 0
+
+
+def _lock(value):
+
+    """Make the arrays in value read-only, so that the cached copy cannot be changed by a caller."""
+
+    if isinstance(value, tuple):
+
+        for element in value:
+            _lock(element)
+
+    elif isinstance(value, np.ndarray):
+
+        value.flags.writeable = False
+
+
+def writable(value):
+
+    """Return value with its arrays copied, so that a caller can change them without changing the cached result. Memory-mapped arrays are returned as they are, as they stay read-only and are not read into memory."""
+
+    if isinstance(value, tuple):
+
+        return tuple(writable(element) for element in value)
+
+    if isinstance(value, np.ndarray) and not isinstance(value, np.memmap):
+
+        return np.array(value)
+
+    return value
+
+
+def load(file_name, function, *args):
+
+    """
+    Return function(file_name, *args), reusing the result of an earlier call if the file has not changed since.
+
+    The results are kept in memory as long as they fit in the size set by constants.set_cache_size(). Once they do not, the least recently used results are dropped. The arrays in a cached result are read-only, as they are shared between all of the calls. Functions that return them to the user pass them through writable() first.
+
+    Parameters
+    ----------
+    file_name : str
+        The full path and name of the file to load.
+
+    function : callable
+        The function that loads the file. It is called with file_name and args.
+
+    args
+        Further arguments of function. They must be hashable.
+
+    Returns
+    -------
+    value
+        The result of function(file_name, *args).
+    """
+
+    stat = os.stat(file_name)
+    key = (
+        os.path.realpath(file_name),
+        stat.st_mtime_ns,
+        stat.st_size,
+        function.__module__ + "." + function.__qualname__,
+        args,
+    )
+
+    if key in _cache:
+
+        _cache.move_to_end(key)
+
+        return _cache[key]
+
+    value = function(file_name, *args)
+
+    # Results that do not fit in the cache on their own are not cached
+
+    budget = constants.get_cache_size() * 1e9  # [bytes]
+
+    if _size(value) > budget:
+
+        return value
+
+    _lock(value)
+    _cache[key] = value
+
+    # Drop the least recently used results, and the results for older versions of the same file
+
+    total = sum(_size(cached) for cached in _cache.values())
+
+    for cached_key in list(_cache):
+
+        if cached_key == key:
+
+            continue
+
+        if total > budget or (cached_key[0] == key[0] and cached_key[1:3] != key[1:3]):
+
+            total -= _size(_cache.pop(cached_key))
+
+    return value
+
+
+def clear():
+
+    """Drop all of the cached results. This is called by constants.clear()."""
+
+    _cache.clear()
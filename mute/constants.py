@@ -57,7 +57,10 @@ _overburden = "flat"
 _vertical_depth = 1
 _medium = "rock"
 _density = 2.65
+_density_tolerance = 0
 _n_muon = 100000
+_store_size = 10
+_cache_size = 1
 
 # Setters and getters for global constants
 
@@ -265,6 +268,71 @@ def get_density():
     return _density
 
 
+# Relative density tolerance for reusing survival probabilities
+
+
+def set_density_tolerance(density_tolerance):
+
+    """Set the largest relative difference between the set density and the density of an existing survival probability tensor of the same medium for that tensor to be used instead of propagating muons again. The slant depths are in mass thickness, so the survival probabilities only depend on the density through the density effect in ionisation losses. The default is 0 (only tensors of exactly the set density are used)."""
+
+    assert (
+        0 <= density_tolerance < 1
+    ), "The density tolerance must be at least 0 and less than 1."
+
+    global _density_tolerance
+
+    _density_tolerance = density_tolerance
+
+
+def get_density_tolerance():
+
+    """Return the set relative density tolerance."""
+
+    return _density_tolerance
+
+
+# Disk budget of the artefact store
+
+
+def set_store_size(store_size):
+
+    """Set the largest total size in [GB] of the products kept in the artefact store in the data directory. When a new product takes the store over this size, the least recently used products are deleted until it fits again. The default is 10."""
+
+    assert store_size > 0, "The store size must be positive."
+
+    global _store_size
+
+    _store_size = store_size
+
+
+def get_store_size():
+
+    """Return the set size of the artefact store in [GB]."""
+
+    return _store_size
+
+
+# Memory budget of the cache of loaded files
+
+
+def set_cache_size(cache_size):
+
+    """Set the largest total size in [GB] of the surface fluxes and survival probabilities kept in memory after they have been loaded from files, so that loading them again does not read the files again. When a newly loaded file takes the cache over this size, the least recently used files are dropped. The default is 1."""
+
+    assert cache_size > 0, "The cache size must be positive."
+
+    global _cache_size
+
+    _cache_size = cache_size
+
+
+def get_cache_size():
+
+    """Return the set size of the cache of loaded files in [GB]."""
+
+    return _cache_size
+
+
 # Number of muon
 
 
@@ -489,6 +557,8 @@ def clear():
 
     import gc
 
+    from .cache import clear as clear_cache
+
     # Global constants and variables
 
     global _verbose
@@ -499,7 +569,10 @@ def clear():
     global _vertical_depth
     global _medium
     global _density
+    global _density_tolerance
     global _n_muon
+    global _store_size
+    global _cache_size
 
     _verbose = 2
     _output = True
@@ -509,7 +582,14 @@ def clear():
     _vertical_depth = 1
     _medium = "rock"
     _density = 2.65
+    _density_tolerance = 0
     _n_muon = 100000
+    _store_size = 10
+    _cache_size = 1
+
+    # Drop the files loaded into memory
+
+    clear_cache()
 
     # Global weight variables
     # Set the variables to None first, in case they do not already exist
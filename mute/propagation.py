@@ -10,12 +10,22 @@
 
 # Import packages
 
+import concurrent.futures
+import glob
+import json
+import multiprocessing
 import os
+import shutil
+import sys
+import time
 
 import numpy as np
 from tqdm import tqdm
 
+import mute.cache as cache
 import mute.constants as constants
+import mute.store as store
+import mute.surface as surface
 
 try:
 
@@ -25,12 +35,48 @@ except ImportError:
 
     pass
 
+# resource is only available on POSIX systems
+
+try:
+
+    import resource
+
+except ImportError:
+
+    resource = None
+
 # Create the propagator
 
+# Energy cuts (e_cut in [MeV], v_cut, cont_rand) and parametrisation models used in the propagator
+
+ENERGY_CUTS = (500, 0.05, True)
+PARAMETRISATIONS = (
+    "bremsstrahlung.KelnerKokoulinPetrukhin(lpm=False)",
+    "pairproduction.KelnerKokoulinPetrukhin(lpm=False)",
+    "ionization.BetheBlochRossi",
+    "photonuclear.AbramowiczLevinLevyMaor97(ShadowButkevichMikheyev)",
+)
+
+# Propagators that have already been created in this process, keyed by _propagator_key()
+
+_propagators = {}
+
+
+def _propagator_key():
+
+    """Return the key that identifies a propagator for the set constants in the propagator cache."""
+
+    return (
+        constants.get_medium(),
+        constants.get_density(),
+        ENERGY_CUTS,
+        PARAMETRISATIONS,
+    )
+
 
 def _create_propagator(force):
 
-    """This function creates the propagator object in PROPOSAL for use in _propagation_loop()"""
+    """This function creates the propagator object in PROPOSAL for use in _propagation_loop(). Propagators are cached by configuration, and their interpolation tables are stored in the interpolation_tables directory."""
 
     # Check values
 
@@ -38,17 +84,45 @@ def _create_propagator(force):
 
     # Global variables
     # The propagator is used in every iteration of the doubly-nested propagation loop
-    # Make it a global variable so it only has to be created once
+    # Make it a global variable so it only has to be looked up once
 
     global propagator
 
+    # Reuse the propagator if it has already been created for the set constants
+
+    key = _propagator_key()
+
+    if key in _propagators:
+
+        propagator = _propagators[key]
+
+        return propagator
+
+    # Check that PROPOSAL is installed before any directory is created
+
+    if "proposal" not in sys.modules:
+
+        raise ImportError(
+            "PROPOSAL is not installed. Install it, or propagate with backend = 'numpy'."
+        )
+
     if constants.get_verbose() > 1:
         print("Creating propagator.")
 
+    # Store the interpolation tables on disk so they can be reused
+    # If the directory is not created, the tables are only kept in memory
+
+    tables_path = os.path.join(constants.get_directory(), "interpolation_tables")
+
+    constants.check_directory(tables_path, force=force)
+
+    if os.path.isdir(tables_path):
+        pp.InterpolationSettings.tables_path = tables_path
+
     # Propagator arguments
 
     mu = pp.particle.MuMinusDef()
-    cuts = pp.EnergyCutSettings(500, 0.05, True)
+    cuts = pp.EnergyCutSettings(*ENERGY_CUTS)
 
     if constants.get_medium() == "rock":
 
@@ -119,6 +193,8 @@ def _create_propagator(force):
 
     propagator = pp.Propagator(mu, [(detector, utility, density_distr)])
 
+    _propagators[key] = propagator
+
     if constants.get_verbose() > 1:
         print("Finished creating propagator.")
 
@@ -128,23 +204,31 @@ def _create_propagator(force):
 # Propagation function
 
 
-def _propagation_loop(energy, slant_depth, force):
+def _propagation_loop(energy, slant_depth, histogram=False, n_muon=None):
 
     # This function propagates n_muon muons, looping over the energies and slant depths, and returns the muons' underground energies
+    # If histogram is True, the underground energies are counted into the bins of constants.E_BINS instead of being returned
+    # If n_muon is None, the set number of muons is propagated
+    # The constants are checked once by propagate_muons(), not for every bin
 
-    # Check values
+    if n_muon is None:
+        n_muon = constants.get_n_muon()
 
-    n_muon = constants.get_n_muon()
+    # Convert the slant depth from [km.w.e.] to [cm]
 
-    constants.check_constants(force=force)
+    distance = slant_depth * 1e5 * 0.997 / constants.get_density()
 
-    # Convert the slant depth from [km.w.e.] to [cm]
+    # Initialise the array of underground energies, or of their histogram
+    # Only the first n_survived entries of the underground energies are filled
+
+    if histogram:
 
-    convert_to_cm = 1e5 * 0.997 / constants.get_density()
+        u_counts_ix = np.zeros(len(constants.ENERGIES), dtype=np.int64)
 
-    # Initialise the list of underground energies
+    else:
 
-    u_energies_ix = []
+        u_energies_ix = np.empty(n_muon)
+        n_survived = 0
 
     # Define the initial state of the muon
 
@@ -158,482 +242,3870 @@ def _propagation_loop(energy, slant_depth, force):
     for _ in range(n_muon):
 
         # Propagate the muons
+        # Only the final state of the track is used
 
-        track = propagator.propagate(mu_initial, slant_depth * convert_to_cm)
+        mu_final = propagator.propagate(mu_initial, distance).final_state()
 
         # Test whether or not the muon has energy left (has not lost all of its energy or has not decayed)
         # If it does, record its energy
         # If it does not, ignore this muon and proceed with the next loop iteration
 
-        if (
-            track.track_energies()[-1] != constants.MU_MASS
-            and track.track_types()[-1] != pp.particle.Interaction_Type.decay
-        ):
+        if not _has_survived(mu_final, distance):
 
-            # Store the final underground energy of the muon
+            continue
 
-            u_energies_ix.append(track.track_energies()[-1])
+        if histogram:
 
-    # Return the underground energies for the muon
+            u = _u_energy_bin(mu_final.energy)
 
-    return u_energies_ix
+            if u is not None:
+                u_counts_ix[u] += 1
 
+        else:
 
-# Propagate the muons and return underground energies
+            u_energies_ix[n_survived] = mu_final.energy
+            n_survived += 1
 
+    # Return the underground energies or their histogram for the muon
 
-def propagate_muons(seed=0, job_array_number=0, output=None, force=False):
+    if histogram:
 
-    """
-    Propagate muons for the default surface energy grid and slant depths.
+        return u_counts_ix
 
-    The default surface energy grid is given by constants.ENERGIES, and the default slant depths are given by constants.SLANT_DEPTHS.
+    return u_energies_ix[:n_survived]
 
-    Parameters
-    ----------
-    seed : str, optional (default: 0)
-        The random seed for use in the PROPOSAL propagator.
 
-    job_array_number : int, optional (default: 0)
-        The job array number from a high-statistics run on a computer cluster. This is set so the underground energy files from each job in the job array will be named differently.
+# Propagation function for scoring several slant depths with a single track
 
-    output : bool, optional (default: taken from constants.get_output())
-        If True, an output file will be created to store the results.
 
-    force : bool, optional (default: False)
-        If True, this will force the creation of an underground_energies directory if one does not already exist.
+def _propagation_loop_multi_depth(energy, slant_depths, histogram=False, n_muon=None):
 
-    Returns
-    -------
-    u_energies : NumPy ndarray
-        A two-dimensional array containing lists of underground energies for muons that survived the propagation.
-    """
+    # This function propagates n_muon muons once to the largest of slant_depths, and returns the muons' underground energies at every slant depth
+    # Each muon is propagated from one slant depth to the next, starting from its final state at the previous slant depth, so its energy is scored as it crosses every depth
+    # The result for every slant depth has the same form as the output of _propagation_loop()
 
-    # Check values
+    if n_muon is None:
+        n_muon = constants.get_n_muon()
 
-    assert type(job_array_number) == int, "job_array_number must be an integer."
+    # Convert the distances between consecutive slant depths from [km.w.e.] to [cm]
 
-    constants.check_constants(force=force)
+    distances = (
+        np.diff(np.concatenate(([0], slant_depths)))
+        * 1e5
+        * 0.997
+        / constants.get_density()
+    )
 
-    if output is None:
-        output = constants.get_output()
+    assert np.all(distances > 0), "slant_depths must be increasing."
 
-    # Create the propagator once
+    # Initialise the arrays of underground energies, or of their histograms
+    # Only the first n_survived[x] entries of row x of the underground energies are filled
 
-    _create_propagator(force=force)
+    if histogram:
 
-    # Set the random seed
+        u_counts_i = np.zeros(
+            (len(slant_depths), len(constants.ENERGIES)), dtype=np.int64
+        )
 
-    pp.RandomGenerator.get().set_seed(seed)
+    else:
 
-    # Initialise the matrix of underground energies
+        u_energies_i = np.empty((len(slant_depths), n_muon))
+        n_survived = np.zeros(len(slant_depths), dtype=np.int64)
 
-    u_energies = np.zeros(
-        (len(constants.ENERGIES), len(constants.SLANT_DEPTHS)), dtype=np.ndarray
-    )
+    # Define the initial state of the muon
 
-    # Run the propagation function and print the underground energies
+    mu_initial = pp.particle.ParticleState()
+    mu_initial.energy = energy + constants.MU_MASS
+    mu_initial.position = pp.Cartesian3D(0, 0, 0)
+    mu_initial.direction = pp.Cartesian3D(0, 0, -1)
 
-    if constants.get_verbose() >= 1:
-        print(
-            "Propagating "
-            + str(
-                constants.get_n_muon()
-                * len(constants.ENERGIES)
-                * len(constants.SLANT_DEPTHS)
-            )
-            + " muons."
-        )
+    # Propagate n_muon muons
 
-    for i in (
-        tqdm(range(len(constants.ENERGIES)))
-        if constants.get_verbose() >= 1
-        else range(len(constants.ENERGIES))
-    ):
+    for _ in range(n_muon):
 
-        for x in range(len(constants.SLANT_DEPTHS)):
+        mu_state = mu_initial
 
-            u_energies[i, x] = _propagation_loop(
-                constants.ENERGIES[i], constants.SLANT_DEPTHS[x], force=force
-            )
+        for x in range(len(slant_depths)):
 
-    if constants.get_verbose() >= 1:
-        print("Finished propagation.")
+            # Propagate the muon to the next slant depth
 
-    if output:
+            mu_final = propagator.propagate(mu_state, distances[x]).final_state()
 
-        constants.check_directory(
-            os.path.join(constants.get_directory(), "underground_energies"), force=force
-        )
+            # Stop following the muon once it has lost all of its energy or has decayed
 
-        file_name = os.path.join(
-            constants.get_directory(),
-            "underground_energies",
-            "{0}_{1}_{2}_Underground_Energies_{3}.npy".format(
-                constants.get_medium(),
-                constants.get_density(),
-                constants.get_n_muon(),
-                job_array_number,
-            ),
-        )
+            if not _has_survived(mu_final, distances[x]):
 
-        np.save(file_name, u_energies)
+                break
 
-        if constants.get_verbose() > 1:
-            print("Underground energies written to " + file_name + ".")
+            # Store the underground energy of the muon at this slant depth
 
-    return u_energies
+            if histogram:
 
+                u = _u_energy_bin(mu_final.energy)
 
-# Load underground energies
+                if u is not None:
+                    u_counts_i[x, u] += 1
 
+            else:
 
-def _load_u_energies_from_files(file_name, n_job=1, force=False):
+                u_energies_i[x, n_survived[x]] = mu_final.energy
+                n_survived[x] += 1
 
-    """
-    Load the underground energies resulting from the PROPOSAL Monte Carlo from a file or collection of files stored in data/underground_energies.
+            # Continue from the final state of the muon, with the propagated distance reset
 
-    Parameters
-    ----------
-    file_name : str, optional
-        The file name pattern that the underground energy data is stored in. This should end in an underscore so the function can append the job array number.
+            mu_state = pp.particle.ParticleState()
+            mu_state.energy = mu_final.energy
+            mu_state.position = mu_final.position
+            mu_state.direction = mu_final.direction
 
-    n_job : int, optional (default: 1)
-        The number of jobs that were run on the computer cluster. Set this to the number of files the underground energies are spread across.
+    # Return the underground energies or their histograms for every slant depth
 
-    force : bool, optional (default: False)
-        If True, this will force the creation of an underground_energies directory if one does not already exist.
+    if histogram:
 
-    Returns
-    -------
-    u_energies : NumPy ndarray
-        A two-dimensional array containing lists of underground energies for muons that survived the propagation.
-    """
+        return u_counts_i
 
-    # Check values
+    return [u_energies_i[x, : n_survived[x]] for x in range(len(slant_depths))]
 
-    constants.check_constants(force=force)
 
-    # Check that the directory exists
+# Test whether a muon survived the propagation
 
-    if not os.path.exists(constants.get_directory() + "/underground_energies"):
 
-        if constants.get_verbose() >= 1:
+def _has_survived(mu_final, distance):
 
-            print(
-                constants.get_directory()
-                + "/underground_energies does not exist. Underground energies not loaded."
-            )
+    """Return True if a muon with the final state mu_final reached the full distance in [cm] with energy left. A muon that lost all of its energy is left with its rest mass, and a muon that decayed stopped before the full distance; the small tolerance only absorbs rounding in the propagated distance."""
 
-        return None
+    return (
+        mu_final.energy != constants.MU_MASS
+        and mu_final.propagated_distance >= distance * (1 - 1e-9)
+    )
 
-    # Test if the file exists
 
-    if not os.path.isfile(file_name + "_0.npy"):
+# Analytic propagation with NumPy
 
-        if constants.get_verbose() >= 1:
+# Energy loss parameters (a_0 in [MeV cm^2 g^-1], a_1 in [MeV cm^2 g^-1], b_0 in [cm^2 g^-1], b_1 in [cm^2 g^-1]) for the NumPy backend
+# The continuous energy loss is a(E) + b(E) * E, with a(E) = a_0 + a_1 * ln(E / GeV) and b(E) = b_0 + b_1 * ln(E / GeV)
+# The values approximate the tabulated muon energy losses of the PDG (Groom, Mokhov, and Striganov, 2001) between 1 GeV and 100 TeV
+# They have not yet been validated against PROPOSAL, see validate_numpy_backend()
 
-            print(file_name + "_0.npy does not exist. Underground energies not loaded.")
+NUMPY_LOSS_PARAMETERS = {
+    "rock": (1.87, 0.12, 2.6e-6, 1.7e-7),
+    "water": (2.20, 0.13, 2.4e-6, 1.2e-7),
+    "ice": (2.20, 0.13, 2.4e-6, 1.2e-7),
+    "air": (2.00, 0.13, 2.3e-6, 1.2e-7),
+}
 
-        return None
+# Step size in [g cm^-2] of the NumPy backend, and the number of muons propagated at once
 
-    # Fill a u_energies array with empty lists that will be able to be extended
+NUMPY_STEP = 1e4
+NUMPY_CHUNK_SIZE = 2 ** 20
 
-    u_energies = np.empty(
-        (len(constants.ENERGIES), len(constants.SLANT_DEPTHS)), dtype=object
-    )
 
-    for i in np.ndindex(u_energies.shape):
-        u_energies[i] = []
+def _propagation_loop_numpy(energy, slant_depths, rng, histogram=False, n_muon=None):
 
-    # Loop over all output files and add the contents to u_energies
+    """Propagate n_muon muons with the surface energy energy through slant_depths in [km.w.e.] with the NumPy backend, drawing from the random number generator rng. The output has the same form as that of _propagation_loop_multi_depth()."""
 
-    for a in tqdm(range(n_job)) if constants.get_verbose() >= 1 else range(n_job):
+    if n_muon is None:
+        n_muon = constants.get_n_muon()
 
-        u_energies += np.load(file_name + "_" + str(a) + ".npy", allow_pickle=True)
+    a_0, a_1, b_0, b_1 = NUMPY_LOSS_PARAMETERS[constants.get_medium()]
+    v_cut = ENERGY_CUTS[1]
 
-    if constants.get_verbose() > 1:
-        print("Loaded underground energies.")
+    # Convert the slant depths from [km.w.e.] to [g cm^-2]
 
-    return u_energies
+    depths = np.asarray(slant_depths, dtype=float) * 1e5 * 0.997
 
+    u_energies = [[] for _ in range(len(depths))]
 
-def calc_survival_probability_tensor(
-    seed=0, file_name=None, n_job=1, output=None, force=False
-):
+    for start in range(0, n_muon, NUMPY_CHUNK_SIZE):
 
-    """
-    Calculate survival probabilities for the default surface energy grid and slant depths.
+        # Follow only the muons that are still alive
 
-    The default surface energy grid is given by constants.ENERGIES, and the default slant depths are given by constants.SLANT_DEPTHS. If the propagation of muons has already been done, this will load the underground energies file (it will load it for n_job = 1; to load for more jobs, call load_u_energies_from_files() directly), unless force is set to True.
+        energies = np.full(
+            min(NUMPY_CHUNK_SIZE, n_muon - start), energy + constants.MU_MASS
+        )
+        depth = 0
 
-    Parameters
-    ----------
-    seed : int, optional (default: 0)
-        The random seed for use in the PROPOSAL propagator.
+        for x in range(len(depths)):
 
-    file_name : str, optional
-        The file name pattern that the underground energy data is stored in. This should end in an underscore so the function can append the job array number.
+            while depth < depths[x] and len(energies) > 0:
 
-    n_job : int, optional (default: 1)
-        The number of jobs that were run on the computer cluster. Set this to the number of files the underground energies are spread across.
+                step = min(depth + NUMPY_STEP, depths[x]) - depth
 
-    output : bool, optional (default: taken from constants.get_output())
-        If True, an output file will be created to store the results.
+                log_energies = np.log(energies / 1e3)
 
-    force : bool, optional (default: False)
-        If True, this will force the muons to be propagated whether an underground energies file already exists or not.
+                a = np.maximum(
+                    a_0 + a_1 * log_energies,
+                    MIN_STOPPING_POWERS[constants.get_medium()],
+                )
+                b = b_0 + b_1 * log_energies
 
-    Returns
-    -------
-    survival : NumPy ndarray
-        A three-dimensional array containing the survival probabilities.
-    """
+                # Integrate the continuous losses below v_cut
+                # dE/dX = -(a + b_c * E) gives E(X) = (E_0 + a / b_c) * exp(-b_c * X) - a / b_c
 
-    # Check values
+                b_c = b * v_cut
 
-    if output is None:
-        output = constants.get_output()
+                energies = (energies + a / b_c) * np.exp(-b_c * step) - a / b_c
 
-    # Construct a file name
+                # Sample the stochastic losses above v_cut
+                # For a 1 / v spectrum, the mean fraction lost per interaction is (1 - v_cut) / ln(1 / v_cut)
 
-    file_name_default = os.path.join(
-        constants.get_directory(),
-        "underground_energies",
-        "{0}_{1}_{2}_Underground_Energies".format(
-            constants.get_medium(),
-            constants.get_density(),
-            int(constants.get_n_muon() / n_job),
-        ),
-    )
+                n_losses = rng.poisson(b * np.log(1 / v_cut) * step)
 
-    # Check if propagate_muons() should be forced or not
-    # If not, check if underground energy files exist
-    # If not, ask if muons should be propagated
+                for k in range(np.max(n_losses, initial=0)):
 
-    if force:
+                    lossy = n_losses > k
 
-        u_energies = propagate_muons(seed=seed, output=output, force=force)
+                    energies[lossy] *= 1 - v_cut ** (1 - rng.random(np.sum(lossy)))
 
-    else:
+                energies = energies[energies > constants.MU_MASS]
+                depth += step
 
-        # Check if the user has specified underground energies to load
-        # If not, look for the default file name pattern, and check if it exists
-        # If so, load the underground energies
-        # If not, ask if muons should be propagated
+            depth = depths[x]
 
-        if file_name is not None:
+            u_energies[x].append(energies.copy())
 
-            u_energies = _load_u_energies_from_files(
-                file_name=os.path.join(
-                    constants.get_directory(), "underground_energies", file_name
-                ),
-                n_job=n_job,
-                force=force,
-            )
+    u_energies = [np.concatenate(u_energies_x) for u_energies_x in u_energies]
 
-        elif os.path.isfile(file_name_default + "_0.npy"):
+    # Return the underground energies or their histograms for every slant depth
 
-            u_energies = _load_u_energies_from_files(
-                file_name=file_name_default, n_job=n_job, force=force
-            )
+    if histogram:
 
-        else:
+        return np.array(
+            [
+                np.histogram(u_energies_x, bins=constants.E_BINS)[0]
+                for u_energies_x in u_energies
+            ]
+        )
 
-            answer = input(
-                "No underground energy file currently exists for the set lab, medium, or number of muons. Would you like to create one (y/n)?: "
-            )
+    return u_energies
 
-            if answer.lower() == "y":
 
-                u_energies = propagate_muons(seed=seed, output=output, force=force)
+# Find the bins in which muons can survive
 
-            else:
+# Minimum mass stopping powers in [MeV cm^2 g^-1] (PDG, Atomic and Nuclear Properties of Materials)
+# Ionisation is the only loss that every muon suffers, and it is never smaller than the minimum-ionising value
 
-                print("Underground energies not calculated.")
-                print("Survival probabilities not calculated.")
+MIN_STOPPING_POWERS = {"rock": 1.688, "water": 1.992, "ice": 1.992, "air": 1.815}
 
-                return
 
-    # Check that the underground energies were loaded
+def _calc_max_ranges(safety=0.8):
 
-    if u_energies is None:
+    """Return upper bounds on the ranges in [km.w.e.] of muons with the surface energies in constants.ENERGIES, assuming an energy loss of safety times the minimum stopping power of the set medium."""
 
-        print("Survival probabilities not calculated.")
+    # Convert the range from [g cm^-2] to [km.w.e.]
 
-        return
+    return (
+        constants.ENERGIES
+        / (safety * MIN_STOPPING_POWERS[constants.get_medium()])
+        / (1e5 * 0.997)
+    )
 
-    # Calculate the survival probabilities
-    # First index  = Surface energy
-    # Second index = Slant depth
-    # Third index  = Underground energy
 
-    survival = np.zeros(
-        (len(constants.ENERGIES), len(constants.SLANT_DEPTHS), len(constants.ENERGIES))
-    )
+def _calc_feasible_bins(slant_depths=None):
 
-    if constants.get_verbose() > 1:
-        print("Calculating survival probabilities.")
+    """Return a boolean array of shape (len(constants.ENERGIES), len(slant_depths)) that is False for the bins in which no muon can survive to the slant depth. If slant_depths is None, constants.SLANT_DEPTHS is used."""
 
-    for i in range(len(constants.ENERGIES)):
+    slant_depths = _get_slant_depths(slant_depths)
 
-        for x in range(len(constants.SLANT_DEPTHS)):
+    return _calc_max_ranges()[:, np.newaxis] >= slant_depths[np.newaxis, :]
 
-            survival[i, x, :] = np.histogram(
-                np.array(u_energies[i, x]), bins=constants.E_BINS
-            )[0] / float(constants.get_n_muon())
 
-    if constants.get_verbose() > 1:
-        print("Finished calculating survival probabilities.")
+# Find the bins covered by a shard
 
-    # Write the results to a file
 
-    if output:
+def _calc_shard_bins(shard, n_shards, multi_depth, slant_depths=None):
 
-        constants.check_directory(
-            os.path.join(constants.get_directory(), "survival_probabilities"),
-            force=force,
-        )
+    """Return a boolean array of the surface energy-slant depth bins covered by the shard, dealt out in turn (by surface energy if multi_depth is True). If shard is None, all bins are covered."""
 
-        file_name = os.path.join(
-            constants.get_directory(),
-            "survival_probabilities",
-            "{0}_{1}_{2}_Survival_Probabilities.txt".format(
-                constants.get_medium(), constants.get_density(), constants.get_n_muon()
-            ),
-        )
+    slant_depths = _get_slant_depths(slant_depths)
 
-        file_out = open(file_name, "w")
+    i, x = np.indices((len(constants.ENERGIES), len(slant_depths)))
 
-        for i in range(len(constants.ENERGIES)):
+    if shard is None:
 
-            for x in range(len(constants.SLANT_DEPTHS)):
+        return np.ones(i.shape, dtype=bool)
 
-                for u in range(len(constants.ENERGIES)):
+    if multi_depth:
 
-                    file_out.write(
-                        "{0:1.14f} {1:1.5f} {2:1.14f} {3:1.14e}\n".format(
-                            constants.ENERGIES[i],
-                            constants.SLANT_DEPTHS[x],
-                            constants.ENERGIES[u],
-                            survival[i, x, u],
-                        )
-                    )
+        return i % n_shards == shard
 
-        file_out.close()
+    return (i * len(slant_depths) + x) % n_shards == shard
 
-        if constants.get_verbose() > 1:
-            print("Survival probabilities written to " + file_name + ".")
 
-    return survival
+# Find the slant depths of a propagation
 
 
-def load_survival_probability_tensor_from_file(force=False):
+def _get_slant_depths(slant_depths=None):
 
-    """
-    Retrieve a survival probability matrix stored in data/survival_probabilities based on the set global parameters.
+    """Return slant_depths as an array, or constants.SLANT_DEPTHS if slant_depths is None."""
 
-    The function searches for a file name that matches the set lab, medium, and number of muons. If the file does not exist, prompt the user to run calc_survival().
+    if slant_depths is None:
 
-    Parameters
-    ----------
-    force : bool
-        If True, force the calculation of a new survival probability tensor if required.
+        return constants.SLANT_DEPTHS
 
-    Returns
-    -------
-    survival : NumPy ndarray
-        A two-dimensional array containing the survival probabilities.
-    """
+    return np.atleast_1d(np.asarray(slant_depths, dtype=float))
 
-    # Define a function to run if there is no survival probability file
 
-    def no_file(force):
+def _backend_suffix(backend="proposal"):
 
-        # If the file does not exist, ask the user if they want to run PROPOSAL to create it
+    """Return the part of a file name that marks results of the NumPy backend. For PROPOSAL, this is empty."""
 
-        if not force:
+    return "" if backend == "proposal" else "_NumPy"
 
-            answer = input(
-                "No survival probability matrix currently exists for the set lab, medium, or number of muons. Would you like to create one (y/n)?: "
-            )
 
-        if force or answer.lower() == "y":
+def _lab_suffix(slant_depths=None):
 
-            survival_full = calc_survival_probability_tensor(force=force)
+    """Return the part of a file name that marks results for slant depths other than constants.SLANT_DEPTHS. These results are named after the set lab. For constants.SLANT_DEPTHS, this is empty."""
 
-            return survival_full
+    slant_depths = _get_slant_depths(slant_depths)
 
-        else:
+    if len(slant_depths) == len(constants.SLANT_DEPTHS) and np.allclose(
+        slant_depths, constants.SLANT_DEPTHS
+    ):
 
-            print("Survival probabilities not calculated.")
+        return ""
 
-            return None
+    return "_" + constants.get_lab()
 
-    # Construct a file name based on the set lab, medium, and number of muons
 
-    file_name = os.path.join(
+# Estimate the cost of propagating the muons in every bin
+
+
+def _bin_costs_file_name(slant_depths=None):
+
+    """Return the full path and name of the file that stores the measured propagation times per muon of the bins for the set medium and density, and for slant_depths (constants.SLANT_DEPTHS if None)."""
+
+    return os.path.join(
         constants.get_directory(),
-        "survival_probabilities",
-        "{0}_{1}_{2}_Survival_Probabilities.txt".format(
-            constants.get_medium(), constants.get_density(), constants.get_n_muon()
+        "underground_energies",
+        "{0}_{1}{2}_Bin_Costs.npy".format(
+            constants.get_medium(), constants.get_density(), _lab_suffix(slant_depths)
         ),
     )
 
-    # Check if the file exists
-    # Also check that the file has the correct number of energies and angles
 
-    if os.path.isfile(file_name):
+def _estimate_bin_costs(slant_depths=None):
 
-        if constants.get_verbose() > 1:
-            print("Loading survival probabilities from " + file_name + ".")
+    """Return the estimated propagation time per muon in every surface energy-slant depth bin in arbitrary units, from the distance a muon can travel, min(X, R_max(E)), times the number of stochastic losses per unit distance. If slant_depths is None, constants.SLANT_DEPTHS is used."""
 
-        # If the file exists, read in the survival probabilities from it
+    return (
+        1
+        + np.minimum(
+            _get_slant_depths(slant_depths)[np.newaxis, :],
+            _calc_max_ranges()[:, np.newaxis],
+        )
+        * (1 + constants.ENERGIES[:, np.newaxis] / ENERGY_CUTS[0])
+    )
 
-        file = open(file_name, "r")
-        n_lines = len(file.read().splitlines())
 
-        file.close()
+def _calc_bin_costs(slant_depths=None):
 
-        if n_lines == constants.len_iju:
+    """Return the estimated propagation time per muon in every surface energy-slant depth bin. Bins timed in a previous run (see _write_bin_costs()) use the measured times."""
 
-            survival = np.reshape(
-                np.loadtxt(file_name)[:, 3],
-                (
-                    len(constants.ENERGIES),
-                    len(constants.SLANT_DEPTHS),
-                    len(constants.ENERGIES),
-                ),
-            )
+    costs = _estimate_bin_costs(slant_depths)
 
-            if constants.get_verbose() > 1:
-                print("Loaded survival probabilities.")
+    # Scale the estimates of the untimed bins to match the timed bins
 
-            return survival
+    if os.path.isfile(_bin_costs_file_name(slant_depths)):
 
-        else:
+        measured = np.load(_bin_costs_file_name(slant_depths))
 
-            return no_file(force=force)
+        if measured.shape == costs.shape and np.any(measured > 0):
 
-    else:
+            timed = measured > 0
 
-        return no_file(force=force)
+            costs = np.where(
+                timed, measured, costs * np.median(measured[timed] / costs[timed])
+            )
 
+    return costs
 
-# Read the energies and slant depths from a survival probabilities file
 
+def _write_bin_costs(bin_times, slant_depths=None):
 
-def print_survival_probability_tensor_grids(file_name):
+    """Store the measured propagation times per muon, bin_times, for the bins that were timed, and keep the times of the other bins from previous runs. Untimed bins are NaN in bin_times. If slant_depths is None, constants.SLANT_DEPTHS is used."""
 
-    """Return the slant depths and underground energies in a survival probability file."""
+    timed = ~np.isnan(bin_times)
 
-    file_contents = np.loadtxt(
-        os.path.join(constants.get_directory(), "survival_probabilities", file_name)
+    if not np.any(timed):
+        return
+
+    costs = np.zeros(bin_times.shape)
+
+    if os.path.isfile(_bin_costs_file_name(slant_depths)):
+
+        measured = np.load(_bin_costs_file_name(slant_depths))
+
+        if measured.shape == costs.shape:
+            costs = measured
+
+    costs[timed] = bin_times[timed]
+
+    np.save(_bin_costs_file_name(slant_depths), costs)
+
+
+# Order and group the tasks for the worker processes
+
+
+def _schedule_tasks(tasks, costs, n_workers):
+
+    """
+    Return the tasks grouped into chunks for the worker processes, in order of decreasing cost, with chunks of about the remaining cost divided by twice the number of workers (guided scheduling).
+
+    Parameters
+    ----------
+    tasks : list of tuple
+        The tasks, as passed to _propagate_task().
+
+    costs : NumPy ndarray
+        The estimated cost of every surface energy-slant depth bin. See _calc_bin_costs().
+
+    n_workers : int
+        The number of worker processes.
+
+    Returns
+    -------
+    chunks : list of list of tuple
+        The chunks of tasks.
+    """
+
+    task_costs = np.array([np.sum(costs[task[0], list(task[1])]) for task in tasks])
+
+    order = np.argsort(-task_costs, kind="stable")
+
+    chunks = []
+    remaining = np.sum(task_costs)
+
+    for k in order:
+
+        if len(chunks) == 0 or chunk_cost >= target:
+
+            chunks.append([])
+            chunk_cost = 0
+            target = remaining / (2 * n_workers)
+
+        chunks[-1].append(tasks[k])
+        chunk_cost += task_costs[k]
+        remaining -= task_costs[k]
+
+    return chunks
+
+
+# Find the underground energy bin of a muon
+
+
+def _u_energy_bin(u_energy):
+
+    """Return the index of the bin in constants.E_BINS that u_energy falls in, using the same edge convention as np.histogram(), or None if it falls outside of the bins."""
+
+    if u_energy == constants.E_BINS[-1]:
+
+        return len(constants.ENERGIES) - 1
+
+    u = np.searchsorted(constants.E_BINS, u_energy, side="right") - 1
+
+    if 0 <= u < len(constants.ENERGIES):
+
+        return u
+
+    return None
+
+
+# Histogram underground energies
+
+
+def _calc_u_counts(u_energies):
+
+    """Return the underground energy histograms for every surface energy-slant depth bin as an integer array. If u_energies already holds histograms, it is returned unchanged."""
+
+    if u_energies.ndim == 3:
+
+        return u_energies
+
+    u_counts = np.zeros(u_energies.shape + (len(constants.ENERGIES),), dtype=np.int64)
+
+    for i in range(u_energies.shape[0]):
+
+        for x in range(u_energies.shape[1]):
+
+            u_counts[i, x, :] = np.histogram(
+                np.array(u_energies[i, x]), bins=constants.E_BINS
+            )[0]
+
+    return u_counts
+
+
+# Normalise underground energy histograms
+
+
+def _calc_survival(u_counts, n_thrown):
+
+    """Return the survival probabilities from the underground energy histograms and the number of muons thrown in every surface energy-slant depth bin. Bins in which no muons were thrown have survival probabilities of zero."""
+
+    n_thrown = np.asarray(n_thrown, dtype=float)[:, :, np.newaxis]
+
+    return np.divide(
+        u_counts, n_thrown, out=np.zeros(u_counts.shape), where=n_thrown > 0
+    )
+
+
+# Add underground energy histograms to those of an existing survival probability tensor
+
+
+def _add_existing_u_counts(u_counts, n_thrown, slant_depths=None, backend="proposal"):
+
+    """Add the underground energy histograms and numbers of muons thrown of the existing survival probability tensor for slant_depths and backend to u_counts and n_thrown. A ValueError is raised if the only existing tensor is for another density."""
+
+    survival, n_thrown_existing = _find_stored_survival(
+        slant_depths, backend, exact=True
+    )
+
+    if survival is None:
+
+        file_name, density = _find_survival_file(slant_depths, backend)
+
+        if os.path.isfile(file_name) and float(density) != constants.get_density():
+
+            raise ValueError(
+                "The existing survival probabilities in {0} are for a density of {1} g/cm^3, not the set density of {2} g/cm^3, so they cannot be refined.".format(
+                    file_name, density, constants.get_density()
+                )
+            )
+
+        survival, depths = (
+            _read_survival(file_name) if os.path.isfile(file_name) else (None, None)
+        )
+
+        if (
+            survival is None
+            or len(depths) != len(_get_slant_depths(slant_depths))
+            or not np.allclose(depths, _get_slant_depths(slant_depths), atol=1e-5)
+        ):
+
+            if constants.get_verbose() >= 1:
+                print("There are no survival probabilities to refine.")
+
+            return u_counts, n_thrown
+
+        n_thrown_existing = _load_n_thrown(density, slant_depths, backend)
+
+    elif survival.ndim == 2:
+
+        survival = _unpack_survival(survival)
+
+    u_counts_existing = np.rint(survival * n_thrown_existing[:, :, np.newaxis]).astype(
+        np.int64
+    )
+
+    if constants.get_verbose() > 1:
+        print(
+            "Adding {0} muons to the {1} muons of the existing survival probabilities.".format(
+                np.sum(n_thrown), np.sum(n_thrown_existing)
+            )
+        )
+
+    return u_counts + u_counts_existing, np.asarray(n_thrown) + n_thrown_existing
+
+
+# Calculate the statistical variances of the survival probabilities
+
+
+def _calc_survival_variances(
+    survival, n_thrown, variance_method="binomial", packed=False
+):
+
+    """Return the binomial (p * (1 - p) / N) or Poisson (p / N) variances of the survival probabilities, in the same form as survival, given the number of muons thrown in every bin."""
+
+    assert variance_method in [
+        "binomial",
+        "poisson",
+    ], "variance_method must be binomial or poisson."
+
+    if packed:
+
+        n_thrown = np.transpose(np.asarray(n_thrown, dtype=float))[
+            :, np.triu_indices(len(constants.ENERGIES))[1]
+        ]
+
+    else:
+
+        n_thrown = np.asarray(n_thrown, dtype=float)[:, :, np.newaxis]
+
+    if variance_method == "binomial":
+
+        variances = survival * (1 - survival)
+
+    else:
+
+        variances = np.array(survival, dtype=float)
+
+    return np.divide(
+        variances, n_thrown, out=np.zeros(survival.shape), where=n_thrown > 0
+    )
+
+
+# Describe the inputs of propagation products, to key them in the artefact store
+
+
+def _propagation_parameters(backend="proposal"):
+
+    """Return the energy grid and the physics settings of backend that every propagation product depends on."""
+
+    parameters = {"energy_grid": store.digest(constants.E_BINS)}
+
+    if backend == "proposal":
+
+        parameters["energy_cuts"] = list(ENERGY_CUTS)
+        parameters["parametrisations"] = list(PARAMETRISATIONS)
+        parameters["proposal"] = store.get_version("proposal")
+
+    else:
+
+        parameters["loss_parameters"] = list(
+            NUMPY_LOSS_PARAMETERS[constants.get_medium()]
+        )
+        parameters["step"] = NUMPY_STEP
+        parameters["numpy"] = np.__version__
+
+    return parameters
+
+
+def _survival_parameters(slant_depths=None, backend="proposal"):
+
+    """Return every input that the directly propagated survival probability tensor for the set medium, density, and number of muons depends on, for slant_depths (constants.SLANT_DEPTHS if None) and backend."""
+
+    return {
+        "medium": constants.get_medium(),
+        "density": constants.get_density(),
+        "n_muon": constants.get_n_muon(),
+        "slant_depths": [float(depth) for depth in _get_slant_depths(slant_depths)],
+        "backend": backend,
+        **_propagation_parameters(backend),
+    }
+
+
+def _u_counts_parameters(metadata):
+
+    """Return every input that the underground energy histograms of a run depend on, from the description of the run written to its output file. The lists of bins and of the number of muons thrown are entered by their digest."""
+
+    parameters = dict(metadata)
+    parameters["bins"] = store.digest(np.asarray(metadata["bins"], dtype=np.int64))
+
+    if "n_thrown" in metadata:
+
+        parameters["n_thrown"] = store.digest(
+            np.asarray(metadata["n_thrown"], dtype=np.int64)
+        )
+
+    parameters.update(_propagation_parameters(metadata["backend"]))
+
+    return parameters
+
+
+def _survival_tolerances():
+
+    """Return the tolerances of the inputs of a survival probability tensor to find it in the artefact store, which allow a tensor for a density within the density tolerance to be used."""
+
+    if constants.get_density_tolerance() > 0:
+
+        return {"density": constants.get_density_tolerance()}
+
+    return None
+
+
+def _find_stored_survival(
+    slant_depths=None, backend="proposal", mmap=False, exact=False
+):
+
+    """Return the survival probability tensor for slant_depths and backend from the artefact store and the number of muons thrown in every bin, or None, None. Unless exact is True, a density within the density tolerance is accepted."""
+
+    stored = store.get(
+        "survival",
+        _survival_parameters(slant_depths, backend),
+        None if exact else _survival_tolerances(),
+        mmap,
+    )
+
+    if stored is None:
+
+        return None, None
+
+    if "survival_packed" in stored:
+
+        return stored["survival_packed"], stored["n_thrown"]
+
+    return stored["survival"], stored["n_thrown"]
+
+
+# Construct the file name for the number of muons thrown in every bin of a survival probability tensor
+
+
+def _survival_file_name(suffix, density=None, slant_depths=None, backend="proposal"):
+
+    """Return the full path and name of a survival probability file ending in _Survival_{suffix}, for density if it is given, or for the set density otherwise."""
+
+    if density is None:
+        density = constants.get_density()
+
+    return os.path.join(
+        constants.get_directory(),
+        "survival_probabilities",
+        "{0}_{1}_{2}{3}{4}_Survival_{5}".format(
+            constants.get_medium(),
+            density,
+            constants.get_n_muon(),
+            _lab_suffix(slant_depths),
+            _backend_suffix(backend),
+            suffix,
+        ),
+    )
+
+
+def _find_survival_file(slant_depths=None, backend="proposal", composed=False):
+
+    """Return the full path and name of the survival probability file to load for slant_depths and backend, and the density in its name. If there is no file, the name of the binary file for the set density is returned."""
+
+    suffix = "Composed_Probabilities" if composed else "Probabilities"
+
+    for extension in [".npy", ".txt"]:
+
+        density = _find_density(
+            _survival_file_name(
+                suffix + extension,
+                density="{0}",
+                slant_depths=slant_depths,
+                backend=backend,
+            )
+        )
+
+        file_name = _survival_file_name(
+            suffix + extension, density, slant_depths, backend
+        )
+
+        if os.path.isfile(file_name):
+
+            return file_name, density
+
+    return (
+        _survival_file_name(suffix + ".npy", None, slant_depths, backend),
+        constants.get_density(),
+    )
+
+
+# Write and read survival probability tensors
+# A tensor is stored in a .npy file, and its energy and slant depth grids and a description of it in a JSON file
+
+
+def _pack_survival(survival):
+
+    """Return the survival probability tensor survival in packed form, leaving out the bins with an underground energy above the surface energy. A ValueError is raised if any of these bins is not empty."""
+
+    u_above, i_above = np.tril_indices(len(constants.ENERGIES), -1)
+
+    if np.any(survival[i_above, :, u_above]):
+
+        raise ValueError(
+            "The survival probability tensor has underground energies above the surface energies, so it cannot be packed."
+        )
+
+    u_indices, i_indices = np.triu_indices(len(constants.ENERGIES))
+
+    return np.ascontiguousarray(np.transpose(survival[i_indices, :, u_indices]))
+
+
+def _unpack_survival(packed):
+
+    """Return the full survival probability tensor from the packed tensor packed. See _pack_survival()."""
+
+    u_indices, i_indices = np.triu_indices(len(constants.ENERGIES))
+
+    survival = np.zeros((len(constants.ENERGIES), len(packed), len(constants.ENERGIES)))
+    survival[i_indices, :, u_indices] = np.transpose(packed)
+
+    return survival
+
+
+def _save_survival(file_name, survival, slant_depths, metadata):
+
+    """Write the survival probability tensor survival, packed if possible, to file_name.npy, and its grids and the metadata to file_name.json."""
+
+    survival = np.asarray(survival, dtype=float)
+
+    try:
+
+        np.save(file_name + ".npy", _pack_survival(survival))
+        storage = "survival_packed"
+
+    except ValueError:
+
+        np.save(file_name + ".npy", survival)
+        storage = "survival"
+
+    metadata = dict(
+        metadata,
+        format=storage,
+        shape=list(np.shape(survival)),
+        energies=constants.ENERGIES.tolist(),
+        slant_depths=np.asarray(slant_depths, dtype=float).tolist(),
+    )
+
+    with open(file_name + ".json", "w") as file_out:
+
+        json.dump(metadata, file_out, indent=4)
+
+
+def _read_survival(file_name, mmap=False, packed=False):
+
+    """Return the survival probability tensor and its slant depths from a .npy or older text survival probability file, or (None, None) if its energies are not constants.ENERGIES."""
+
+    if file_name.endswith(".npy"):
+
+        with open(file_name[: -len(".npy")] + ".json", "r") as file_in:
+
+            metadata = json.load(file_in)
+
+        if len(metadata["energies"]) != len(constants.ENERGIES) or not np.allclose(
+            metadata["energies"], constants.ENERGIES
+        ):
+
+            return None, None
+
+        survival = np.load(file_name, mmap_mode="r" if mmap else None)
+
+        # Convert between the packed and full forms if needed
+
+        if metadata["format"] == "survival_packed" and not packed:
+
+            survival = _unpack_survival(survival)
+
+        elif metadata["format"] == "survival" and packed:
+
+            survival = _pack_survival(survival)
+
+        return survival, np.array(metadata["slant_depths"])
+
+    # Every line of a text file holds a surface energy, a slant depth, an underground energy, and a survival probability
+
+    data = np.loadtxt(file_name, ndmin=2)
+
+    depths = np.unique(data[:, 1])
+
+    if len(data) != len(constants.ENERGIES) ** 2 * len(depths):
+
+        return None, None
+
+    survival = np.reshape(
+        data[:, 3], (len(constants.ENERGIES), len(depths), len(constants.ENERGIES))
+    )
+
+    if packed:
+
+        survival = _pack_survival(survival)
+
+    return survival, depths
+
+
+def _read_survival_slant_depths(file_name):
+
+    """Return the slant depths of a survival probability file, without reading the survival probabilities from a .npy file."""
+
+    if file_name.endswith(".npy"):
+
+        with open(file_name[: -len(".npy")] + ".json", "r") as file_in:
+
+            return np.array(json.load(file_in)["slant_depths"])
+
+    return np.unique(np.loadtxt(file_name, usecols=1, ndmin=1))
+
+
+def _n_thrown_file_name(density=None, slant_depths=None, backend="proposal"):
+
+    """Return the full path and name of the file that stores the number of muons thrown in every surface energy-slant depth bin of the survival probability tensor for the set medium, density, and number of muons. If density is given, it is used instead of the set density."""
+
+    return _survival_file_name("Thrown.npy", density, slant_depths, backend)
+
+
+# Load the number of muons thrown in every bin of a survival probability tensor
+
+
+def _load_n_thrown(density=None, slant_depths=None, backend="proposal"):
+
+    """Return the number of muons thrown in every surface energy-slant depth bin of the survival probability tensor. Tensors written by older versions of MUTE do not store this, so the set number of muons is used for every bin."""
+
+    if os.path.isfile(_n_thrown_file_name(density, slant_depths, backend)):
+
+        return np.load(_n_thrown_file_name(density, slant_depths, backend))
+
+    return np.full(
+        (len(constants.ENERGIES), len(_get_slant_depths(slant_depths))),
+        constants.get_n_muon(),
+    )
+
+
+# Derive the random seed for a single bin
+
+
+def _bin_seed(seed, i, x=None):
+
+    """Return the random seed for the (i, x) surface energy-slant depth bin, so that every bin has its own reproducible random number stream. If x is None, return the seed for the tracks of surface energy i that are scored at several slant depths."""
+
+    # SeedSequence ignores trailing zeros in its entropy, so [seed, i] would give the same seed as [seed, i, 0]
+    # The tracks are told apart from the bins by a spawn key instead
+
+    if x is None:
+
+        sequence = np.random.SeedSequence([int(seed), i], spawn_key=(1,))
+
+    else:
+
+        sequence = np.random.SeedSequence([int(seed), i, x])
+
+    return int(sequence.generate_state(1)[0])
+
+
+# Calculate the statistical precision of the survival probabilities of a bin
+
+
+def _calc_precision(u_counts_ix, n_thrown_ix):
+
+    """Return the relative statistical error of the survival probabilities of a surface energy-slant depth bin, weighted by the number of survivors in every underground energy bin."""
+
+    # Within a bin, the surface flux and energy bin width are common factors, so every underground energy bin contributes to the underground flux in proportion to its survivors
+    # With c_u survivors in bin u, C in total, and N thrown, the precision is sum_u (c_u / C) * sqrt((1 - c_u / N) / c_u)
+    # The bins are not weighted against each other, as that depends on the surface flux model, so the target applies to every bin on its own
+
+    u_counts_ix = np.asarray(u_counts_ix, dtype=float)
+    n_survived = np.sum(u_counts_ix)
+
+    if n_survived == 0:
+
+        return np.inf
+
+    return np.sum(np.sqrt(u_counts_ix * (1 - u_counts_ix / n_thrown_ix))) / n_survived
+
+
+def _u_counts_ix(u_energies_ix, histogram):
+
+    """Return the underground energy histogram of a bin from its underground energies, or u_energies_ix itself if it is already a histogram."""
+
+    if histogram:
+
+        return u_energies_ix
+
+    return np.histogram(u_energies_ix, bins=constants.E_BINS)[0]
+
+
+# Propagate muons in batches until the survival probabilities are precise enough
+
+
+def _propagate_batches(propagate, n_depths, histogram, adaptive, n_muon):
+
+    """Propagate the muons of a task with propagate(n_muon), in batches of min_muons muons until the precision is reached if adaptive is set. Return the underground energies and the number of muons propagated."""
+
+    if adaptive is None:
+
+        return propagate(n_muon), n_muon
+
+    # The random number stream continues from one batch to the next, so the muons are the same as the first muons of a single call
+
+    target_precision, min_muons, max_muons = adaptive
+
+    batches = [[] for _ in range(n_depths)]
+    u_counts = np.zeros((n_depths, len(constants.ENERGIES)), dtype=np.int64)
+    n_thrown = 0
+
+    while n_thrown < max_muons:
+
+        n_batch = min(min_muons, max_muons - n_thrown)
+
+        for k, u_energies_k in enumerate(propagate(n_batch)):
+
+            batches[k].append(u_energies_k)
+
+            u_counts[k] += _u_counts_ix(u_energies_k, histogram)
+
+        n_thrown += n_batch
+
+        # Stop once every slant depth of the task is precise enough
+
+        if all(
+            _calc_precision(u_counts[k], n_thrown) <= target_precision
+            for k in range(n_depths)
+        ):
+
+            break
+
+    if histogram:
+
+        return list(u_counts), n_thrown
+
+    return [np.concatenate(batches_k) for batches_k in batches], n_thrown
+
+
+# Propagate the muons in a task
+
+
+def _propagate_task(task):
+
+    """Seed the random number generator and propagate the muons of a task (see propagate_muons()). Return a list of (i, x, u_energies_ix, n_thrown_ix) for the bins of the task."""
+
+    # The task covers surface energy i and the slant depth indices xs, where slant_depths and n_muons hold the slant depths and numbers of muons of xs
+    # adaptive is None, or (target_precision, min_muons, max_muons), in which case n_muons is not used
+
+    i, xs, seed, histogram, multi_depth, slant_depths, adaptive, n_muons, backend = task
+
+    # The NumPy backend propagates every muon of a bin through all of its slant depths at once, with its own random number generator
+
+    if backend == "numpy":
+
+        if multi_depth:
+
+            rng = np.random.default_rng(_bin_seed(seed, i))
+
+            u_energies_i, n_thrown = _propagate_batches(
+                lambda n_muon: _propagation_loop_numpy(
+                    constants.ENERGIES[i],
+                    slant_depths,
+                    rng,
+                    histogram=histogram,
+                    n_muon=n_muon,
+                ),
+                len(xs),
+                histogram,
+                adaptive,
+                max(n_muons),
+            )
+
+            return [(i, x, u_energies_i[k], n_thrown) for k, x in enumerate(xs)]
+
+        results = []
+
+        for x, slant_depth, n_muon in zip(xs, slant_depths, n_muons):
+
+            rng = np.random.default_rng(_bin_seed(seed, i, x))
+
+            u_energies_ix, n_thrown = _propagate_batches(
+                lambda n_muon: _propagation_loop_numpy(
+                    constants.ENERGIES[i],
+                    [slant_depth],
+                    rng,
+                    histogram=histogram,
+                    n_muon=n_muon,
+                ),
+                1,
+                histogram,
+                adaptive,
+                n_muon,
+            )
+
+            results.append((i, x, u_energies_ix[0], n_thrown))
+
+        return results
+
+    if multi_depth:
+
+        pp.RandomGenerator.get().set_seed(_bin_seed(seed, i))
+
+        u_energies_i, n_thrown = _propagate_batches(
+            lambda n_muon: _propagation_loop_multi_depth(
+                constants.ENERGIES[i],
+                np.array(slant_depths),
+                histogram=histogram,
+                n_muon=n_muon,
+            ),
+            len(xs),
+            histogram,
+            adaptive,
+            max(n_muons),
+        )
+
+        return [(i, x, u_energies_i[k], n_thrown) for k, x in enumerate(xs)]
+
+    results = []
+
+    for x, slant_depth, n_muon in zip(xs, slant_depths, n_muons):
+
+        pp.RandomGenerator.get().set_seed(_bin_seed(seed, i, x))
+
+        u_energies_ix, n_thrown = _propagate_batches(
+            lambda n_muon: [
+                _propagation_loop(
+                    constants.ENERGIES[i],
+                    slant_depth,
+                    histogram=histogram,
+                    n_muon=n_muon,
+                )
+            ],
+            1,
+            histogram,
+            adaptive,
+            n_muon,
+        )
+
+        results.append((i, x, u_energies_ix[0], n_thrown))
+
+    return results
+
+
+# Propagate the muons in a chunk of tasks
+
+
+def _propagate_chunk(chunk):
+
+    """Propagate the muons of every task in a chunk of tasks, and return (task_results, elapsed, peak_rss, pid) for every task."""
+
+    # Report an exception raised while setting up the worker process to the parent process
+
+    if _worker_error is not None:
+
+        raise _worker_error
+
+    chunk_results = []
+
+    for task in chunk:
+
+        start = time.perf_counter()
+        task_results = _propagate_task(task)
+
+        chunk_results.append(
+            (task_results, time.perf_counter() - start, _calc_peak_rss(), os.getpid())
+        )
+
+    return chunk_results
+
+
+# Measure the peak memory use of the process
+
+
+def _calc_peak_rss():
+
+    """Return the peak resident memory of the current process in [MB], or None if the platform does not report it."""
+
+    if resource is None:
+
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports the peak resident memory in [kB], and macOS in [B]
+
+    return peak_rss / 1024 ** (2 if sys.platform == "darwin" else 1)
+
+
+# Set up a worker process for parallel propagation
+
+
+# An exception raised while setting up a worker process, which is raised again by the first chunk of tasks the worker runs
+# A multiprocessing pool replaces a worker whose initializer raises without reporting the exception, so it has to be passed on through the results instead
+
+_worker_error = None
+
+
+def _init_worker(settings):
+
+    """Copy the constants of the parent process into a worker process and create the worker's own propagator. The NumPy backend does not need a propagator. The directory is assigned directly, as constants.set_directory() can download data. An exception is kept in _worker_error instead of being raised."""
+
+    global _worker_error
+
+    try:
+
+        constants.set_verbose(0)
+        constants._directory = settings["directory"]
+        constants.set_medium(settings["medium"])
+        constants.set_density(settings["density"])
+        constants.set_n_muon(settings["n_muon"])
+
+        if settings["backend"] == "proposal":
+
+            _create_propagator(force=True)
+
+    except Exception as error:
+
+        _worker_error = error
+
+
+# Allocate the muons to the bins by their contribution to the underground intensities
+
+
+def calc_muon_allocation(
+    n_muon_total,
+    location="USStd",
+    month=None,
+    interaction_model="SIBYLL-2.3c",
+    primary_model="GSF",
+    atmosphere="CORSIKA",
+    survival=None,
+    pilot_muons=100,
+    min_muons=None,
+    seed=0,
+    slant_depths=None,
+    force=False,
+    backend="proposal",
+):
+
+    """
+    Calculate the number of muons to propagate in every surface energy-slant depth bin, in proportion to the share of the bin in the underground intensity at its slant depth.
+
+    Most of the underground intensity at a slant depth comes from a narrow band of surface energies. The share of bin (i, x) is estimated as the surface flux at the zenith angle of slant depth x for the set vertical depth, times the width of surface energy bin i, times the survival probability of bin (i, x), normalised over the surface energies at slant depth x. Every feasible bin (see _calc_feasible_bins()) first gets min_muons muons, so that no bin is left unsampled, and the rest of the budget is handed out in proportion to the shares. Pass the result to propagate_muons(n_muons=...); the survival probabilities of every bin are then normalised by its own number of muons, so the tensor stays unbiased.
+
+    Parameters
+    ----------
+    n_muon_total : int
+        The total number of muons to hand out over the feasible bins.
+
+    location : str, optional (default: "USStd")
+        The name of the location of the surface fluxes. See mts.load_s_fluxes_from_file().
+
+    month : str, optional (default: None)
+        The month of the surface fluxes. See mts.load_s_fluxes_from_file().
+
+    interaction_model: str, optional (default: "SIBYLL-2.3c")
+        The hadronic interaction model of the surface fluxes. See mts.load_s_fluxes_from_file().
+
+    primary_model : str in {"GSF", "HG", "GH", "ZS", "ZSP"} or tuple, optional (default: "GSF")
+        The primary flux model of the surface fluxes. See mts.load_s_fluxes_from_file().
+
+    atmosphere : {"CORSIKA", "MSIS00"}, optional (default: "CORSIKA")
+        The atmospheric model of the surface fluxes. See mts.load_s_fluxes_from_file().
+
+    survival : NumPy ndarray, optional (default: None)
+        A survival probability tensor for slant_depths to estimate the shares from, such as an existing tensor with fewer muons. If None, a cheap pilot run of pilot_muons muons per surface energy is propagated through all slant depths at once (see propagate_muons(multi_depth=True)).
+
+    pilot_muons : int, optional (default: 100)
+        The number of muons per surface energy in the pilot run.
+
+    min_muons : int, optional (default: None)
+        The minimum number of muons in every feasible bin. If None, a tenth of the average number of muons per feasible bin is used.
+
+    seed : int, optional (default: 0)
+        The random seed of the pilot run. Use a different seed for propagate_muons(), so that the muons used to allocate the budget are not reused in the survival probabilities.
+
+    slant_depths : array-like, optional (default: None)
+        The slant depths in [km.w.e.] to allocate the muons for. If None, constants.SLANT_DEPTHS is used.
+
+    force : bool, optional (default: False)
+        If True, force the calculation of a new surface flux matrix if required.
+
+    backend : {"proposal", "numpy"}, optional (default: "proposal")
+        The propagation engine of the pilot run. See propagate_muons().
+
+    Returns
+    -------
+    n_muons : NumPy ndarray
+        A two-dimensional integer array of shape (len(constants.ENERGIES), len(slant_depths)) containing the number of muons to propagate in every bin. Bins that no muon can survive are given min_muons muons, but are not propagated by propagate_muons() with prune set to True.
+    """
+
+    # Import packages
+
+    import scipy.interpolate as scii
+
+    slant_depths = _get_slant_depths(slant_depths)
+
+    feasible = _calc_feasible_bins(slant_depths)
+
+    # Check values
+
+    if min_muons is None:
+        min_muons = max(int(n_muon_total / np.sum(feasible) / 10), 1)
+
+    assert n_muon_total >= min_muons * np.sum(
+        feasible
+    ), "n_muon_total must be at least min_muons times the number of feasible bins."
+
+    # Get the surface fluxes
+
+    s_fluxes = surface.load_s_fluxes_from_file(
+        location, month, interaction_model, primary_model, atmosphere, force=force
+    )
+
+    if s_fluxes is None:
+
+        print("Muon allocation not calculated.")
+
+        return None
+
+    # Estimate the total survival probability of every bin with a pilot run if no tensor is given
+
+    if survival is None:
+
+        if constants.get_verbose() > 1:
+            print("Propagating pilot muons.")
+
+        survival = _calc_survival(
+            propagate_muons(
+                seed=seed,
+                output=False,
+                force=force,
+                histogram=True,
+                multi_depth=True,
+                n_muons=pilot_muons,
+                slant_depths=slant_depths,
+                backend=backend,
+                prune=True,
+            ),
+            np.full((len(constants.ENERGIES), len(slant_depths)), pilot_muons),
+        )
+
+    # Interpolate the surface fluxes to the zenith angle of every slant depth
+    # Slant depths smaller than the set vertical depth are not reached at any zenith angle, so they do not contribute
+
+    reached = slant_depths >= constants.get_vertical_depth()
+
+    angles = np.degrees(
+        np.arccos(np.minimum(constants.get_vertical_depth() / slant_depths, 1))
+    )
+
+    s_fluxes_x = np.maximum(
+        scii.interp1d(constants.ANGLES_FOR_S_FLUXES, s_fluxes, axis=1)(angles), 0
+    )
+
+    # Calculate the share of every bin in the underground intensity at its slant depth
+
+    contributions = (
+        s_fluxes_x
+        * constants.E_WIDTHS[:, np.newaxis]
+        * np.sum(survival, axis=2)
+        * feasible
+        * reached
+    )
+
+    totals = np.sum(contributions, axis=0)
+
+    shares = np.divide(
+        contributions,
+        totals,
+        out=np.zeros(contributions.shape),
+        where=totals > 0,
+    )
+
+    # Hand out the muons that are left after every feasible bin has min_muons muons, in proportion to the shares
+
+    n_muons = np.full(
+        (len(constants.ENERGIES), len(slant_depths)), min_muons, dtype=np.int64
+    )
+
+    if np.sum(shares) > 0:
+
+        n_muons += np.floor(
+            (n_muon_total - min_muons * np.sum(feasible)) * shares / np.sum(shares)
+        ).astype(np.int64)
+
+    if constants.get_verbose() > 1:
+        print(
+            "Allocated {0} muons, between {1} and {2} per bin.".format(
+                np.sum(n_muons[feasible]),
+                np.min(n_muons[feasible]),
+                np.max(n_muons[feasible]),
+            )
+        )
+
+    return n_muons
+
+
+# Propagate the muons and return underground energies
+
+
+def propagate_muons(
+    seed=0,
+    job_array_number=0,
+    output=None,
+    force=False,
+    n_workers=1,
+    histogram=False,
+    dtype="float64",
+    checkpoint_every=None,
+    resume=False,
+    prune=False,
+    multi_depth=False,
+    shard=None,
+    n_shards=None,
+    metrics_callback=None,
+    bins=None,
+    slant_depths=None,
+    target_precision=None,
+    min_muons=None,
+    max_muons=None,
+    n_muons=None,
+    backend="proposal",
+):
+
+    """
+    Propagate muons for the default surface energy grid and slant depths.
+
+    The default surface energy grid is given by constants.ENERGIES, and the default slant depths are given by constants.SLANT_DEPTHS. Other slant depths can be propagated with slant_depths, such as only the slant depths a lab needs, constants.slant_depths.
+
+    Every surface energy-slant depth bin is seeded with its own random number stream derived from seed and the bin indices, so the results do not depend on the order the bins are run in or on the number of worker processes.
+
+    Parameters
+    ----------
+    seed : int, optional (default: 0)
+        The random seed for use in the PROPOSAL propagator.
+
+    job_array_number : int, optional (default: 0)
+        The job array number from a high-statistics run on a computer cluster. This is set so the underground energy files from each job in the job array will be named differently.
+
+    output : bool, optional (default: taken from constants.get_output())
+        If True, an output file will be created to store the results.
+
+    force : bool, optional (default: False)
+        If True, this will force the creation of an underground_energies directory if one does not already exist.
+
+    n_workers : int, optional (default: 1)
+        The number of processes to spread the surface energy-slant depth bins over. Each worker process creates its own propagator. If 1, the bins are propagated in the current process. The bins are handed out longest first, using the times of previous runs for the set medium and density where they are available, so the workers finish at about the same time. See _schedule_tasks().
+
+    histogram : bool, optional (default: False)
+        If True, the underground energies of the surviving muons are counted into the bins of constants.E_BINS as they are propagated instead of being stored individually. This keeps the memory use independent of the number of muons.
+
+    dtype : {"float64", "float32", "uint16"}, optional (default: "float64")
+        The type the underground energies are written to the output file as. The energies are written in a flat ragged-array format (*_Values.npy, *_Offsets.npy, and *.json) that can be memory-mapped. For "uint16", the logarithms of the energies are quantised, which reduces the file size by a factor of four at a relative precision of about 3e-4. This is not used if histogram is True.
+
+    checkpoint_every : int, optional (default: None)
+        If set, the finished bins are flushed to a checkpoint directory next to the output file every checkpoint_every bins, together with the random seeds they were propagated with. The checkpoint is deleted once the run has finished.
+
+    resume : bool, optional (default: False)
+        If True, the bins stored in an existing checkpoint for the same settings and job_array_number are loaded instead of being propagated again. The settings include the backend, the slant depths, and the requested bins. Because every bin has its own random number stream, the output is bit-identical to that of an uninterrupted run. If False, an existing checkpoint is replaced, with a warning if verbose is at least 1.
+
+    prune : bool, optional (default: False)
+        If True, the bins in which the slant depth is beyond the maximum possible range of a muon with the surface energy are not propagated, and are recorded as having no survivors. See _calc_max_ranges(). The ranges have not yet been validated against PROPOSAL, so this is off by default.
+
+    multi_depth : bool, optional (default: False)
+        If True, every muon is propagated once to the largest slant depth, and its energy is scored as it crosses each of the smaller slant depths. This reduces the propagation cost by up to the number of slant depths. The survival probabilities at different slant depths are then correlated, but the statistics at each slant depth are unchanged.
+
+    shard : int, optional (default: None)
+        The index of the shard of the surface energy-slant depth bins to propagate, from 0 to n_shards - 1. The bins are dealt out to the shards in turn, so every shard has a similar mix of cheap and expensive bins. If multi_depth is True, the surface energies are dealt out instead. The output file name ends in _Shard_{shard}, and the metadata in the output file records which bins it covers, so the shards can be combined with merge_u_energies_files().
+
+    n_shards : int, optional (default: None)
+        The total number of shards. This must be set if shard is set.
+
+    bins : array-like of bool, optional (default: None)
+        A boolean array, broadcastable to the shape (len(constants.ENERGIES), len(slant_depths)), that is True for the surface energy-slant depth bins to propagate. The other bins are not propagated, and the metadata in the output file records that they are not covered, so the output can be added to an existing survival probability tensor with calc_survival_probability_tensor(file_names=..., refine=True). If None, all bins are propagated.
+
+    slant_depths : array-like, optional (default: None)
+        The slant depths in [km.w.e.] to propagate the muons to, in increasing order. For example, set this to constants.slant_depths to propagate only the slant depths needed for the set vertical depth. If the slant depths are not constants.SLANT_DEPTHS, the output file name contains the set lab, so the results can be reused for the lab. If None, constants.SLANT_DEPTHS is used.
+
+    target_precision : float, optional (default: None)
+        If set, the muons of every bin are propagated in batches of min_muons muons, and the propagation of the bin stops once the relative statistical error of its survival probabilities, weighted by the contribution of every underground energy bin to the underground flux (see _calc_precision()), is at most target_precision, or once max_muons muons have been propagated. The number of muons propagated in every bin is recorded in the metadata of the output file, so the results should be combined with merge_u_energies_files() or calc_survival_probability_tensor(file_names=...). The achieved precision of every bin is written to a file next to the output file, ending in _Precision.npy. If multi_depth is True, a track stops once all of its slant depths are precise enough. If None, every bin gets the set number of muons.
+
+    min_muons : int, optional (default: None)
+        The minimum number of muons to propagate in every bin if target_precision is set. This is also the size of the batches. It should be large enough that the precision of a bin is not underestimated from a few muons, for example when all of them fall into the same underground energy bin. If None, a tenth of max_muons is used.
+
+    max_muons : int, optional (default: None)
+        The maximum number of muons to propagate in every bin if target_precision is set. If None, the set number of muons is used.
+
+    n_muons : array-like of int, optional (default: None)
+        The number of muons to propagate in every surface energy-slant depth bin, broadcastable to the shape (len(constants.ENERGIES), len(slant_depths)), such as the output of calc_muon_allocation(). As with adaptive stopping, the number of muons propagated in every bin is recorded in the metadata of the output file, so the survival probabilities of every bin are normalised by its own number of muons. If multi_depth is True, the tracks of a surface energy use the largest number of muons of its slant depths. This cannot be used with target_precision. If None, every bin gets the set number of muons.
+
+    backend : {"proposal", "numpy"}, optional (default: "proposal")
+        The propagation engine. "proposal" runs the full Monte Carlo with PROPOSAL. "numpy" runs a fast analytic approximation that propagates all muons of a bin at once with NumPy, with continuous energy losses a(E) + b(E) * E for the set medium and sampled stochastic losses (see _propagation_loop_numpy()). It does not need PROPOSAL to be installed, and is meant for design studies and quick scans. It is experimental: its energy loss parameters (see NUMPY_LOSS_PARAMETERS) have not yet been validated against PROPOSAL. The output file names contain NumPy, so the results are kept apart from those of PROPOSAL. See validate_numpy_backend().
+
+    metrics_callback : callable, optional (default: None)
+        A function that is called with the run metrics of every bin as soon as the bin has finished. The metrics are a dict with the bin indices i and x, the surface energy in [MeV], the slant depth in [km.w.e.], the number of muons, the wall time in [s], the number of muons per second, the number of survivors, the precision of the survival probabilities (see target_precision), the peak resident memory in [MB] and the ID of the process that propagated the bin. If output is True, the metrics are also appended to a JSON-lines file next to the output file, ending in _Metrics.jsonl. If multi_depth is True, the wall time of a track is split evenly over its slant depths. The number of muons per second is that of the task that propagated the bin: the muons propagated by the task divided by its wall time, counting every muon of a multi-depth track once, however many slant depths it reaches. It is None if the task finished too quickly to be timed.
+
+    Returns
+    -------
+    u_energies : NumPy ndarray
+        A two-dimensional array containing lists of underground energies for muons that survived the propagation. If histogram is True, this is instead a three-dimensional integer array of shape (len(constants.ENERGIES), len(slant_depths), len(constants.ENERGIES)) containing the number of surviving muons in each underground energy bin.
+    """
+
+    # Check values
+
+    assert type(job_array_number) == int, "job_array_number must be an integer."
+    assert type(n_workers) == int, "n_workers must be an integer."
+    assert n_workers > 0, "n_workers must be positive."
+    assert (
+        checkpoint_every is None or checkpoint_every > 0
+    ), "checkpoint_every must be positive."
+    assert (shard is None) == (
+        n_shards is None
+    ), "shard and n_shards must be set together."
+    assert (
+        shard is None or 0 <= shard < n_shards
+    ), "shard must be between 0 and n_shards - 1."
+    assert (
+        target_precision is None or target_precision > 0
+    ), "target_precision must be positive."
+    assert (
+        target_precision is None or n_muons is None
+    ), "target_precision and n_muons cannot be set together."
+    assert backend in ["proposal", "numpy"], "backend must be proposal or numpy."
+
+    constants.check_constants(force=force)
+
+    # Set the limits of the number of muons per bin for adaptive stopping
+
+    adaptive = None
+
+    if target_precision is not None:
+
+        if max_muons is None:
+            max_muons = constants.get_n_muon()
+
+        if min_muons is None:
+            min_muons = max(max_muons // 10, 1)
+
+        assert (
+            0 < min_muons <= max_muons
+        ), "min_muons must be positive and no larger than max_muons."
+
+        adaptive = (float(target_precision), int(min_muons), int(max_muons))
+
+    if output is None:
+        output = constants.get_output()
+
+    lab_suffix = _lab_suffix(slant_depths)
+    slant_depths = _get_slant_depths(slant_depths)
+
+    assert np.all(np.diff(slant_depths) > 0), "slant_depths must be increasing."
+
+    # Find the number of muons to propagate in every bin
+
+    if n_muons is not None:
+
+        n_muons = np.array(
+            np.broadcast_to(
+                np.asarray(n_muons, dtype=np.int64),
+                (len(constants.ENERGIES), len(slant_depths)),
+            )
+        )
+
+        assert np.all(n_muons > 0), "n_muons must be positive."
+
+    # Initialise the matrix of underground energies or underground energy histograms
+
+    if histogram:
+
+        u_energies = np.zeros(
+            (
+                len(constants.ENERGIES),
+                len(slant_depths),
+                len(constants.ENERGIES),
+            ),
+            dtype=np.int64,
+        )
+
+    else:
+
+        u_energies = np.empty(
+            (len(constants.ENERGIES), len(slant_depths)), dtype=object
+        )
+
+        for i in np.ndindex(u_energies.shape):
+            u_energies[i] = []
+
+    # Construct the output file name
+    # This is also used to name the checkpoint directory
+
+    file_name = os.path.join(
+        constants.get_directory(),
+        "underground_energies",
+        "{0}_{1}_{2}{3}{4}_Underground_{5}_{6}".format(
+            constants.get_medium(),
+            constants.get_density(),
+            constants.get_n_muon(),
+            lab_suffix,
+            _backend_suffix(backend),
+            "Counts" if histogram else "Energies",
+            job_array_number,
+        ),
+    )
+
+    if n_shards is not None:
+
+        file_name += "_Shard_{0}".format(shard)
+
+    # Find the bins covered by this shard, out of the requested bins
+
+    in_shard = _calc_shard_bins(shard, n_shards, multi_depth, slant_depths)
+
+    if bins is not None:
+
+        in_shard &= np.broadcast_to(np.asarray(bins, dtype=bool), in_shard.shape)
+
+    # Find the bins where muons can reach the slant depth
+    # The other bins are skipped and left with no survivors
+
+    if prune:
+
+        feasible = _calc_feasible_bins(slant_depths) & in_shard
+
+        if constants.get_verbose() >= 1:
+            print(
+                "Skipping {0} of {1} bins ({2} muons) that no muon can survive.".format(
+                    np.sum(in_shard & ~feasible),
+                    np.sum(in_shard),
+                    (
+                        np.sum(in_shard & ~feasible) * constants.get_n_muon()
+                        if n_muons is None
+                        else np.sum(n_muons[in_shard & ~feasible])
+                    ),
+                )
+            )
+
+    else:
+
+        feasible = in_shard.copy()
+
+    # Record the number of muons thrown and the precision of the survival probabilities in every bin
+    # The bins that are not propagated are recorded with the number of muons they would have been given
+
+    n_thrown = (
+        np.full(
+            (len(constants.ENERGIES), len(slant_depths)),
+            constants.get_n_muon(),
+            dtype=np.int64,
+        )
+        if n_muons is None
+        else n_muons.copy()
+    )
+    precision = np.full((len(constants.ENERGIES), len(slant_depths)), np.nan)
+
+    # When resuming, skip the bins that are already stored in the checkpoint
+
+    if checkpoint_every is not None or resume:
+
+        constants.check_directory(
+            os.path.join(constants.get_directory(), "underground_energies"), force=force
+        )
+
+        journal = _open_checkpoint(
+            file_name,
+            seed,
+            histogram,
+            multi_depth,
+            resume,
+            slant_depths,
+            adaptive,
+            n_muons,
+            backend,
+            in_shard,
+        )
+
+        for i, x, u_energies_ix, n_thrown_ix in _read_checkpoint(file_name, journal):
+
+            u_energies[i, x] = u_energies_ix
+            n_thrown[i, x] = n_thrown_ix
+            precision[i, x] = _calc_precision(
+                _u_counts_ix(u_energies_ix, histogram), n_thrown_ix
+            )
+            feasible[i, x] = False
+
+        if resume and constants.get_verbose() >= 1:
+            print(
+                "Resuming from checkpoint with "
+                + str(len(journal["bins"]))
+                + " bins already propagated."
+            )
+
+    # Split the bins into tasks
+    # Each bin is an independent task, unless the muons are scored at every slant depth with a single track
+
+    if multi_depth:
+
+        tasks = [
+            (
+                i,
+                tuple(np.flatnonzero(feasible[i])),
+                seed,
+                histogram,
+                True,
+                tuple(slant_depths[feasible[i]]),
+                adaptive,
+                tuple(n_thrown[i, feasible[i]].tolist()),
+                backend,
+            )
+            for i in range(len(constants.ENERGIES))
+            if np.any(feasible[i])
+        ]
+
+    else:
+
+        tasks = [
+            (
+                i,
+                (x,),
+                seed,
+                histogram,
+                False,
+                (slant_depths[x],),
+                adaptive,
+                (int(n_thrown[i, x]),),
+                backend,
+            )
+            for i, x in zip(*np.nonzero(feasible))
+        ]
+
+    # Order the tasks by their estimated cost and group them into chunks for the worker processes
+    # In the current process, the tasks are run one at a time
+
+    if n_workers == 1:
+
+        chunks = [[task] for task in tasks]
+
+    else:
+
+        # The estimated costs are per muon, so they are scaled by the number of muons in every bin
+
+        chunks = _schedule_tasks(
+            tasks, _calc_bin_costs(slant_depths) * n_thrown, n_workers
+        )
+
+    # Run the propagation function and print the underground energies
+
+    if constants.get_verbose() >= 1:
+
+        if adaptive is None:
+
+            print(
+                "Propagating "
+                + str(
+                    sum(max(task[7]) if multi_depth else task[7][0] for task in tasks)
+                )
+                + " muons."
+            )
+
+        else:
+
+            print(
+                "Propagating up to "
+                + str(max_muons * len(tasks))
+                + " muons, to a precision of "
+                + str(target_precision)
+                + "."
+            )
+
+    # Create the propagator in this process before any worker process starts
+    # A missing PROPOSAL installation is then reported at once, and the interpolation tables are only built once, by this process, instead of by every worker process at the same time
+
+    if backend == "proposal":
+        _create_propagator(force=force)
+
+    progress = tqdm(total=np.sum(feasible)) if constants.get_verbose() >= 1 else None
+    pool = None
+
+    if n_workers == 1:
+
+        results = map(_propagate_chunk, chunks)
+
+    else:
+
+        settings = {
+            "directory": constants.get_directory(),
+            "medium": constants.get_medium(),
+            "density": constants.get_density(),
+            "n_muon": constants.get_n_muon(),
+            "backend": backend,
+        }
+
+        # Each worker creates its own propagator once in _init_worker(), reading the interpolation tables built by this process
+
+        pool = multiprocessing.Pool(
+            n_workers, initializer=_init_worker, initargs=(settings,)
+        )
+        results = pool.imap_unordered(_propagate_chunk, chunks)
+
+    # Time every bin, so that later runs can be scheduled from the measured costs
+    # The metrics of every bin are written to the metrics file as soon as the bin finishes, so that the run can be monitored
+
+    bin_times = np.full((len(constants.ENERGIES), len(slant_depths)), np.nan)
+
+    metrics_file = None
+
+    if output:
+
+        constants.check_directory(
+            os.path.join(constants.get_directory(), "underground_energies"), force=force
+        )
+
+        metrics_file = open(file_name + "_Metrics.jsonl", "a" if resume else "w")
+
+    try:
+
+        pending = []
+
+        for task_results, elapsed, peak_rss, pid in (
+            task_result for chunk_results in results for task_result in chunk_results
+        ):
+
+            # Every muon of a multi-depth track is propagated through all of its slant depths, so it is only counted once
+            # A task that is too fast for the clock is not timed
+
+            n_thrown_task = [n_thrown_ix for _, _, _, n_thrown_ix in task_results]
+            n_thrown_task = (
+                max(n_thrown_task, default=0) if multi_depth else sum(n_thrown_task)
+            )
+
+            for i, x, u_energies_ix, n_thrown_ix in task_results:
+
+                u_energies[i, x] = u_energies_ix
+                n_thrown[i, x] = n_thrown_ix
+                precision[i, x] = _calc_precision(
+                    _u_counts_ix(u_energies_ix, histogram), n_thrown_ix
+                )
+
+                if elapsed > 0 and n_thrown_ix > 0:
+                    bin_times[i, x] = elapsed / len(task_results) / n_thrown_ix
+
+                # Record the metrics of the bin
+
+                metrics = {
+                    "i": int(i),
+                    "x": int(x),
+                    "energy": float(constants.ENERGIES[i]),
+                    "slant_depth": float(slant_depths[x]),
+                    "n_muon": int(n_thrown_ix),
+                    "wall_time": elapsed / len(task_results),
+                    "muons_per_second": n_thrown_task / elapsed
+                    if elapsed > 0
+                    else None,
+                    "survivors": int(
+                        np.sum(u_energies_ix) if histogram else len(u_energies_ix)
+                    ),
+                    "precision": float(precision[i, x]),
+                    "peak_rss": peak_rss,
+                    "pid": pid,
+                }
+
+                if metrics_file is not None:
+
+                    metrics_file.write(json.dumps(metrics) + "\n")
+                    metrics_file.flush()
+
+                if metrics_callback is not None:
+                    metrics_callback(metrics)
+
+            # Flush the finished bins to the checkpoint every checkpoint_every bins
+
+            if checkpoint_every is not None:
+
+                pending += task_results
+
+                if len(pending) >= checkpoint_every:
+
+                    _write_checkpoint(file_name, journal, pending)
+                    pending = []
+
+            if progress is not None:
+                progress.update(len(task_results))
+
+        if checkpoint_every is not None and len(pending) > 0:
+
+            _write_checkpoint(file_name, journal, pending)
+
+    finally:
+
+        if pool is not None:
+
+            pool.terminate()
+            pool.join()
+
+        if metrics_file is not None:
+            metrics_file.close()
+
+        if progress is not None:
+            progress.close()
+
+    if constants.get_verbose() >= 1:
+        print("Finished propagation.")
+
+    if output:
+
+        constants.check_directory(
+            os.path.join(constants.get_directory(), "underground_energies"), force=force
+        )
+
+        # Describe the run in the output file, so that partial results can be merged
+
+        metadata = {
+            "seed": int(seed),
+            "job_array_number": job_array_number,
+            "shard": 0 if shard is None else shard,
+            "n_shards": 1 if n_shards is None else n_shards,
+            "multi_depth": multi_depth,
+            "medium": constants.get_medium(),
+            "density": constants.get_density(),
+            "n_muon": constants.get_n_muon(),
+            "slant_depths": slant_depths.tolist(),
+            "backend": backend,
+            "bins": np.argwhere(in_shard).tolist(),
+        }
+
+        # With adaptive stopping or a number of muons per bin, the number of muons thrown differs between the bins
+
+        if n_muons is not None:
+
+            metadata["n_thrown"] = n_thrown.tolist()
+
+        if adaptive is not None:
+
+            metadata["target_precision"] = target_precision
+            metadata["n_thrown"] = n_thrown.tolist()
+
+        if histogram:
+
+            _write_u_counts(file_name, u_energies, metadata)
+
+        else:
+
+            _write_u_energies(file_name, u_energies, dtype=dtype, metadata=metadata)
+
+        # The measured costs are only used to schedule PROPOSAL runs
+
+        if backend == "proposal":
+            _write_bin_costs(bin_times, slant_depths)
+
+        if adaptive is not None:
+
+            np.save(file_name + "_Precision.npy", precision)
+
+        if constants.get_verbose() > 1:
+            print("Underground energies written to " + file_name + ".")
+
+        store.put(
+            "u_counts",
+            _u_counts_parameters(metadata),
+            {"u_counts": _calc_u_counts(u_energies), "n_thrown": n_thrown},
+        )
+
+    # The checkpoint is no longer needed once the run has finished and the output has been written
+
+    if checkpoint_every is not None or resume:
+
+        shutil.rmtree(file_name + "_Checkpoint", ignore_errors=True)
+
+    return u_energies
+
+
+# Checkpoint and resume propagation runs
+# The checkpoint of a run is stored in a directory next to its output file
+# Journal.json records the settings of the run, the bins that have finished, and the segment files they are stored in
+# Every flush writes the finished bins, their underground energies, and the random seeds they were propagated with to a new segment file
+
+
+def _open_checkpoint(
+    file_name,
+    seed,
+    histogram,
+    multi_depth,
+    resume,
+    slant_depths,
+    adaptive=None,
+    n_muons=None,
+    backend="proposal",
+    bins=None,
+):
+
+    """Return the journal of the checkpoint for file_name, after checking it against the current settings if resume is True, or start a new checkpoint."""
+
+    checkpoint_dir = file_name + "_Checkpoint"
+
+    journal = {
+        "seed": int(seed),
+        "histogram": histogram,
+        "multi_depth": multi_depth,
+        "medium": constants.get_medium(),
+        "density": constants.get_density(),
+        "n_muon": constants.get_n_muon(),
+        "shape": [len(constants.ENERGIES), len(slant_depths)],
+        "slant_depths": [float(depth) for depth in slant_depths],
+        "backend": backend,
+        "bin_mask": None if bins is None else store.digest(bins),
+        "adaptive": None if adaptive is None else list(adaptive),
+        "n_muons": None if n_muons is None else n_muons.tolist(),
+        "bins": [],
+        "segments": [],
+    }
+
+    if resume and os.path.isfile(os.path.join(checkpoint_dir, "Journal.json")):
+
+        with open(os.path.join(checkpoint_dir, "Journal.json"), "r") as file_in:
+
+            journal_read = json.load(file_in)
+
+        for key in [
+            "seed",
+            "histogram",
+            "multi_depth",
+            "medium",
+            "density",
+            "n_muon",
+            "shape",
+            "slant_depths",
+            "backend",
+            "bin_mask",
+            "adaptive",
+            "n_muons",
+        ]:
+
+            if journal_read.get(key) != journal[key]:
+
+                raise ValueError(
+                    "The checkpoint in {0} was written with {1} = {2}, but the current value is {3}.".format(
+                        checkpoint_dir, key, journal_read.get(key), journal[key]
+                    )
+                )
+
+        return journal_read
+
+    # An existing checkpoint is replaced, so warn about the bins that are thrown away
+
+    if os.path.isdir(checkpoint_dir) and constants.get_verbose() >= 1:
+        print(
+            "Replacing the checkpoint in {0}. Use resume = True to continue it instead.".format(
+                checkpoint_dir
+            )
+        )
+
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    os.makedirs(checkpoint_dir)
+
+    return journal
+
+
+def _write_checkpoint(file_name, journal, pending):
+
+    """Write the finished bins in pending to a new segment file and record them in the journal. The journal is replaced atomically, so an interrupted flush leaves the previous checkpoint intact."""
+
+    checkpoint_dir = file_name + "_Checkpoint"
+    segment = "Segment_{0}.npz".format(len(journal["segments"]))
+
+    bins = np.array([[i, x] for i, x, _, _ in pending], dtype=np.int64)
+    seeds = np.array(
+        [
+            _bin_seed(journal["seed"], i, None if journal["multi_depth"] else x)
+            for i, x, _, _ in pending
+        ]
+    )
+    n_thrown = np.array([n_thrown_ix for _, _, _, n_thrown_ix in pending])
+
+    if journal["histogram"]:
+
+        np.savez(
+            os.path.join(checkpoint_dir, segment),
+            bins=bins,
+            seeds=seeds,
+            n_thrown=n_thrown,
+            u_counts=np.array([u_energies_ix for _, _, u_energies_ix, _ in pending]),
+        )
+
+    else:
+
+        u_energies = np.empty(len(pending), dtype=object)
+        u_energies[:] = [u_energies_ix for _, _, u_energies_ix, _ in pending]
+
+        values, offsets = _flatten_u_energies(u_energies)
+
+        np.savez(
+            os.path.join(checkpoint_dir, segment),
+            bins=bins,
+            seeds=seeds,
+            n_thrown=n_thrown,
+            values=values,
+            offsets=offsets,
+        )
+
+    journal["bins"] += bins.tolist()
+    journal["segments"].append(segment)
+
+    with open(os.path.join(checkpoint_dir, "Journal.json.tmp"), "w") as file_out:
+
+        json.dump(journal, file_out)
+
+    os.replace(
+        os.path.join(checkpoint_dir, "Journal.json.tmp"),
+        os.path.join(checkpoint_dir, "Journal.json"),
+    )
+
+
+def _read_checkpoint(file_name, journal):
+
+    """Yield (i, x, u_energies_ix, n_thrown_ix) for every bin stored in the segment files of the checkpoint journal."""
+
+    for segment in journal["segments"]:
+
+        with np.load(os.path.join(file_name + "_Checkpoint", segment)) as segment_in:
+
+            n_thrown = segment_in["n_thrown"]
+
+            for k, (i, x) in enumerate(segment_in["bins"]):
+
+                if journal["histogram"]:
+
+                    yield i, x, segment_in["u_counts"][k], n_thrown[k]
+
+                else:
+
+                    yield i, x, list(
+                        segment_in["values"][
+                            segment_in["offsets"][k] : segment_in["offsets"][k + 1]
+                        ]
+                    ), n_thrown[k]
+
+
+# Write and read underground energies in a flat ragged-array format
+# All underground energies of a file are stored in one contiguous array (*_Values.npy)
+# The energies of bin (i, x) are values[offsets[k]:offsets[k + 1]], where k = i * (number of slant depths) + x (*_Offsets.npy)
+# The storage type and the shape of the bin grid are stored in a JSON file (*.json)
+
+
+def _flatten_u_energies(u_energies):
+
+    """Concatenate the lists of underground energies of all bins into one array and return it with the offsets of the bins."""
+
+    offsets = np.zeros(u_energies.size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(u_energies[i]) for i in np.ndindex(u_energies.shape)])
+
+    values = np.zeros(offsets[-1])
+
+    for k, i in enumerate(np.ndindex(u_energies.shape)):
+
+        values[offsets[k] : offsets[k + 1]] = u_energies[i]
+
+    return values, offsets
+
+
+def _write_u_energies(file_name, u_energies, dtype="float64", metadata=None):
+
+    """
+    Write underground energies to the flat ragged-array format.
+
+    Parameters
+    ----------
+    file_name : str
+        The full path and name of the files without an extension.
+
+    u_energies : NumPy ndarray
+        A two-dimensional array containing lists of underground energies.
+
+    dtype : {"float64", "float32", "uint16"}, optional (default: "float64")
+        The type the underground energies are stored as. For "uint16", the logarithms of the energies are quantised into 65536 steps between the edges of constants.E_BINS, which is a lossy compression to a relative precision of about 3e-4.
+
+    metadata : dict, optional (default: None)
+        A description of the run that produced the underground energies, which is stored in the JSON file.
+    """
+
+    assert dtype in [
+        "float64",
+        "float32",
+        "uint16",
+    ], 'dtype must be "float64", "float32", or "uint16".'
+
+    values, offsets = _flatten_u_energies(u_energies)
+
+    metadata = dict(
+        {} if metadata is None else metadata,
+        format="ragged",
+        dtype=dtype,
+        shape=list(u_energies.shape),
+    )
+
+    if dtype == "uint16":
+
+        metadata["log_min"] = float(np.log10(constants.E_BINS[0]))
+        metadata["log_max"] = float(np.log10(constants.E_BINS[-1]))
+
+        values = np.round(
+            (
+                np.clip(np.log10(values), metadata["log_min"], metadata["log_max"])
+                - metadata["log_min"]
+            )
+            / (metadata["log_max"] - metadata["log_min"])
+            * np.iinfo(np.uint16).max
+        )
+
+    np.save(file_name + "_Values.npy", values.astype(dtype))
+    np.save(file_name + "_Offsets.npy", offsets)
+
+    with open(file_name + ".json", "w") as file_out:
+
+        json.dump(metadata, file_out, indent=4)
+
+
+def _read_u_energies(file_name, mmap=True):
+
+    """
+    Read underground energies from the flat ragged-array format, or from a pickled object array written by older versions of MUTE.
+
+    Parameters
+    ----------
+    file_name : str
+        The full path and name of the files without an extension.
+
+    mmap : bool, optional (default: True)
+        If True, the array of underground energies is memory-mapped instead of being read into memory.
+
+    Returns
+    -------
+    values : NumPy array
+        The underground energies of all bins.
+
+    offsets : NumPy array
+        The offsets of the bins in values.
+
+    metadata : dict
+        The storage type and the shape of the bin grid.
+    """
+
+    # Convert a pickled object array written by an older version of MUTE
+
+    if not os.path.isfile(file_name + "_Offsets.npy"):
+
+        u_energies = np.load(file_name + ".npy", allow_pickle=True)
+
+        values, offsets = _flatten_u_energies(u_energies)
+
+        return (
+            values,
+            offsets,
+            {"format": "ragged", "dtype": "float64", "shape": list(u_energies.shape)},
+        )
+
+    with open(file_name + ".json", "r") as file_in:
+
+        metadata = json.load(file_in)
+
+    values = np.load(file_name + "_Values.npy", mmap_mode="r" if mmap else None)
+    offsets = np.load(file_name + "_Offsets.npy")
+
+    return values, offsets, metadata
+
+
+def _write_u_counts(file_name, u_counts, metadata):
+
+    """Write underground energy histograms to a .npy file, and a description of the run that produced them to a JSON file."""
+
+    np.save(file_name + ".npy", u_counts)
+
+    metadata = dict(metadata, format="counts", shape=list(u_counts.shape[:2]))
+
+    with open(file_name + ".json", "w") as file_out:
+
+        json.dump(metadata, file_out, indent=4)
+
+
+def _u_energies_bin(values, offsets, metadata, i, x):
+
+    """Return the underground energies of bin (i, x) from the arrays returned by _read_u_energies(). Unless the energies are quantised, this is a view into values that does not copy any data."""
+
+    k = i * metadata["shape"][1] + x
+
+    return _decode_u_energies(values[offsets[k] : offsets[k + 1]], metadata)
+
+
+def _decode_u_energies(values, metadata):
+
+    """Return the underground energies stored in values. Quantised energies are converted back to [MeV]; otherwise, values is returned unchanged."""
+
+    if metadata["dtype"] == "uint16":
+
+        return 10 ** (
+            metadata["log_min"]
+            + values
+            / np.iinfo(np.uint16).max
+            * (metadata["log_max"] - metadata["log_min"])
+        )
+
+    return values
+
+
+def _u_energies_file_exists(file_name):
+
+    """Return True if an underground energies file exists in either the ragged-array format or the older pickled format. file_name should not have an extension."""
+
+    return os.path.isfile(file_name + "_Offsets.npy") or os.path.isfile(
+        file_name + ".npy"
+    )
+
+
+def _is_u_counts_file(file_name):
+
+    """Return True if the .npy file is an array of underground energy histograms written by propagate_muons() with histogram set to True. Only the header of the file is read."""
+
+    if not os.path.isfile(file_name + ".npy"):
+
+        return False
+
+    with open(file_name + ".npy", "rb") as file_in:
+
+        version = np.lib.format.read_magic(file_in)
+
+        if version == (1, 0):
+
+            shape = np.lib.format.read_array_header_1_0(file_in)[0]
+
+        else:
+
+            shape = np.lib.format.read_array_header_2_0(file_in)[0]
+
+    return len(shape) == 3
+
+
+# Load underground energies
+
+
+def _load_u_energies_from_files(file_name, n_job=1, force=False, n_threads=None):
+
+    """
+    Load the underground energies resulting from the PROPOSAL Monte Carlo from a file or collection of files stored in data/underground_energies.
+
+    The files can contain either underground energies, in the flat ragged-array format or the older pickled format, or underground energy histograms written by propagate_muons() with histogram set to True. Every file is streamed into running underground energy histograms, so the memory use does not grow with the number of files or muons.
+
+    Parameters
+    ----------
+    file_name : str, optional
+        The file name pattern that the underground energy data is stored in. This should end in an underscore so the function can append the job array number.
+
+    n_job : int, optional (default: 1)
+        The number of jobs that were run on the computer cluster. Set this to the number of files the underground energies are spread across.
+
+    force : bool, optional (default: False)
+        If True, this will force the creation of an underground_energies directory if one does not already exist.
+
+    n_threads : int, optional (default: None)
+        The number of threads to read and histogram the files with. If None, the number of CPUs is used.
+
+    Returns
+    -------
+    u_counts : NumPy ndarray
+        A three-dimensional integer array of shape (len(constants.ENERGIES), number of slant depths, len(constants.ENERGIES)) containing the number of surviving muons in each underground energy bin, summed over all files.
+    """
+
+    # Check values
+
+    constants.check_constants(force=force)
+
+    # Check that the directory exists
+
+    if not os.path.exists(constants.get_directory() + "/underground_energies"):
+
+        if constants.get_verbose() >= 1:
+
+            print(
+                constants.get_directory()
+                + "/underground_energies does not exist. Underground energies not loaded."
+            )
+
+        return None
+
+    # Test if the file exists
+
+    if not _u_energies_file_exists(file_name + "_0"):
+
+        if constants.get_verbose() >= 1:
+
+            print(file_name + "_0 does not exist. Underground energies not loaded.")
+
+        return None
+
+    # Stream the files into running histograms
+    # The files are read and histogrammed concurrently, and added to the sum in file order
+
+    u_counts = None
+
+    file_names = [file_name + "_" + str(a) for a in range(n_job)]
+
+    for u_counts_a in (
+        tqdm(_map_files(_histogram_u_energies_file, file_names, n_threads), total=n_job)
+        if constants.get_verbose() >= 1
+        else _map_files(_histogram_u_energies_file, file_names, n_threads)
+    ):
+
+        if u_counts is None:
+
+            u_counts = np.array(u_counts_a, dtype=np.int64)
+
+        else:
+
+            u_counts += u_counts_a
+
+    if constants.get_verbose() > 1:
+        print("Loaded underground energies.")
+
+    return u_counts
+
+
+# Read the number of muons thrown in every bin from underground energy files
+
+
+def _load_n_thrown_from_files(file_name, n_job, n_thrown):
+
+    """Return the total number of muons thrown in every bin of the files, or n_thrown if none of them records it."""
+
+    metadata = []
+
+    for a in range(n_job):
+
+        if not os.path.isfile(file_name + "_" + str(a) + ".json"):
+
+            return n_thrown
+
+        with open(file_name + "_" + str(a) + ".json", "r") as file_in:
+
+            metadata.append(json.load(file_in))
+
+    if not any("n_thrown" in metadata_a for metadata_a in metadata):
+
+        return n_thrown
+
+    return sum(
+        np.asarray(metadata_a["n_thrown"], dtype=np.int64)
+        if "n_thrown" in metadata_a
+        else np.full(np.shape(n_thrown), metadata_a["n_muon"], dtype=np.int64)
+        for metadata_a in metadata
+    )
+
+
+# Histogram the underground energies in a file
+
+
+def _histogram_u_energies_file(file_name, chunk_size=2 ** 22):
+
+    """Return the underground energy histograms of every surface energy-slant depth bin in an underground energies file. The energies are histogrammed chunk_size at a time, so the memory use does not depend on the size of the file."""
+
+    if _is_u_counts_file(file_name):
+
+        return np.load(file_name + ".npy")
+
+    values, offsets, metadata = _read_u_energies(file_name)
+
+    n_bins = len(offsets) - 1
+    n_u = len(constants.ENERGIES)
+
+    u_counts = np.zeros(n_bins * n_u, dtype=np.int64)
+
+    for start in range(0, len(values), chunk_size):
+
+        stop = min(start + chunk_size, len(values))
+
+        # Find the surface energy-slant depth bin and the underground energy bin of every energy
+        # Use the same edge convention as np.histogram()
+
+        bins = np.searchsorted(offsets, np.arange(start, stop), side="right") - 1
+
+        u_energies = _decode_u_energies(values[start:stop], metadata)
+
+        u = np.searchsorted(constants.E_BINS, u_energies, side="right") - 1
+        u[u_energies == constants.E_BINS[-1]] = n_u - 1
+
+        in_range = (u >= 0) & (u < n_u)
+
+        u_counts += np.bincount(
+            bins[in_range] * n_u + u[in_range], minlength=n_bins * n_u
+        )
+
+    return u_counts.reshape(metadata["shape"] + [n_u])
+
+
+# Apply a function to files in a thread pool
+
+
+def _map_files(function, file_names, n_threads=None):
+
+    """Yield function(file_name) for every file in file_names, in the order of file_names. The files are processed in a pool of n_threads threads (all CPUs if None), with at most twice that many results held in memory at once."""
+
+    if n_threads is None:
+
+        n_threads = os.cpu_count() or 1
+
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+
+        running = []
+
+        for file_name in file_names:
+
+            running.append(executor.submit(function, file_name))
+
+            if len(running) >= 2 * n_threads:
+
+                yield running.pop(0).result()
+
+        for future in running:
+
+            yield future.result()
+
+
+# Merge partial results
+
+
+def merge_u_energies_files(
+    file_names, force=False, n_threads=None, slant_depths=None, backend="proposal"
+):
+
+    """
+    Merge underground energy files written by propagate_muons() into underground energy histograms and the number of muons thrown in every bin.
+
+    Any mix of files can be merged, such as shards of the bins from propagate_muons(shard=k, n_shards=N) and jobs with different seeds that each cover all bins. The files are streamed into running histograms, so the memory use does not grow with the number of files or muons.
+
+    Parameters
+    ----------
+    file_names : list of str
+        The full paths and names of the files to merge. The extension can be left off or be .json, for example the output of glob.glob("data/underground_energies/*.json").
+
+    force : bool, optional (default: False)
+        If True, this will force the creation of the working directory if one does not already exist.
+
+    n_threads : int, optional (default: None)
+        The number of threads to read and histogram the files with. If None, the number of CPUs is used.
+
+    slant_depths : array-like, optional (default: None)
+        The slant depths in [km.w.e.] that the files must have been propagated to. If None, constants.SLANT_DEPTHS is used.
+
+    backend : {"proposal", "numpy"}, optional (default: "proposal")
+        The backend that the files must have been propagated with. See propagate_muons().
+
+    Returns
+    -------
+    u_counts : NumPy ndarray
+        A three-dimensional integer array of shape (len(constants.ENERGIES), len(slant_depths), len(constants.ENERGIES)) containing the number of surviving muons in each underground energy bin.
+
+    n_thrown : NumPy ndarray
+        A two-dimensional integer array of shape (len(constants.ENERGIES), len(slant_depths)) containing the number of muons propagated in each surface energy-slant depth bin.
+
+    Raises
+    ------
+    ValueError
+        If a file does not describe the run that produced it, was produced for different constants, or if shards are missing or bins are covered more than once with the same random numbers.
+    """
+
+    # Check values
+
+    constants.check_constants(force=force)
+
+    slant_depths = _get_slant_depths(slant_depths)
+
+    file_names = [
+        file_name[: -len(".json")] if file_name.endswith(".json") else file_name
+        for file_name in file_names
+    ]
+
+    # Read the descriptions of all files first, so that missing or duplicate shards are found before any underground energies are read
+
+    metadata = []
+
+    for file_name in file_names:
+
+        if not os.path.isfile(file_name + ".json"):
+
+            raise ValueError(
+                "{0} does not describe the run that produced it. Use _load_u_energies_from_files() instead.".format(
+                    file_name
+                )
+            )
+
+        with open(file_name + ".json", "r") as file_in:
+
+            metadata.append(json.load(file_in))
+
+        if "bins" not in metadata[-1]:
+
+            raise ValueError(
+                "{0} does not record which bins it covers.".format(file_name)
+            )
+
+        for key, value in [
+            ("medium", constants.get_medium()),
+            ("density", constants.get_density()),
+            ("shape", [len(constants.ENERGIES), len(slant_depths)]),
+            ("backend", backend),
+        ]:
+
+            if metadata[-1][key] != value:
+
+                raise ValueError(
+                    "{0} was written with {1} = {2}, but the current value is {3}.".format(
+                        file_name, key, metadata[-1][key], value
+                    )
+                )
+
+        if not np.allclose(metadata[-1]["slant_depths"], slant_depths):
+
+            raise ValueError(
+                "{0} was propagated to slant depths {1}, but the requested slant depths are {2}.".format(
+                    file_name, metadata[-1]["slant_depths"], slant_depths.tolist()
+                )
+            )
+
+    # Bins propagated with the same seed and scoring mode use the same random numbers, so they must not be covered more than once
+    # Every shard of a sharded run must be present
+
+    coverage = {}
+    shards = {}
+
+    for file_name, metadata_a in zip(file_names, metadata):
+
+        run = (metadata_a["seed"], metadata_a["multi_depth"])
+        bins = np.reshape(metadata_a["bins"], (-1, 2))
+
+        coverage.setdefault(
+            run,
+            np.zeros((len(constants.ENERGIES), len(slant_depths)), dtype=np.int64),
+        )
+        np.add.at(coverage[run], (bins[:, 0], bins[:, 1]), 1)
+
+        shards.setdefault(run + (metadata_a["n_shards"],), []).append(
+            metadata_a["shard"]
+        )
+
+    for run in coverage:
+
+        if np.any(coverage[run] > 1):
+
+            raise ValueError(
+                "{0} bins are covered more than once by files with seed {1}.".format(
+                    np.sum(coverage[run] > 1), run[0]
+                )
+            )
+
+    for run in shards:
+
+        missing = sorted(set(range(run[2])) - set(shards[run]))
+
+        if len(missing) > 0:
+
+            raise ValueError(
+                "Shards {0} of the {1} shards with seed {2} are missing.".format(
+                    missing, run[2], run[0]
+                )
+            )
+
+    # Reduce the files into the histograms as they are read
+
+    u_counts = np.zeros(
+        (len(constants.ENERGIES), len(slant_depths), len(constants.ENERGIES)),
+        dtype=np.int64,
+    )
+    n_thrown = np.zeros((len(constants.ENERGIES), len(slant_depths)), dtype=np.int64)
+
+    # Files propagated with adaptive stopping record the number of muons thrown in every bin
+
+    for metadata_a in metadata:
+
+        bins = np.reshape(metadata_a["bins"], (-1, 2))
+
+        if "n_thrown" in metadata_a:
+
+            n_thrown[bins[:, 0], bins[:, 1]] += np.asarray(
+                metadata_a["n_thrown"], dtype=np.int64
+            )[bins[:, 0], bins[:, 1]]
+
+        else:
+
+            n_thrown[bins[:, 0], bins[:, 1]] += metadata_a["n_muon"]
+
+    for u_counts_a in (
+        tqdm(
+            _map_files(_histogram_u_energies_file, file_names, n_threads),
+            total=len(file_names),
+        )
+        if constants.get_verbose() >= 1
+        else _map_files(_histogram_u_energies_file, file_names, n_threads)
+    ):
+
+        u_counts += u_counts_a
+
+    if constants.get_verbose() > 1:
+        print("Merged {0} underground energy files.".format(len(file_names)))
+
+    return u_counts, n_thrown
+
+
+def calc_survival_probability_tensor(
+    seed=0,
+    file_name=None,
+    n_job=1,
+    output=None,
+    force=False,
+    histogram=False,
+    file_names=None,
+    return_variances=False,
+    variance_method="binomial",
+    refine=False,
+    slant_depths=None,
+    backend="proposal",
+):
+
+    """
+    Calculate survival probabilities for the default surface energy grid and slant depths.
+
+    The default surface energy grid is given by constants.ENERGIES, and the default slant depths are given by constants.SLANT_DEPTHS. Survival probabilities for other slant depths, such as only those needed for the set lab, can be calculated with slant_depths. If the propagation of muons has already been done, this will load the underground energies file (it will load it for n_job = 1; to load for more jobs, call load_u_energies_from_files() directly), unless force is set to True.
+
+    Parameters
+    ----------
+    seed : int, optional (default: 0)
+        The random seed for use in the PROPOSAL propagator.
+
+    file_name : str, optional
+        The file name pattern that the underground energy data is stored in. This should end in an underscore so the function can append the job array number.
+
+    n_job : int, optional (default: 1)
+        The number of jobs that were run on the computer cluster. Set this to the number of files the underground energies are spread across.
+
+    output : bool, optional (default: taken from constants.get_output())
+        If True, an output file will be created to store the results.
+
+    force : bool, optional (default: False)
+        If True, this will force the muons to be propagated whether an underground energies file already exists or not.
+
+    histogram : bool, optional (default: False)
+        If True and muons have to be propagated, the underground energies are counted into histograms during the propagation instead of being stored individually. See propagate_muons().
+
+    file_names : list of str, optional (default: None)
+        The full paths and names of underground energy files to merge with merge_u_energies_files(), such as the shards of a sharded run. If set, these are used instead of file_name and n_job, and the survival probabilities in every bin are normalised by the number of muons thrown in that bin.
+
+    return_variances : bool, optional (default: False)
+        If True, the statistical variances of the survival probabilities are also returned. They are calculated from the same underground energy histograms, so no further propagation is needed.
+
+    variance_method : {"binomial", "poisson"}, optional (default: "binomial")
+        The statistical model for the variances. The binomial variance is exact for the survival in each bin. The Poisson variance is a slightly larger approximation that treats the underground energy bins as independent.
+
+    refine : bool, optional (default: False)
+        If True, the new underground energies are added to the existing survival probability tensor for the set medium, density, and number of muons, instead of replacing it. The counts in every bin are combined, weighted by the number of muons thrown in that bin by the existing tensor and by the new underground energies. This can be used with file_names to add muons to only some of the bins, such as the deep, high-energy bins, and the number of muons thrown in every bin is stored with the tensor. Only a tensor for exactly the set density is refined: a tensor for another density within the density tolerance raises a ValueError, as the refined tensor is written for the set density.
+
+    slant_depths : array-like, optional (default: None)
+        The slant depths in [km.w.e.] to calculate the survival probabilities for. For example, set this to constants.slant_depths to propagate only the slant depths needed for the set vertical depth. The survival probability file is then named after the set lab, and is used by mtu.calc_u_fluxes() instead of the default tensor while the slant depths of the lab match. If None, constants.SLANT_DEPTHS is used.
+
+    backend : {"proposal", "numpy"}, optional (default: "proposal")
+        The propagation engine to propagate the muons with, if they have to be propagated. The underground energy and survival probability files of the NumPy backend contain NumPy, so they do not replace those of PROPOSAL. See propagate_muons().
+
+    Returns
+    -------
+    survival : NumPy ndarray
+        A three-dimensional array containing the survival probabilities.
+
+    variances : NumPy ndarray
+        A three-dimensional array containing the variances of the survival probabilities. Only returned if return_variances is True.
+    """
+
+    # Check values
+
+    if output is None:
+        output = constants.get_output()
+
+    if slant_depths is not None:
+        slant_depths = _get_slant_depths(slant_depths)
+
+    # Construct the file names for underground energy histograms and lists of underground energies
+
+    file_names_default = [
+        os.path.join(
+            constants.get_directory(),
+            "underground_energies",
+            "{0}_{1}_{2}{3}{4}_Underground_{5}".format(
+                constants.get_medium(),
+                constants.get_density(),
+                int(constants.get_n_muon() / n_job),
+                _lab_suffix(slant_depths),
+                _backend_suffix(backend),
+                file_type,
+            ),
+        )
+        for file_type in ["Counts", "Energies"]
+    ]
+    file_names_default = [
+        file_name_default
+        for file_name_default in file_names_default
+        if _u_energies_file_exists(file_name_default + "_0")
+    ]
+
+    # The number of muons thrown in every bin is known from the files if they are merged
+    # Otherwise, it is the set number of muons
+
+    n_thrown = np.full(
+        (len(constants.ENERGIES), len(_get_slant_depths(slant_depths))),
+        constants.get_n_muon(),
+    )
+
+    # Look for the underground energy histograms of a run of propagate_muons() with this seed and the default settings in the store
+
+    stored = None
+
+    if file_names is None and file_name is None and n_job == 1 and not force:
+
+        tensor_depths = _get_slant_depths(slant_depths)
+
+        stored = store.get(
+            "u_counts",
+            _u_counts_parameters(
+                {
+                    "seed": int(seed),
+                    "job_array_number": 0,
+                    "shard": 0,
+                    "n_shards": 1,
+                    "multi_depth": False,
+                    "medium": constants.get_medium(),
+                    "density": constants.get_density(),
+                    "n_muon": constants.get_n_muon(),
+                    "slant_depths": tensor_depths.tolist(),
+                    "backend": backend,
+                    "bins": np.argwhere(
+                        np.ones((len(constants.ENERGIES), len(tensor_depths)))
+                    ).tolist(),
+                }
+            ),
+        )
+
+    # Check if files to merge have been specified
+    # If not, check if propagate_muons() should be forced or not
+    # If not, check if underground energies exist in the store or in files
+    # If not, ask if muons should be propagated
+
+    if file_names is not None:
+
+        u_energies, n_thrown = merge_u_energies_files(
+            file_names, force=force, slant_depths=slant_depths, backend=backend
+        )
+
+    elif force:
+
+        u_energies = propagate_muons(
+            seed=seed,
+            output=output,
+            force=force,
+            histogram=histogram,
+            slant_depths=slant_depths,
+            backend=backend,
+        )
+
+    else:
+
+        # Check if the user has specified underground energies to load
+        # If not, use those in the store
+        # If not, look for the default file name pattern, and check if it exists
+        # If so, load the underground energies
+        # If not, ask if muons should be propagated
+
+        if file_name is not None:
+
+            file_name = os.path.join(
+                constants.get_directory(), "underground_energies", file_name
+            )
+
+            u_energies = _load_u_energies_from_files(
+                file_name=file_name, n_job=n_job, force=force
+            )
+            n_thrown = _load_n_thrown_from_files(file_name, n_job, n_thrown)
+
+        elif stored is not None:
+
+            u_energies, n_thrown = stored["u_counts"], stored["n_thrown"]
+
+        elif len(file_names_default) > 0:
+
+            u_energies = _load_u_energies_from_files(
+                file_name=file_names_default[0], n_job=n_job, force=force
+            )
+            n_thrown = _load_n_thrown_from_files(file_names_default[0], n_job, n_thrown)
+
+        else:
+
+            answer = input(
+                "No underground energy file currently exists for the set lab, medium, or number of muons. Would you like to create one (y/n)?: "
+            )
+
+            if answer.lower() == "y":
+
+                u_energies = propagate_muons(
+                    seed=seed,
+                    output=output,
+                    force=force,
+                    histogram=histogram,
+                    slant_depths=slant_depths,
+                    backend=backend,
+                )
+
+            else:
+
+                print("Underground energies not calculated.")
+                print("Survival probabilities not calculated.")
+
+                return None if not return_variances else (None, None)
+
+    # Check that the underground energies were loaded
+
+    if u_energies is None:
+
+        print("Survival probabilities not calculated.")
+
+        return None if not return_variances else (None, None)
+
+    # Calculate the survival probabilities
+    # If the underground energies were histogrammed during the propagation, the histograms are used directly
+    # First index  = Surface energy
+    # Second index = Slant depth
+    # Third index  = Underground energy
+
+    if constants.get_verbose() > 1:
+        print("Calculating survival probabilities.")
+
+    u_counts = _calc_u_counts(u_energies)
+
+    # Add the counts of the existing survival probability tensor
+
+    if refine:
+
+        u_counts, n_thrown = _add_existing_u_counts(
+            u_counts, n_thrown, slant_depths, backend
+        )
+
+    survival = _calc_survival(u_counts, n_thrown)
+
+    if constants.get_verbose() > 1:
+        print("Finished calculating survival probabilities.")
+
+    # Write the results to a file
+
+    if output:
+
+        _write_survival(survival, n_thrown, slant_depths, backend, force=force)
+
+    if return_variances:
+
+        return survival, _calc_survival_variances(survival, n_thrown, variance_method)
+
+    return survival
+
+
+def _write_survival(
+    survival,
+    n_thrown,
+    slant_depths=None,
+    backend="proposal",
+    force=False,
+    composition=None,
+):
+
+    """Write the survival probability tensor and the number of muons thrown in every bin to the survival probability files, and put them into the artefact store. A tensor composed from slabs is written to its own file instead."""
+
+    constants.check_directory(
+        os.path.join(constants.get_directory(), "survival_probabilities"),
+        force=force,
+    )
+
+    file_name = _survival_file_name(
+        "Probabilities" if composition is None else "Composed_Probabilities",
+        slant_depths=slant_depths,
+        backend=backend,
+    )
+
+    metadata = {
+        "medium": constants.get_medium(),
+        "density": constants.get_density(),
+        "n_muon": constants.get_n_muon(),
+        "backend": backend,
+    }
+
+    if composition is not None:
+        metadata["composition"] = composition
+
+    _save_survival(file_name, survival, _get_slant_depths(slant_depths), metadata)
+
+    if constants.get_verbose() > 1:
+        print("Survival probabilities written to " + file_name + ".npy.")
+
+    if composition is not None:
+
+        return
+
+    np.save(
+        _n_thrown_file_name(slant_depths=slant_depths, backend=backend),
+        np.asarray(n_thrown, dtype=np.int64),
+    )
+
+    try:
+
+        arrays = {"survival_packed": _pack_survival(survival)}
+
+    except ValueError:
+
+        arrays = {"survival": survival}
+
+    arrays["n_thrown"] = np.asarray(n_thrown, dtype=np.int64)
+
+    store.put("survival", _survival_parameters(slant_depths, backend), arrays)
+
+
+def export_survival_probability_tensor(
+    slant_depths=None, backend="proposal", force=False
+):
+
+    """
+    Write the survival probability tensor for the set medium, density, and number of muons to a text file.
+
+    Survival probability tensors are stored in binary .npy files, which are much faster to read. The text file has one line for every bin, with the surface energy in [MeV], the slant depth in [km.w.e.], the underground energy in [MeV], and the survival probability, as written by older versions of MUTE, so it can be used outside of MUTE.
+
+    Parameters
+    ----------
+    slant_depths : array-like, optional (default: None)
+        The slant depths in [km.w.e.] of the survival probability tensor to export. See load_survival_probability_tensor_from_file(). If None, the tensor for constants.SLANT_DEPTHS is exported.
+
+    backend : {"proposal", "numpy"}, optional (default: "proposal")
+        The backend of the survival probability tensor to export. See propagate_muons().
+
+    force : bool, optional (default: False)
+        If True, force the calculation of a new survival probability tensor if required.
+
+    Returns
+    -------
+    file_name : str
+        The full path and name of the text file.
+    """
+
+    if slant_depths is not None:
+        slant_depths = _get_slant_depths(slant_depths)
+
+    survival = load_survival_probability_tensor_from_file(
+        force=force, slant_depths=slant_depths, backend=backend
+    )
+
+    if survival is None:
+
+        print("Survival probabilities not exported.")
+
+        return None
+
+    file_name = _survival_file_name(
+        "Probabilities.txt", slant_depths=slant_depths, backend=backend
+    )
+
+    # Write one line for every surface energy, slant depth, and underground energy, in that order
+
+    grids = np.meshgrid(
+        constants.ENERGIES,
+        _get_slant_depths(slant_depths),
+        constants.ENERGIES,
+        indexing="ij",
+    )
+
+    np.savetxt(
+        file_name,
+        np.column_stack([grid.ravel() for grid in grids] + [survival.ravel()]),
+        fmt=["%1.14f", "%1.5f", "%1.14f", "%1.14e"],
+    )
+
+    if constants.get_verbose() > 1:
+        print("Survival probabilities written to " + file_name + ".")
+
+    return file_name
+
+
+def load_survival_probability_tensor_from_file(
+    force=False,
+    return_variances=False,
+    variance_method="binomial",
+    slant_depths=None,
+    backend="proposal",
+    mmap=False,
+    packed=False,
+    composed=False,
+):
+
+    """
+    Retrieve a survival probability matrix stored in data/survival_probabilities based on the set global parameters.
+
+    The function searches for a file name that matches the set lab, medium, and number of muons. If the file does not exist, prompt the user to run calc_survival(). The survival probabilities are read from a binary .npy file. A text file written by an older version of MUTE is read instead if there is no binary file, and is converted to a binary file so that later loads are fast.
+
+    Parameters
+    ----------
+    force : bool
+        If True, force the calculation of a new survival probability tensor if required.
+
+    return_variances : bool, optional (default: False)
+        If True, the statistical variances of the survival probabilities are also returned. See calc_survival_probability_tensor().
+
+    variance_method : {"binomial", "poisson"}, optional (default: "binomial")
+        The statistical model for the variances.
+
+    slant_depths : array-like, optional (default: None)
+        The slant depths in [km.w.e.] of the survival probability tensor to load, such as constants.slant_depths for a tensor calculated for only the set lab. See calc_survival_probability_tensor(). If None, the tensor for constants.SLANT_DEPTHS is loaded.
+
+    backend : {"proposal", "numpy"}, optional (default: "proposal")
+        The backend of the survival probability tensor to load. See propagate_muons().
+
+    mmap : bool, optional (default: False)
+        If True, the survival probabilities are memory-mapped read-only from the binary file instead of being read into memory. Parts of the tensor are then only read from disk when they are used, such as the slices of single slant depths, and processes on the same machine that load the same tensor share its memory through the operating system. Tensors are stored packed, so this only applies together with packed set to True. With packed set to False, the tensor is unpacked into memory, unless it was stored in full by an older version of MUTE. A tensor that has to be calculated is returned in memory.
+
+    packed : bool, optional (default: False)
+        If True, the survival probabilities are returned in the packed form they are stored in. A muon cannot gain energy, so survival[i, x, u] is zero for every underground energy bin u above the surface energy bin i. The packed tensor leaves these bins out: it is a two-dimensional array of shape (len(slant_depths), len(constants.ENERGIES) * (len(constants.ENERGIES) + 1) / 2), in which element [x, k] is survival[i, x, u] for the k-th pair (u, i) of np.triu_indices(len(constants.ENERGIES)). The bins of every slant depth are contiguous, and are ordered by underground energy, then by surface energy. The variances are returned in the same form.
+
+    composed : bool, optional (default: False)
+        If True, the tensor composed from slabs with compose_survival_probability_tensor() is loaded instead of the directly propagated tensor, and is composed if there is no file for it. Its variances are not known, so return_variances must be False.
+
+    Returns
+    -------
+    survival : NumPy ndarray
+        A two-dimensional array containing the survival probabilities.
+
+    variances : NumPy ndarray
+        A three-dimensional array containing the variances of the survival probabilities. Only returned if return_variances is True.
+    """
+
+    # Define a function to run if there is no survival probability file
+
+    def no_file(force):
+
+        # If the file does not exist, ask the user if they want to run PROPOSAL to create it
+
+        if not force:
+
+            answer = input(
+                "No survival probability matrix currently exists for the set lab, medium, or number of muons. Would you like to create one (y/n)?: "
+            )
+
+        if force or answer.lower() == "y":
+
+            if composed:
+
+                survival_full = compose_survival_probability_tensor(
+                    force=force, slant_depths=slant_depths, backend=backend
+                )
+
+            else:
+
+                survival_full = calc_survival_probability_tensor(
+                    force=force,
+                    return_variances=return_variances,
+                    variance_method=variance_method,
+                    slant_depths=slant_depths,
+                    backend=backend,
+                )
+
+            if packed and survival_full is not None:
+
+                if return_variances:
+
+                    return tuple(_pack_survival(array) for array in survival_full)
+
+                return _pack_survival(survival_full)
+
+            return survival_full
+
+        else:
+
+            print("Survival probabilities not calculated.")
+
+            return None if not return_variances else (None, None)
+
+    # Construct a file name based on the set lab, medium, and number of muons
+    # If there is no file for the set density, a file for a density within the set tolerance can be used instead
+
+    if slant_depths is not None:
+        slant_depths = _get_slant_depths(slant_depths)
+
+    tensor_depths = _get_slant_depths(slant_depths)
+
+    if composed and return_variances:
+
+        raise ValueError(
+            "The variances of a survival probability tensor composed from slabs are not known."
+        )
+
+    # Look for a tensor calculated with exactly these inputs in the store first
+    # Composed tensors are not put into the store
+
+    survival, n_thrown = (
+        (None, None) if composed else _find_stored_survival(slant_depths, backend, mmap)
+    )
+
+    if survival is not None:
+
+        if constants.get_verbose() > 1:
+            print("Loaded survival probabilities from the store.")
+
+        is_packed = survival.ndim == 2
+
+        if is_packed and not packed:
+
+            survival = _unpack_survival(survival)
+
+        elif packed and not is_packed:
+
+            survival = _pack_survival(survival)
+
+        else:
+
+            survival = cache.writable(survival)
+
+        if return_variances:
+
+            return survival, _calc_survival_variances(
+                survival, n_thrown, variance_method, packed=packed
+            )
+
+        return survival
+
+    # Otherwise, look for a survival probability file
+
+    file_name, density = _find_survival_file(slant_depths, backend, composed)
+
+    # Check if the file exists
+
+    if not os.path.isfile(file_name):
+
+        return no_file(force=force)
+
+    if constants.get_verbose() > 1:
+        print("Loading survival probabilities from " + file_name + ".")
+
+    # Convert a text file written by an older version of MUTE, so that it is read from the binary file from then on
+
+    if file_name.endswith(".txt"):
+
+        survival, depths = _read_survival(file_name)
+
+        if survival is None:
+
+            return no_file(force=force)
+
+        file_name = file_name[: -len(".txt")]
+
+        _save_survival(
+            file_name,
+            survival,
+            depths,
+            {
+                "medium": constants.get_medium(),
+                "density": float(density),
+                "n_muon": constants.get_n_muon(),
+                "backend": backend,
+            },
+        )
+
+        file_name += ".npy"
+
+    # The survival probabilities are kept in memory, so the file is only read again if it changes
+
+    survival, depths = cache.load(file_name, _read_survival, mmap, packed)
+
+    # Check that the file has the correct energies and slant depths
+    # A lab file can be left over from a different vertical depth of the same lab
+
+    if (
+        survival is None
+        or len(depths) != len(tensor_depths)
+        or not np.allclose(depths, tensor_depths, atol=1e-5)
+    ):
+
+        return no_file(force=force)
+
+    if constants.get_verbose() > 1:
+        print("Loaded survival probabilities.")
+
+    # The cached tensor is shared between calls, so a copy is returned unless it is memory-mapped
+
+    survival = cache.writable(survival)
+
+    if return_variances:
+
+        return survival, _calc_survival_variances(
+            survival,
+            _load_n_thrown(density, slant_depths, backend),
+            variance_method,
+            packed=packed,
+        )
+
+    return survival
+
+
+# Compare two survival probability tensors
+
+
+def _compare_survival_tensors(survival, reference, variances):
+
+    """Return the deviations of the survival probability tensor survival from the tensor reference, in the form returned by validate_numpy_backend(). variances are the combined statistical variances of the two tensors, used for the pulls."""
+
+    # Compare the total survival probabilities and the mean underground energies of every bin
+
+    totals = [np.sum(tensor, axis=2) for tensor in (reference, survival)]
+    means = [
+        np.divide(
+            np.sum(tensor * constants.ENERGIES, axis=2),
+            total,
+            out=np.full(total.shape, np.nan),
+            where=total > 0,
+        )
+        for tensor, total in zip((reference, survival), totals)
+    ]
+
+    sigmas = np.sqrt(variances)
+
+    deviations = {
+        "survival_ratios": np.divide(
+            totals[1],
+            totals[0],
+            out=np.full(totals[0].shape, np.nan),
+            where=totals[0] > 0,
+        ),
+        "mean_energy_ratios": means[1] / means[0],
+        "pulls": np.divide(
+            survival - reference,
+            sigmas,
+            out=np.zeros(sigmas.shape),
+            where=sigmas > 0,
+        ),
+    }
+
+    return deviations
+
+
+# Compare the NumPy backend with PROPOSAL
+
+
+def validate_numpy_backend(seed=0, output=None, force=False):
+
+    """
+    Compare the survival probability tensor of the NumPy backend with that of PROPOSAL for the set medium, density, and number of muons.
+
+    The NumPy backend is experimental until this comparison has been run on a PROPOSAL tensor for its energy loss parameters.
+
+    The PROPOSAL tensor is loaded with load_survival_probability_tensor_from_file(), and the NumPy tensor is calculated with calc_survival_probability_tensor(backend="numpy"), which is fast enough to be redone for every comparison.
+
+    Parameters
+    ----------
+    seed : int, optional (default: 0)
+        The random seed for the NumPy backend.
+
+    output : bool, optional (default: taken from constants.get_output())
+        If True, the NumPy survival probability tensor is written to a file.
+
+    force : bool, optional (default: False)
+        If True, force the calculation of a new PROPOSAL survival probability tensor if required.
+
+    Returns
+    -------
+    deviations : dict of NumPy ndarray
+        "survival_ratios" are the ratios of the total survival probabilities of the NumPy backend and PROPOSAL in every surface energy-slant depth bin. "mean_energy_ratios" are the ratios of the mean underground energies of the surviving muons. Both are NaN where PROPOSAL has no survivors. "pulls" are the differences of the survival probabilities in every bin of the tensor divided by their combined statistical uncertainties, and are zero where both uncertainties are zero.
+    """
+
+    survival_proposal, variances_proposal = load_survival_probability_tensor_from_file(
+        force=force, return_variances=True
+    )
+
+    if survival_proposal is None:
+
+        print("NumPy backend not validated.")
+
+        return None
+
+    survival_numpy, variances_numpy = calc_survival_probability_tensor(
+        seed=seed,
+        output=output,
+        force=True,
+        histogram=True,
+        return_variances=True,
+        backend="numpy",
+    )
+
+    deviations = _compare_survival_tensors(
+        survival_numpy, survival_proposal, variances_proposal + variances_numpy
+    )
+
+    if constants.get_verbose() >= 1:
+        print(
+            "Median deviation of the total survival probabilities: {0:.3f}. Median deviation of the mean underground energies: {1:.3f}.".format(
+                np.nanmedian(np.abs(deviations["survival_ratios"] - 1)),
+                np.nanmedian(np.abs(deviations["mean_energy_ratios"] - 1)),
+            )
+        )
+
+    return deviations
+
+
+# Compose survival probability tensors from the transfer matrices of thin slabs
+# Muon transport through a homogeneous medium only depends on the current energy of the muon, so the survival probabilities to X_1 + X_2 are the matrix product of those to X_1 and through X_2 on the grid of constants.E_BINS
+
+
+def _calc_sub_bins(sub_bins):
+
+    """Return the bin edges in [MeV] of the grid that splits every bin of constants.E_BINS into sub_bins bins of equal logarithmic width."""
+
+    return np.exp(
+        np.interp(
+            np.arange((len(constants.E_BINS) - 1) * sub_bins + 1) / sub_bins,
+            np.arange(len(constants.E_BINS)),
+            np.log(constants.E_BINS),
+        )
+    )
+
+
+def _calc_critical_energy(u_energies_x, n_muon):
+
+    """Return the critical energy a / b in [MeV] of the mean energy loss a + b * E in a slab, fitted to the underground energies u_energies_x of n_muon muons propagated through it."""
+
+    # For constant a and b, the mean final energy is alpha * E_0 - beta, with alpha = exp(-b * X) and beta = a / b * (1 - alpha)
+    # The fraction of energy lost, (1 - alpha) + beta / E_0, is fitted in 1 / E_0, using only the surface energies at which nearly every muon survives, as the mean energy of the survivors is biased otherwise
+
+    e_0 = constants.ENERGIES + constants.MU_MASS
+
+    survivors = np.array([len(u_energies_ix) for u_energies_ix in u_energies_x])
+    rows = survivors >= 0.99 * n_muon
+
+    if np.sum(rows) < 2:
+
+        raise ValueError(
+            "Too few muons survive the slab to fit its energy losses. Use a thinner slab."
+        )
+
+    fraction_lost = np.array(
+        [
+            1 - np.mean(u_energies_x[i]) / e_0[i]
+            for i in range(len(constants.ENERGIES))
+            if rows[i]
+        ]
+    )
+
+    beta, one_minus_alpha = np.polyfit(1 / e_0[rows], fraction_lost, 1)
+
+    return beta / one_minus_alpha
+
+
+def _calc_slab_matrix(
+    u_energies_x, n_muon, sub_bins=1, spread=False, critical_energy=None
+):
+
+    """Return the transfer matrix of a slab from the underground energies u_energies_x of n_muon muons propagated through it, binned on the grid of _calc_sub_bins(sub_bins). If spread is True, every row is averaged over the initial energies in its bin."""
+
+    e_bins = _calc_sub_bins(sub_bins)
+
+    if not spread:
+
+        return (
+            np.array(
+                [
+                    np.histogram(u_energies_x[i], bins=e_bins)[0]
+                    for i in range(len(constants.ENERGIES))
+                ]
+            )
+            / n_muon
+        )
+
+    # Muons that enter a slab from a previous one can have any energy in their bin, and would never lose energy if a muon losing less than a bin width were put back at the bin centre
+    # The final energy of a muon with another initial energy is found by scaling its final energy with continuous losses a + b * E, which conserve (E + a / b) * exp(b * X)
+
+    matrix = np.zeros((len(e_bins) - 1, len(e_bins) - 1))
+
+    if critical_energy is None:
+        critical_energy = _calc_critical_energy(u_energies_x, n_muon)
+
+    # Split the survivors into chunks so that the memory use does not depend on the number of muons
+
+    chunk_size = max(NUMPY_CHUNK_SIZE // len(e_bins), 1)
+
+    for i in range(len(constants.ENERGIES)):
+
+        u_energies_ix = np.asarray(u_energies_x[i], dtype=float)
+
+        for start in range(0, len(u_energies_ix), chunk_size):
+
+            # Find the initial energies that would have ended at every bin edge
+
+            e_0 = (e_bins[np.newaxis, :] + critical_energy) * (
+                constants.ENERGIES[i] + constants.MU_MASS + critical_energy
+            ) / (
+                u_energies_ix[start : start + chunk_size, np.newaxis] + critical_energy
+            ) - critical_energy
+
+            # Keep the parts of every bin of initial energies between them
+
+            for r in range(i * sub_bins, (i + 1) * sub_bins):
+
+                log_e_0 = np.log(np.clip(e_0, e_bins[r], e_bins[r + 1]))
+
+                matrix[r] += np.sum(np.diff(log_e_0, axis=1), axis=0)
+
+    return matrix / np.diff(np.log(e_bins))[:, np.newaxis] / n_muon
+
+
+def compose_survival_probability_tensor(
+    slab_depth=None,
+    seed=0,
+    output=None,
+    force=False,
+    n_workers=1,
+    slant_depths=None,
+    backend="proposal",
+    sub_bins=4,
+):
+
+    """
+    Calculate survival probabilities for the default surface energy grid and slant depths by propagating muons through thin slabs only.
+
+    The muons are propagated directly to the first slant depth, and through one slab of every thickness needed to step from one slant depth to the next. The survival probabilities at the deeper slant depths are then built up by multiplying the transfer matrices of the slabs, see _calc_slab_matrix(). As the slabs are thin and only a few of them are propagated, this needs a small fraction of the propagation of calc_survival_probability_tensor(). The binning of the energies between the slabs makes the result an approximation; see validate_slab_composition() for its accuracy.
+
+    Parameters
+    ----------
+    slab_depth : float, optional (default: None)
+        The thickness in [km.w.e.] of the slab to propagate the muons through. The distances between consecutive slant depths must all be multiples of it, and are stepped over with powers of its transfer matrix. If None, a slab is propagated for every different distance between consecutive slant depths.
+
+    seed : int, optional (default: 0)
+        The random seed for use in the PROPOSAL propagator.
+
+    output : bool, optional (default: taken from constants.get_output())
+        If True, the survival probabilities are written to a file ending in _Survival_Composed_Probabilities, with the slab settings in its metadata. A composed tensor is an approximation, so it is kept apart from the directly propagated tensor of calc_survival_probability_tensor(), and is only loaded by load_survival_probability_tensor_from_file(composed = True).
+
+    force : bool, optional (default: False)
+        If True, this will force the creation of a survival_probabilities directory if one does not already exist.
+
+    n_workers : int, optional (default: 1)
+        The number of processes to propagate the muons with. See propagate_muons().
+
+    slant_depths : array-like, optional (default: None)
+        The slant depths in [km.w.e.] to calculate the survival probabilities for. See calc_survival_probability_tensor(). If None, constants.SLANT_DEPTHS is used.
+
+    backend : {"proposal", "numpy"}, optional (default: "proposal")
+        The propagation engine. See propagate_muons().
+
+    sub_bins : int, optional (default: 4)
+        The number of bins every bin of constants.E_BINS is split into while the muons are stepped through the slabs. Finer bins reduce the spread in energy that the binning adds at every step. See _calc_slab_matrix().
+
+    Returns
+    -------
+    survival : NumPy ndarray
+        A three-dimensional array containing the survival probabilities.
+    """
+
+    # Check values
+
+    if output is None:
+        output = constants.get_output()
+
+    if slant_depths is not None:
+        slant_depths = _get_slant_depths(slant_depths)
+
+    tensor_depths = _get_slant_depths(slant_depths)
+
+    assert np.all(np.diff(tensor_depths) > 0), "slant_depths must be increasing."
+    assert slab_depth is None or slab_depth > 0, "slab_depth must be positive."
+    assert (
+        type(sub_bins) == int and sub_bins > 0
+    ), "sub_bins must be a positive integer."
+
+    # Find the slabs needed to step from one slant depth to the next
+    # The steps are rounded so that equal steps from floating-point grids use the same slab
+
+    steps = np.round(np.diff(tensor_depths), 6)
+
+    if slab_depth is None:
+
+        slabs = np.unique(steps)
+        n_slabs = np.ones(len(steps), dtype=int)
+
+    else:
+
+        slabs = np.round([float(slab_depth)], 6)
+        n_slabs = np.round(steps / slabs[0]).astype(int)
+
+        assert np.all(n_slabs >= 1) and np.allclose(
+            n_slabs * slabs[0], steps, atol=1e-6
+        ), "The distances between the slant depths must be multiples of slab_depth."
+
+    # Propagate the muons to the first slant depth and through every slab at once
+
+    depths = np.unique(np.round(np.concatenate(([tensor_depths[0]], slabs)), 6))
+
+    u_energies = propagate_muons(
+        seed=seed,
+        output=False,
+        force=force,
+        n_workers=n_workers,
+        slant_depths=depths,
+        backend=backend,
+    )
+
+    if constants.get_verbose() >= 1:
+
+        # Compare the estimated costs of the feasible bins of both propagations
+
+        budget = np.sum(
+            (_estimate_bin_costs(depths) * _calc_feasible_bins(depths))
+        ) / np.sum(
+            _estimate_bin_costs(tensor_depths) * _calc_feasible_bins(tensor_depths)
+        )
+
+        print(
+            "Composed the survival probabilities from {0} slab(s), with {1:.1%} of the propagation of the full tensor.".format(
+                len(slabs), budget
+            )
+        )
+
+    n_muon = constants.get_n_muon()
+
+    # Compose the survival probabilities one slant depth at a time
+    # The first slant depth is propagated from the bin centres of the surface energies, like the full tensor
+
+    survival = np.zeros(
+        (len(constants.ENERGIES), len(tensor_depths), len(constants.ENERGIES))
+    )
+
+    # The energies are followed on a finer grid than constants.E_BINS between the slabs, and summed back into constants.E_BINS at every slant depth
+
+    survival_fine = _calc_slab_matrix(
+        u_energies[:, np.searchsorted(depths, np.round(tensor_depths[0], 6))],
+        n_muon,
+        sub_bins,
+    )
+
+    matrices = {
+        slab: _calc_slab_matrix(
+            u_energies[:, np.searchsorted(depths, slab)],
+            n_muon,
+            sub_bins,
+            spread=True,
+        )
+        for slab in slabs
+    }
+
+    for x in range(len(tensor_depths)):
+
+        # Every step is a number of slabs of one thickness
+
+        if x > 0:
+
+            slab = steps[x - 1] if slab_depth is None else slabs[0]
+
+            survival_fine = survival_fine @ np.linalg.matrix_power(
+                matrices[slab], n_slabs[x - 1]
+            )
+
+        survival[:, x] = np.sum(
+            np.reshape(survival_fine, (len(constants.ENERGIES), -1, sub_bins)), axis=2
+        )
+
+    # Write the results to a file
+    # The statistical uncertainties of a composed tensor are not known, so no number of muons thrown is stored with it
+
+    if output:
+
+        _write_survival(
+            survival,
+            None,
+            slant_depths,
+            backend,
+            force=force,
+            composition={
+                "slab_depth": None if slab_depth is None else float(slab_depth),
+                "sub_bins": sub_bins,
+                "seed": seed,
+            },
+        )
+
+    return survival
+
+
+def validate_slab_composition(
+    slab_depth=None, seed=0, n_workers=1, force=False, backend="proposal", sub_bins=4
+):
+
+    """
+    Compare the survival probability tensor composed from thin slabs with compose_survival_probability_tensor() with the directly propagated survival probability tensor for the set medium, density, and number of muons.
+
+    The direct tensor is loaded with load_survival_probability_tensor_from_file(), and the composed tensor is calculated without being written to a file.
+
+    Parameters
+    ----------
+    slab_depth : float, optional (default: None)
+        The thickness in [km.w.e.] of the slab. See compose_survival_probability_tensor().
+
+    seed : int, optional (default: 0)
+        The random seed for the propagation of the slabs.
+
+    n_workers : int, optional (default: 1)
+        The number of processes to propagate the slabs with.
+
+    force : bool, optional (default: False)
+        If True, force the calculation of a new direct survival probability tensor if required.
+
+    backend : {"proposal", "numpy"}, optional (default: "proposal")
+        The propagation engine of both tensors.
+
+    sub_bins : int, optional (default: 4)
+        The number of bins every energy bin is split into between the slabs. See compose_survival_probability_tensor().
+
+    Returns
+    -------
+    deviations : dict of NumPy ndarray
+        The deviations of the composed tensor from the direct tensor, in the form returned by validate_numpy_backend(). The pulls are in units of the statistical uncertainties of the direct tensor only.
+    """
+
+    survival_direct, variances_direct = load_survival_probability_tensor_from_file(
+        force=force, return_variances=True, backend=backend
+    )
+
+    if survival_direct is None:
+
+        print("Slab composition not validated.")
+
+        return None
+
+    survival_composed = compose_survival_probability_tensor(
+        slab_depth=slab_depth,
+        seed=seed,
+        output=False,
+        force=force,
+        n_workers=n_workers,
+        backend=backend,
+        sub_bins=sub_bins,
+    )
+
+    deviations = _compare_survival_tensors(
+        survival_composed, survival_direct, variances_direct
+    )
+
+    if constants.get_verbose() >= 1:
+        print(
+            "Median deviation of the total survival probabilities: {0:.3f}. Median deviation of the mean underground energies: {1:.3f}.".format(
+                np.nanmedian(np.abs(deviations["survival_ratios"] - 1)),
+                np.nanmedian(np.abs(deviations["mean_energy_ratios"] - 1)),
+            )
+        )
+
+    return deviations
+
+
+# Find the slant depths of the survival probability tensor to use for the set lab
+
+
+def get_survival_probability_tensor_slant_depths():
+
+    """
+    Return the slant depths of the survival probability tensor to use for the set lab.
+
+    If a survival probability tensor has been calculated for exactly the slant depths of the set lab with calc_survival_probability_tensor(slant_depths = constants.slant_depths), its slant depths are returned, and the tensor can be used without interpolating in slant depth. Otherwise, constants.SLANT_DEPTHS is returned.
+
+    Returns
+    -------
+    slant_depths : NumPy ndarray
+        The slant depths in [km.w.e.] of the survival probability tensor to use.
+    """
+
+    slant_depths = np.asarray(constants.slant_depths, dtype=float)
+
+    if len(slant_depths) == len(constants.SLANT_DEPTHS) and np.allclose(
+        slant_depths, constants.SLANT_DEPTHS
+    ):
+
+        return constants.SLANT_DEPTHS
+
+    if (
+        store.find(
+            "survival", _survival_parameters(slant_depths), _survival_tolerances()
+        )[0]
+        is not None
+    ):
+
+        return slant_depths
+
+    file_name, _ = _find_survival_file(slant_depths)
+
+    if not os.path.isfile(file_name):
+
+        return constants.SLANT_DEPTHS
+
+    # The file of a lab can be left over from a different vertical depth, so check the slant depths in it
+
+    depths = _read_survival_slant_depths(file_name)
+
+    if len(depths) == len(slant_depths) and np.allclose(
+        depths, slant_depths, atol=1e-5
+    ):
+
+        return slant_depths
+
+    return constants.SLANT_DEPTHS
+
+
+# Find the density of an existing file within the density tolerance
+
+
+def _find_density(file_name):
+
+    """
+    Return the density to use in a file name for the set medium: the set density, or the closest density of an existing file within the density tolerance if there is no file for the set density.
+
+    Parameters
+    ----------
+    file_name : str
+        The full path and name of the file, with {0} in place of the density.
+
+    Returns
+    -------
+    density : float or str
+        The density to use in the file name, as written in the name of the file.
+    """
+
+    density = constants.get_density()
+
+    if constants.get_density_tolerance() == 0 or os.path.isfile(
+        file_name.format(density)
+    ):
+
+        return density
+
+    # Read the densities from the names of the existing files
+    # Keep the densities as they are written, so that the file names can be reconstructed exactly
+
+    prefix, suffix = file_name.split("{0}")
+
+    candidates = []
+
+    for path in glob.glob(glob.escape(prefix) + "*" + glob.escape(suffix)):
+
+        try:
+
+            candidate = path[len(prefix) : len(path) - len(suffix)]
+
+            if abs(float(candidate) / density - 1) <= constants.get_density_tolerance():
+
+                candidates.append(candidate)
+
+        except ValueError:
+
+            continue
+
+    if len(candidates) == 0:
+
+        return density
+
+    candidate = min(candidates, key=lambda candidate: abs(float(candidate) - density))
+
+    if constants.get_verbose() > 1:
+        print(
+            "Using the file for a density of {0} g/cm^3 instead of {1} g/cm^3.".format(
+                candidate, density
+            )
+        )
+
+    return candidate
+
+
+# Read the energies and slant depths from a survival probabilities file
+
+
+def print_survival_probability_tensor_grids(file_name):
+
+    """Return the slant depths and underground energies in a survival probability file."""
+
+    file_name = os.path.join(
+        constants.get_directory(), "survival_probabilities", file_name
     )
 
-    file_s_energies = np.unique(file_contents[:, 0])
-    file_slant_depths = np.unique(file_contents[:, 1])
-    file_u_energies = np.unique(file_contents[:, 2])
+    # The grids of a binary file are stored in its JSON file
+
+    if file_name.endswith(".npy"):
+
+        with open(file_name[: -len(".npy")] + ".json", "r") as file_in:
+
+            metadata = json.load(file_in)
+
+        file_s_energies = np.array(metadata["energies"])
+        file_slant_depths = np.array(metadata["slant_depths"])
+        file_u_energies = np.array(metadata["energies"])
+
+    else:
+
+        file_contents = np.loadtxt(file_name)
+
+        file_s_energies = np.unique(file_contents[:, 0])
+        file_slant_depths = np.unique(file_contents[:, 1])
+        file_u_energies = np.unique(file_contents[:, 2])
 
     print("This file has " + str(len(file_s_energies)) + " surface energies:")
     print(file_s_energies)
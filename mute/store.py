@@ -0,0 +1,507 @@
+##########################
+##########################
+###                    ###
+###  MUTE              ###
+###  William Woodley   ###
+###  19 December 2021  ###
+###                    ###
+##########################
+##########################
+
+# Import packages
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+# importlib.metadata was added in Python 3.8, so setuptools is used on earlier versions
+
+try:
+
+    from importlib import metadata
+
+except ImportError:
+
+    import pkg_resources
+
+    metadata = None
+
+import numpy as np
+
+import mute.cache as cache
+import mute.constants as constants
+
+# Every product is stored in a directory named after its key, together with a manifest that describes it
+# Every product has its own manifest, so processes that put products into the store at the same time, such as the jobs of a cluster, never write the same file
+# Files are written under a unique temporary name and then renamed, so other processes only ever see complete files
+
+MANIFEST = "manifest.json"
+
+# Get the store directory
+
+
+def _store_directory():
+
+    """Return the directory of the artefact store."""
+
+    return os.path.join(constants.get_directory(), "store")
+
+
+def _product_directory(key):
+
+    """Return the directory of the product with key key."""
+
+    return os.path.join(_store_directory(), key)
+
+
+# Describe the inputs of a product
+
+
+def digest(array):
+
+    """
+    Return a short hash of the contents of an array.
+
+    Large inputs, such as energy grids or lists of bins, are entered into the parameters of a product by their digest, so that the manifest stays small.
+
+    Parameters
+    ----------
+    array : array-like
+        The array to hash.
+
+    Returns
+    -------
+    digest : str
+        The first 16 characters of the SHA-256 hash of the array, including its data type and shape.
+    """
+
+    array = np.ascontiguousarray(array)
+
+    sha = hashlib.sha256()
+    sha.update(str((array.dtype.str, array.shape)).encode())
+    sha.update(array.tobytes())
+
+    return sha.hexdigest()[:16]
+
+
+def get_version(package):
+
+    """Return the installed version of a package, or None if it is not installed."""
+
+    if metadata is None:
+
+        try:
+
+            return pkg_resources.get_distribution(package).version
+
+        except pkg_resources.DistributionNotFound:
+
+            return None
+
+    try:
+
+        return metadata.version(package)
+
+    except metadata.PackageNotFoundError:
+
+        return None
+
+
+def get_key(kind, parameters):
+
+    """
+    Return the key of a product in the store.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of product, for example "s_fluxes" or "survival".
+
+    parameters : dict
+        Every input the product depends on. The values must be serialisable to JSON.
+
+    Returns
+    -------
+    key : str
+        The SHA-256 hash of the kind and the parameters.
+    """
+
+    canonical = json.dumps(
+        {"kind": kind, "parameters": parameters}, sort_keys=True, default=str
+    )
+
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+# Read and write the manifests
+
+
+def _write_file(file_name, write):
+
+    """Write the file file_name with write(file), under a unique temporary name first, and then replace file_name with it in one step."""
+
+    descriptor, temporary = tempfile.mkstemp(
+        suffix=".tmp", dir=os.path.dirname(file_name)
+    )
+
+    try:
+
+        with os.fdopen(descriptor, "wb") as file:
+
+            write(file)
+
+        os.replace(temporary, file_name)
+
+    except BaseException:
+
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+        raise
+
+
+def _read_entry(key):
+
+    """Return the manifest of the product with key key, or None if it is not in the store."""
+
+    try:
+
+        with open(os.path.join(_product_directory(key), MANIFEST)) as file:
+
+            return json.load(file)
+
+    except (OSError, ValueError):
+
+        return None
+
+
+def _write_entry(key, entry):
+
+    """Write the manifest entry of the product with key key."""
+
+    _write_file(
+        os.path.join(_product_directory(key), MANIFEST),
+        lambda file: file.write(json.dumps(entry, indent=1, default=str).encode()),
+    )
+
+
+def _read_manifest():
+
+    """Return the manifests of all of the products in the store, keyed by their keys. The directories of products that are being removed start with a dot, and are left out."""
+
+    if not os.path.isdir(_store_directory()):
+
+        return {}
+
+    manifest = {}
+
+    for key in os.listdir(_store_directory()):
+
+        if key.startswith("."):
+
+            continue
+
+        entry = _read_entry(key)
+
+        if entry is not None:
+            manifest[key] = entry
+
+    return manifest
+
+
+# Put products into the store
+
+
+def put(kind, parameters, arrays):
+
+    """
+    Put a product into the store.
+
+    The arrays are written to a directory named after the key of the product, together with a manifest that lists the kind, parameters, files, size, and creation and access times of the product. A product with the same key is replaced. If the store is then larger than the size set by constants.set_store_size(), the least recently used products are deleted until it fits again.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of product.
+
+    parameters : dict
+        Every input the product depends on.
+
+    arrays : dict
+        The arrays that make up the product, keyed by name.
+
+    Returns
+    -------
+    key : str
+        The key of the product.
+    """
+
+    key = get_key(kind, parameters)
+    directory = _product_directory(key)
+
+    os.makedirs(directory, exist_ok=True)
+
+    # The files are replaced in one step, as other processes can have them memory-mapped
+    # The manifest is written last, so a product is only found once all of its files are complete
+
+    files = []
+
+    for name, array in arrays.items():
+
+        _write_file(
+            os.path.join(directory, name + ".npy"),
+            lambda file: np.save(file, np.asarray(array)),
+        )
+        files.append(name + ".npy")
+
+    now = time.time()
+
+    _write_entry(
+        key,
+        {
+            "kind": kind,
+            "parameters": parameters,
+            "files": files,
+            "size": sum(os.path.getsize(os.path.join(directory, f)) for f in files),
+            "created": now,
+            "accessed": now,
+        },
+    )
+
+    if constants.get_verbose() > 1:
+        print("Stored {0} product {1}.".format(kind, key[:16]))
+
+    _evict(keep=key)
+
+    return key
+
+
+def _remove(key):
+
+    """Remove the product with key key from the store. Its directory is renamed first, so other processes never find a product with missing files. On POSIX systems, processes that already have its files open or memory-mapped can still read them. Return False if another process has already removed the product."""
+
+    removed = os.path.join(_store_directory(), ".{0}.{1}".format(key, uuid.uuid4().hex))
+
+    try:
+
+        os.rename(_product_directory(key), removed)
+
+    except OSError:
+
+        return False
+
+    shutil.rmtree(removed, ignore_errors=True)
+
+    return True
+
+
+def _evict(keep=None):
+
+    """Delete the least recently used products, other than the product with key keep, until the store fits in the set store size."""
+
+    manifest = _read_manifest()
+
+    budget = constants.get_store_size() * 1e9  # [bytes]
+    total = sum(entry["size"] for entry in manifest.values())
+
+    for key in sorted(manifest, key=lambda k: manifest[k]["accessed"]):
+
+        if total <= budget:
+
+            break
+
+        if key == keep:
+
+            continue
+
+        if _remove(key) and constants.get_verbose() > 1:
+            print("Evicted {0} from the store.".format(key[:16]))
+
+        total -= manifest[key]["size"]
+
+
+# Get products from the store
+
+
+def _load_array(file_name, mmap):
+
+    """Return the array in the .npy file file_name, memory-mapped read-only if mmap is True."""
+
+    return np.load(file_name, mmap_mode="r" if mmap else None)
+
+
+def _matches(parameters, stored, tolerances):
+
+    """Return the largest relative difference between the toleranced parameters, or None if the parameters do not match."""
+
+    if parameters.keys() != stored.keys():
+
+        return None
+
+    deviation = 0
+
+    for name, value in parameters.items():
+
+        if name in tolerances:
+
+            difference = abs(stored[name] - value) / value
+
+            if difference > tolerances[name]:
+
+                return None
+
+            deviation = max(deviation, difference)
+
+        elif json.dumps(stored[name], sort_keys=True, default=str) != json.dumps(
+            value, sort_keys=True, default=str
+        ):
+
+            return None
+
+    return deviation
+
+
+def _find(kind, parameters, tolerances=None):
+
+    """Return the key and the manifest of the product that find() finds, or None, None."""
+
+    key = get_key(kind, parameters)
+    entry = _read_entry(key)
+
+    if entry is not None:
+
+        return key, entry
+
+    if not tolerances:
+
+        return None, None
+
+    # Normalise the parameters the same way the manifests store them
+
+    parameters = json.loads(json.dumps(parameters, default=str))
+
+    best = (None, None)
+    smallest = None
+
+    for stored_key, entry in _read_manifest().items():
+
+        if entry["kind"] != kind:
+
+            continue
+
+        deviation = _matches(parameters, entry["parameters"], tolerances)
+
+        if deviation is not None and (smallest is None or deviation < smallest):
+
+            best = (stored_key, entry)
+            smallest = deviation
+
+    return best
+
+
+def find(kind, parameters, tolerances=None):
+
+    """
+    Find a product in the store.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of product.
+
+    parameters : dict
+        Every input the product depends on.
+
+    tolerances : dict, optional (default: None)
+        Largest relative differences for numerical parameters, keyed by parameter name. If given, and no product matches the parameters exactly, the product closest to them within the tolerances is returned.
+
+    Returns
+    -------
+    key : str or None
+        The key of the product, or None if there is none in the store.
+
+    parameters : dict or None
+        The parameters of the product found.
+    """
+
+    key, entry = _find(kind, parameters, tolerances)
+
+    if key is None:
+
+        return None, None
+
+    return key, entry["parameters"]
+
+
+def get(kind, parameters, tolerances=None, mmap=False):
+
+    """
+    Get a product from the store.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of product.
+
+    parameters : dict
+        Every input the product depends on.
+
+    tolerances : dict, optional (default: None)
+        Largest relative differences for numerical parameters, keyed by parameter name, as in find().
+
+    mmap : bool, optional (default: False)
+        If True, memory-map the arrays instead of reading them into memory.
+
+    Returns
+    -------
+    arrays : dict or None
+        The arrays that make up the product, keyed by name, or None if the product is not in the store. The parameters of the product are under the key "parameters".
+    """
+
+    key, entry = _find(kind, parameters, tolerances)
+
+    if key is None:
+
+        return None
+
+    directory = _product_directory(key)
+
+    try:
+
+        arrays = {
+            os.path.splitext(f)[0]: cache.load(
+                os.path.join(directory, f), _load_array, mmap
+            )
+            for f in entry["files"]
+        }
+
+    except (OSError, ValueError):
+
+        # The product has been removed by another process since it was found, or its files are damaged, in which case it is removed
+
+        if os.path.isdir(directory):
+            _remove(key)
+
+        return None
+
+    # Rewriting the manifest would dominate repeated loads of small products, so the access time is refreshed at most once a minute, which is enough to order the products for eviction
+
+    if time.time() - entry["accessed"] > 60:
+
+        entry["accessed"] = time.time()
+
+        try:
+
+            _write_entry(key, entry)
+
+        except OSError:
+
+            pass
+
+    arrays["parameters"] = entry["parameters"]
+
+    return arrays
@@ -15,7 +15,37 @@ import os
 import numpy as np
 from tqdm import tqdm
 
+import mute.cache as cache
 import mute.constants as constants
+import mute.store as store
+
+# Describe the inputs of a surface fluxes matrix
+
+
+def _s_fluxes_parameters(
+    location, month, interaction_model, primary_model, atmosphere, angles
+):
+
+    """Return every input that a surface fluxes matrix depends on, to key it in the artefact store."""
+
+    if isinstance(primary_model, tuple):
+
+        primary_model = "{0}.{1}({2})".format(
+            primary_model[0].__module__, primary_model[0].__name__, primary_model[1]
+        )
+
+    return {
+        "location": location,
+        "month": month,
+        "interaction_model": interaction_model,
+        "primary_model": primary_model,
+        "atmosphere": atmosphere,
+        "energy_grid": store.digest(constants.E_BINS),
+        "angles": [float(angle) for angle in angles],
+        "mceq": store.get_version("MCEq"),
+        "crflux": store.get_version("crflux"),
+    }
+
 
 # Calculate surface fluxes
 
@@ -229,9 +259,35 @@ def calc_s_fluxes(
         if constants.get_verbose() > 1:
             print("Surface fluxes written to " + file_name + ".")
 
+        store.put(
+            "s_fluxes",
+            _s_fluxes_parameters(
+                location, month, interaction_model, primary_model, atmosphere, angles
+            ),
+            {"s_fluxes": s_fluxes},
+        )
+
     return s_fluxes
 
 
+# Read a surface fluxes file
+
+
+def _read_s_fluxes(file_name, n_angles):
+
+    """Return the surface fluxes matrix in the file file_name for n_angles zenith angles, or None if the file does not have the correct number of energies and zenith angles."""
+
+    with open(file_name, "r") as file:
+
+        lines = file.read().splitlines()
+
+    if len(lines) != len(constants.ENERGIES) * n_angles:
+
+        return None
+
+    return np.reshape(np.loadtxt(lines)[:, 2], (len(constants.ENERGIES), n_angles))
+
+
 # Get surface fluxes
 
 
@@ -326,7 +382,23 @@ def load_s_fluxes_from_file(
 
             return None
 
-    # Construct the file name based on the user's inputs
+    # Look for surface fluxes calculated with exactly these inputs in the store first
+
+    stored = store.get(
+        "s_fluxes",
+        _s_fluxes_parameters(
+            location, month, interaction_model, primary_model, atmosphere, angles
+        ),
+    )
+
+    if stored is not None:
+
+        if constants.get_verbose() > 1:
+            print("Loaded surface fluxes from the store.")
+
+        return cache.writable(stored["s_fluxes"])
+
+    # Otherwise, construct the file name based on the user's inputs
 
     if month is None:
 
@@ -364,34 +436,23 @@ def load_s_fluxes_from_file(
             )
 
         # If the file exists, read the fluxes in from it
+        # The fluxes are kept in memory, so the file is only read again if it changes
 
-        file = open(file_name, "r")
-        n_lines = len(file.read().splitlines())
-
-        file.close()
+        s_fluxes = cache.load(file_name, _read_s_fluxes, len(angles))
 
         # Check that the file has the correct number of energies and zenith angles
 
-        if n_lines == len(constants.ENERGIES) * len(angles):
-
-            s_fluxes = np.reshape(
-                np.loadtxt(file_name)[:, 2],
-                (len(constants.ENERGIES), len(angles)),
-            )
-
-            if constants.get_verbose() > 1:
+        if s_fluxes is None:
 
-                print("Loaded surface fluxes.")
+            return no_file(force=force)
 
-            return s_fluxes
+        if constants.get_verbose() > 1:
 
-        else:
+            print("Loaded surface fluxes.")
 
-            print(n_lines)
-            print(len(constants.ENERGIES))
-            print(len(angles))
+        # The cached fluxes are shared between calls, so a copy is returned
 
-            return no_file(force=force)
+        return cache.writable(s_fluxes)
 
     else:
 
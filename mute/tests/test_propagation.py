@@ -1,10 +1,18 @@
+import json
+import os
 import pytest
 import sys
+import time
+import types
 
 import numpy as np
 
+import mute.cache as cache
 import mute.constants as mtc
 import mute.propagation as mtp
+import mute.store as store
+import mute.surface as mts
+import mute.underground as mtu
 
 try:
 
@@ -24,9 +32,1295 @@ def test_propagation():
     mtp._create_propagator(force=True)
     pp.RandomGenerator.get().set_seed(500)
 
-    u_energy_calc = mtp._propagation_loop(
-        mtc.energies[50], mtc.slant_depths[0], force=True
-    )
+    u_energy_calc = mtp._propagation_loop(mtc.energies[50], mtc.slant_depths[0])
+
+    # All three muons keep most of their energy, so they reach the full distance and pass the check in _has_survived()
+
     u_energy_read = [6935594.383751289, 4372686.094864153, 7017531.178970211]
 
     assert np.allclose(u_energy_calc, u_energy_read)
+
+
+def test_create_propagator(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path / "data"))
+    monkeypatch.delitem(sys.modules, "proposal", raising=False)
+
+    mtc.set_verbose(0)
+
+    # Without PROPOSAL, no interpolation table directory is created
+
+    with pytest.raises(ImportError):
+        mtp._create_propagator(force=True)
+
+    assert not os.path.exists(tmp_path / "data" / "interpolation_tables")
+
+    mtc.clear()
+
+
+def test_propagation_numpy():
+
+    mtc.clear()
+
+    mtc.set_n_muon(2000)
+
+    slant_depths = mtc.SLANT_DEPTHS[:3]
+
+    u_counts = mtp._propagation_loop_numpy(
+        1e6, slant_depths, np.random.default_rng(0), histogram=True
+    )
+    u_energies = mtp._propagation_loop_numpy(
+        1e6, slant_depths, np.random.default_rng(0)
+    )
+
+    assert u_counts.shape == (len(slant_depths), len(mtc.ENERGIES))
+    assert np.array_equal(
+        u_counts, mtp._calc_u_counts(np.array([u_energies], dtype=object))[0]
+    )
+    assert 0 < np.sum(u_counts[-1]) <= np.sum(u_counts[0]) <= 2000
+    assert np.all(np.concatenate(u_energies) <= 1e6 + mtc.MU_MASS)
+
+
+def test_multi_depth_numpy():
+
+    mtc.clear()
+
+    n_muon = 4000
+    i = np.argmin(np.abs(mtc.ENERGIES - 3e6))
+    xs = [0, 1, 2]
+    slant_depths = [1, 2, 3]
+
+    # Every muon of a multi-depth task is propagated once through all slant depths, from the seed of its surface energy
+
+    multi_depth = mtp._propagate_task(
+        (i, xs, 0, True, True, slant_depths, None, [n_muon] * 3, "numpy")
+    )
+    per_depth = mtp._propagate_task(
+        (i, xs, 0, True, False, slant_depths, None, [n_muon] * 3, "numpy")
+    )
+
+    u_counts_i = mtp._propagation_loop_numpy(
+        mtc.ENERGIES[i],
+        slant_depths,
+        np.random.default_rng(mtp._bin_seed(0, i)),
+        histogram=True,
+        n_muon=n_muon,
+    )
+
+    # The tracks do not share the random numbers of any single bin
+
+    assert mtp._bin_seed(0, i) not in [mtp._bin_seed(0, i, x) for x in xs]
+
+    for k, x in enumerate(xs):
+
+        assert multi_depth[k][:2] == per_depth[k][:2] == (i, x)
+        assert multi_depth[k][3] == per_depth[k][3] == n_muon
+        assert np.array_equal(multi_depth[k][2], u_counts_i[k])
+
+        # The survival probabilities agree with those of separate bins within their statistical errors
+
+        survival = np.array([multi_depth[k][2], per_depth[k][2]]) / n_muon
+        mean = np.mean(survival, axis=0)
+
+        assert 0 < np.sum(mean) < 1
+        assert np.all(
+            np.abs(survival[0] - survival[1])
+            <= 5 * np.sqrt(2 * mean * (1 - mean) / n_muon) + 1 / n_muon
+        )
+        assert np.abs(np.sum(survival[0]) - np.sum(survival[1])) <= 5 * np.sqrt(
+            2 * np.sum(mean) * (1 - np.sum(mean)) / n_muon
+        )
+
+    mtc.clear()
+
+
+def test_u_energy_histogram():
+
+    mtc.clear()
+
+    u_energies = np.zeros((len(mtc.ENERGIES), len(mtc.SLANT_DEPTHS)), dtype=object)
+
+    for i in np.ndindex(u_energies.shape):
+        u_energies[i] = list(np.random.default_rng(i).uniform(50, 1e11, 20))
+
+    u_energies[0, 0] += [mtc.E_BINS[0], mtc.E_BINS[-1]]
+
+    u_counts_calc = np.zeros(
+        (len(mtc.ENERGIES), len(mtc.SLANT_DEPTHS), len(mtc.ENERGIES)), dtype=np.int64
+    )
+
+    for i, x in np.ndindex(u_energies.shape):
+
+        for u_energy in u_energies[i, x]:
+
+            u = mtp._u_energy_bin(u_energy)
+
+            if u is not None:
+                u_counts_calc[i, x, u] += 1
+
+    u_counts_read = mtp._calc_u_counts(u_energies)
+
+    assert np.array_equal(u_counts_calc, u_counts_read)
+
+
+def test_u_energies_file(tmp_path):
+
+    mtc.clear()
+
+    u_energies = np.zeros((len(mtc.ENERGIES), len(mtc.SLANT_DEPTHS)), dtype=object)
+
+    for i in np.ndindex(u_energies.shape):
+        u_energies[i] = list(np.random.default_rng(i).uniform(200, 1e10, i[0] % 4))
+
+    file_name = str(tmp_path / "Underground_Energies_0")
+
+    np.save(file_name + ".npy", u_energies)
+
+    for dtype, rtol in [("pickled", 0), ("float64", 0), ("uint16", 4e-4)]:
+
+        if dtype != "pickled":
+            mtp._write_u_energies(file_name, u_energies, dtype=dtype)
+
+        values, offsets, metadata = mtp._read_u_energies(file_name)
+
+        for i, x in np.ndindex(u_energies.shape):
+
+            assert np.allclose(
+                mtp._u_energies_bin(values, offsets, metadata, i, x),
+                u_energies[i, x],
+                rtol=rtol,
+                atol=0,
+            )
+
+    mtp._write_u_energies(file_name, u_energies)
+
+    assert np.all(
+        mtp._histogram_u_energies_file(file_name, chunk_size=5)
+        == mtp._calc_u_counts(u_energies)
+    )
+
+
+def test_load_u_energies(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+
+    mtc.set_verbose(0)
+
+    os.makedirs(tmp_path / "underground_energies")
+
+    file_name = str(tmp_path / "underground_energies" / "Underground_Energies")
+
+    # Write alternating ragged and legacy pickled files
+
+    u_counts = []
+
+    for a in range(6):
+
+        u_energies = np.zeros((len(mtc.ENERGIES), len(mtc.SLANT_DEPTHS)), dtype=object)
+
+        for i in np.ndindex(u_energies.shape):
+            u_energies[i] = list(
+                np.random.default_rng((a,) + i).uniform(200, 1e10, (i[0] + a) % 4)
+            )
+
+        if a % 2 == 0:
+            mtp._write_u_energies(file_name + "_" + str(a), u_energies)
+
+        else:
+            np.save(file_name + "_" + str(a) + ".npy", u_energies)
+
+        u_counts.append(mtp._calc_u_counts(u_energies))
+
+    # The threaded loader matches the single-threaded one and the per-file histograms
+
+    for n_threads in [1, 4]:
+
+        assert np.array_equal(
+            mtp._load_u_energies_from_files(file_name, n_job=6, n_threads=n_threads),
+            np.sum(u_counts, axis=0),
+        )
+
+    # The files are returned in order, even if they finish out of order
+
+    file_names = [file_name + "_" + str(a) for a in range(6)]
+
+    for u_counts_a, u_counts_b in zip(
+        mtp._map_files(mtp._histogram_u_energies_file, file_names, 4), u_counts
+    ):
+
+        assert np.array_equal(u_counts_a, u_counts_b)
+
+    def sleep(x):
+
+        time.sleep(0.01 * (10 - x))
+
+        return x
+
+    assert list(mtp._map_files(sleep, range(10), 3)) == list(range(10))
+
+    mtc.clear()
+
+
+def test_survival_file(tmp_path):
+
+    mtc.clear()
+
+    slant_depths = [1, 1.5, 2]
+
+    survival = np.random.default_rng(0).uniform(
+        0, 1, (len(mtc.ENERGIES), len(slant_depths), len(mtc.ENERGIES))
+    )
+
+    file_name = str(tmp_path / "Survival_Probabilities")
+
+    mtp._save_survival(file_name, survival, slant_depths, {})
+
+    survival_read, depths_read = mtp._read_survival(file_name + ".npy")
+
+    assert np.array_equal(survival_read, survival)
+    assert np.array_equal(depths_read, slant_depths)
+    assert np.array_equal(
+        mtp._read_survival_slant_depths(file_name + ".npy"), slant_depths
+    )
+
+    survival_mmap, _ = mtp._read_survival(file_name + ".npy", mmap=True)
+
+    assert isinstance(survival_mmap, np.memmap) and not survival_mmap.flags.writeable
+    assert np.array_equal(survival_mmap[:, 1], survival[:, 1])
+
+    # Text files written by older versions of MUTE
+
+    with open(file_name + ".txt", "w") as file_out:
+
+        for i, x, u in np.ndindex(survival.shape):
+
+            file_out.write(
+                "{0:1.14f} {1:1.5f} {2:1.14f} {3:1.14e}\n".format(
+                    mtc.ENERGIES[i], slant_depths[x], mtc.ENERGIES[u], survival[i, x, u]
+                )
+            )
+
+    survival_read, depths_read = mtp._read_survival(file_name + ".txt")
+
+    assert np.allclose(survival_read, survival, rtol=1e-13)
+    assert np.array_equal(depths_read, slant_depths)
+
+
+def test_pack_survival(tmp_path):
+
+    mtc.clear()
+
+    survival = np.random.default_rng(0).uniform(
+        0, 1, (len(mtc.ENERGIES), 3, len(mtc.ENERGIES))
+    )
+
+    with pytest.raises(ValueError):
+        mtp._pack_survival(survival)
+
+    survival *= np.tril(np.ones((len(mtc.ENERGIES), len(mtc.ENERGIES))))[
+        :, np.newaxis, :
+    ]
+
+    packed = mtp._pack_survival(survival)
+
+    assert packed.shape == (3, len(mtc.ENERGIES) * (len(mtc.ENERGIES) + 1) // 2)
+    assert np.array_equal(mtp._unpack_survival(packed), survival)
+
+    # Lower-triangular tensors are stored packed
+
+    file_name = str(tmp_path / "Survival_Probabilities")
+
+    mtp._save_survival(file_name, survival, [1, 1.5, 2], {})
+
+    assert np.load(file_name + ".npy").shape == packed.shape
+    assert np.array_equal(mtp._read_survival(file_name + ".npy")[0], survival)
+    assert np.array_equal(
+        mtp._read_survival(file_name + ".npy", mmap=True, packed=True)[0], packed
+    )
+
+    n_thrown = np.random.default_rng(1).integers(1, 100, (len(mtc.ENERGIES), 3))
+
+    assert np.allclose(
+        mtp._calc_survival_variances(packed, n_thrown, packed=True),
+        mtp._pack_survival(mtp._calc_survival_variances(survival, n_thrown)),
+    )
+
+
+def test_store(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+    mtc.set_verbose(0)
+
+    survival = (
+        np.random.default_rng(0).uniform(
+            0, 1, (len(mtc.ENERGIES), len(mtc.SLANT_DEPTHS), len(mtc.ENERGIES))
+        )
+        * np.tril(np.ones((len(mtc.ENERGIES), len(mtc.ENERGIES))))[:, np.newaxis, :]
+    )
+    n_thrown = np.full(survival.shape[:2], mtc.get_n_muon())
+
+    mtp._write_survival(survival, n_thrown, backend="numpy", force=True)
+
+    # The tensor is loaded from the store, and only for the same inputs
+
+    assert np.array_equal(
+        mtp.load_survival_probability_tensor_from_file(backend="numpy"), survival
+    )
+    assert mtp._find_stored_survival(backend="proposal")[0] is None
+
+    mtc.set_density(2.66)
+
+    assert mtp._find_stored_survival(backend="numpy")[0] is None
+
+    mtc.set_density_tolerance(0.01)
+
+    assert mtp._find_stored_survival(backend="numpy")[0] is not None
+
+    # The least recently used products are evicted once the store is full
+
+    mtc.set_store_size(1e-6)
+
+    store.put("test", {"n": 1}, {"values": np.zeros(10)})
+
+    assert mtp._find_stored_survival(backend="numpy")[0] is None
+    assert np.array_equal(store.get("test", {"n": 1})["values"], np.zeros(10))
+    assert store.get("test", {"n": 2}) is None
+
+    # Processes that put products into the store at the same time do not lose each other's products
+
+    import multiprocessing
+
+    mtc.set_store_size(10)
+
+    with multiprocessing.Pool(4) as pool:
+        pool.map(_put_product, range(16))
+
+    for n in range(16):
+        assert store.get("test", {"n": n})["values"][0] == n
+
+    mtc.clear()
+
+
+def _put_product(n):
+
+    store.put("test", {"n": n}, {"values": np.full(10, n)})
+
+
+def test_cache(tmp_path):
+
+    mtc.clear()
+
+    survival = np.random.default_rng(0).uniform(
+        0, 1, (len(mtc.ENERGIES), 3, len(mtc.ENERGIES))
+    )
+
+    file_name = str(tmp_path / "Survival_Probabilities")
+
+    mtp._save_survival(file_name, survival, [1, 1.5, 2], {})
+
+    # A file is only read again once it changes
+
+    survival_read, _ = cache.load(file_name + ".npy", mtp._read_survival)
+
+    assert np.array_equal(survival_read, survival)
+    assert cache.load(file_name + ".npy", mtp._read_survival)[0] is survival_read
+    assert not survival_read.flags.writeable
+
+    # The arrays returned to the user are copies, unless they are memory-mapped
+
+    assert cache.writable(survival_read).flags.writeable
+
+    survival_mmap, _ = cache.load(file_name + ".npy", mtp._read_survival, True)
+
+    assert cache.writable(survival_mmap) is survival_mmap
+
+    mtp._save_survival(file_name, 2 * survival[:, :2], [1, 1.5], {})
+
+    assert np.array_equal(
+        cache.load(file_name + ".npy", mtp._read_survival)[0], 2 * survival[:, :2]
+    )
+    assert len(cache._cache) == 1
+
+    mtc.clear()
+
+    assert len(cache._cache) == 0
+
+
+def test_survival_variances():
+
+    mtc.clear()
+
+    u_counts = np.random.default_rng(0).integers(
+        0, 100, (len(mtc.ENERGIES), len(mtc.SLANT_DEPTHS), len(mtc.ENERGIES))
+    )
+    n_thrown = np.full((len(mtc.ENERGIES), len(mtc.SLANT_DEPTHS)), 100)
+    n_thrown[0, 0] = 0
+
+    survival = mtp._calc_survival(u_counts, n_thrown)
+
+    binomial = mtp._calc_survival_variances(survival, n_thrown, "binomial")
+    poisson = mtp._calc_survival_variances(survival, n_thrown, "poisson")
+
+    assert np.allclose(binomial[1:], survival[1:] * (1 - survival[1:]) / 100)
+    assert np.allclose(poisson[1:], u_counts[1:] / 100 ** 2)
+    assert np.all(binomial[0, 0] == 0) and np.all(poisson[0, 0] == 0)
+
+
+def test_u_variances(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+
+    mtc.set_verbose(0)
+
+    monkeypatch.setattr(
+        mts,
+        "load_s_fluxes_from_file",
+        lambda *args, **kwargs: np.outer(
+            mtc.ENERGIES ** -3.7, 1 + np.cos(np.radians(mtc.ANGLES_FOR_S_FLUXES))
+        ),
+    )
+
+    # Fill a few bins of the tensor with a survival probability of 0.3 from 100 muons
+
+    rng = np.random.default_rng(0)
+    shape = (len(mtc.ENERGIES), len(mtc.SLANT_DEPTHS), len(mtc.ENERGIES))
+
+    bins = []
+
+    for _ in range(5):
+
+        i = rng.integers(30, shape[0])
+        bins.append((i, rng.integers(0, shape[1]), rng.integers(0, i + 1)))
+
+    def load_survival(
+        survival, return_variances=False, variance_method="binomial", packed=False
+    ):
+
+        variances = mtp._calc_survival_variances(
+            survival, np.full(shape[:2], 100), variance_method
+        )
+
+        if packed:
+            survival = mtp._pack_survival(survival)
+            variances = mtp._pack_survival(variances)
+
+        return (survival, variances) if return_variances else survival
+
+    def calc(survival, variance_method="binomial"):
+
+        monkeypatch.setattr(
+            mtp,
+            "load_survival_probability_tensor_from_file",
+            lambda **kwargs: load_survival(
+                survival,
+                kwargs["return_variances"],
+                kwargs["variance_method"],
+                kwargs["packed"],
+            ),
+        )
+
+        kwargs = {
+            "force": True,
+            "return_variances": True,
+            "variance_method": variance_method,
+        }
+
+        u_fluxes = mtu.calc_u_fluxes(output=False, **kwargs)
+        u_fluxes_angles = mtu.calc_u_fluxes([10, 35, 60], output=False, **kwargs)
+
+        # Return pairs of results and their variances
+
+        return [
+            u_fluxes[0::2],
+            u_fluxes[1::2],
+            u_fluxes_angles[0::2],
+            u_fluxes_angles[1::2],
+            mtu.calc_u_intensities(output=False, **kwargs),
+            mtu.calc_u_intensities_tr(output=False, **kwargs),
+            mtu.calc_u_intensities_eq(output=False, **kwargs),
+            mtu.calc_u_tot_flux(**kwargs),
+        ]
+
+    survival = np.zeros(shape)
+
+    for b in bins:
+        survival[b] = 0.3
+
+    binomial = calc(survival)
+    poisson = calc(survival, "poisson")
+
+    # The results are linear in the survival probabilities, so their variances are a sum over the bins of the squared results for a unit survival probability
+
+    brute_force = [0] * len(binomial)
+
+    for b in bins:
+
+        unit = np.zeros(shape)
+        unit[b] = 1
+
+        for k, (value, _) in enumerate(calc(unit)):
+            brute_force[k] += np.asarray(value) ** 2 * 0.3 * 0.7 / 100
+
+    for k in range(len(binomial)):
+
+        assert np.any(brute_force[k] > 0)
+
+        # The variances of the total flux treat all angles as fully correlated, which is an upper bound
+
+        if k == len(binomial) - 1:
+            assert binomial[k][1] >= brute_force[k]
+
+        # The splines of the interpolated angles leave round-off in bins with no survival probability
+
+        else:
+            assert np.allclose(
+                binomial[k][1],
+                brute_force[k],
+                rtol=1e-6,
+                atol=1e-9 * np.max(brute_force[k]),
+            )
+
+        # The Poisson variance p / N is the binomial variance p * (1 - p) / N divided by 1 - p
+
+        assert np.allclose(poisson[k][0], binomial[k][0])
+        assert np.allclose(poisson[k][1], binomial[k][1] / 0.7)
+
+    mtc.clear()
+
+
+def test_precision():
+
+    mtc.clear()
+
+    u_counts = np.zeros(len(mtc.ENERGIES), dtype=int)
+
+    assert mtp._calc_precision(u_counts, 100) == np.inf
+
+    u_counts[[10, 20]] = [30, 10]
+
+    precision = mtp._calc_precision(u_counts, 100)
+
+    assert np.isclose(precision, (np.sqrt(30 * 0.7) + np.sqrt(10 * 0.9)) / 40)
+    assert np.isclose(mtp._calc_precision(4 * u_counts, 400), precision / 2)
+
+
+def test_slab_matrix():
+
+    mtc.clear()
+
+    # Muons that lose no energy must stay in their bins
+
+    u_energies = np.empty(len(mtc.ENERGIES), dtype=object)
+
+    for i in range(len(mtc.ENERGIES)):
+        u_energies[i] = np.full(10, mtc.ENERGIES[i] + mtc.MU_MASS)
+
+    for sub_bins in [1, 4]:
+
+        e_bins = mtp._calc_sub_bins(sub_bins)
+
+        assert np.allclose(e_bins[::sub_bins], mtc.E_BINS)
+        assert np.allclose(
+            mtp._calc_slab_matrix(
+                u_energies, 10, sub_bins, spread=True, critical_energy=1e3
+            ),
+            np.identity(len(e_bins) - 1),
+        )
+
+    # The critical energy of continuous losses must be found from the final energies
+
+    alpha = 0.9
+    e_0 = mtc.ENERGIES + mtc.MU_MASS
+
+    for i in range(len(mtc.ENERGIES)):
+        u_energies[i] = np.full(10, alpha * e_0[i] - 500 * (1 - alpha))
+
+    u_energies[0] = np.array([])
+
+    assert np.isclose(mtp._calc_critical_energy(u_energies, 10), 500)
+
+
+def test_shard_bins():
+
+    mtc.clear()
+
+    for multi_depth in [False, True]:
+
+        for slant_depths in [None, [6, 6.5, 7]]:
+
+            coverage = sum(
+                mtp._calc_shard_bins(shard, 7, multi_depth, slant_depths).astype(int)
+                for shard in range(7)
+            )
+
+            assert coverage.shape == (
+                len(mtc.ENERGIES),
+                len(mtp._get_slant_depths(slant_depths)),
+            )
+            assert np.all(coverage == 1)
+
+
+def test_schedule_tasks():
+
+    mtc.clear()
+
+    costs = np.random.default_rng(0).uniform(
+        0, 1, (len(mtc.ENERGIES), len(mtc.SLANT_DEPTHS))
+    )
+    tasks = [
+        (
+            i,
+            (x,),
+            0,
+            False,
+            False,
+            (mtc.SLANT_DEPTHS[x],),
+            None,
+            (1000,),
+            "proposal",
+        )
+        for i in range(len(mtc.ENERGIES))
+        for x in range(len(mtc.SLANT_DEPTHS))
+    ]
+
+    chunks = mtp._schedule_tasks(tasks, costs, 4)
+
+    scheduled = [task for chunk in chunks for task in chunk]
+    scheduled_costs = [costs[task[0], task[1][0]] for task in scheduled]
+
+    assert sorted(scheduled) == sorted(tasks)
+    assert np.all(np.diff(scheduled_costs) <= 0)
+    assert len(chunks[0]) > len(chunks[-1]) == 1
+
+
+def test_parallel_propagation(monkeypatch):
+
+    mtc.clear()
+
+    mtc.set_verbose(0)
+    mtc.set_n_muon(50)
+
+    # The results do not depend on the number of worker processes
+
+    u_counts = [
+        mtp.propagate_muons(
+            output=False,
+            histogram=True,
+            n_workers=n_workers,
+            slant_depths=[1, 2, 3],
+            backend="numpy",
+        )
+        for n_workers in [1, 2]
+    ]
+
+    assert np.array_equal(u_counts[0], u_counts[1])
+
+    # An exception raised while setting up a worker process is raised by its tasks
+
+    monkeypatch.setattr(mtp, "_worker_error", NameError("name 'pp' is not defined"))
+
+    with pytest.raises(NameError):
+        mtp._propagate_chunk([])
+
+    mtc.clear()
+
+
+def test_metrics(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+
+    mtc.set_verbose(0)
+    mtc.set_n_muon(50)
+
+    # The metrics of every bin are passed to the callback and written to the metrics file
+
+    metrics = []
+
+    mtp.propagate_muons(
+        output=True,
+        force=True,
+        histogram=True,
+        metrics_callback=metrics.append,
+        slant_depths=[1, 2, 3],
+        backend="numpy",
+    )
+
+    (file_name,) = (tmp_path / "underground_energies").glob("*_Metrics.jsonl")
+
+    with open(file_name) as file_in:
+
+        assert [json.loads(line) for line in file_in] == metrics
+
+    assert len(metrics) > 0
+    assert all(m["n_muon"] == 50 and m["survivors"] <= 50 for m in metrics)
+
+    # Every muon of a multi-depth track is counted once, and a task too fast to be timed has no rate
+
+    propagate_chunk = mtp._propagate_chunk
+
+    for elapsed, rate in [(1.0, 50), (0.0, None)]:
+
+        monkeypatch.setattr(
+            mtp,
+            "_propagate_chunk",
+            lambda chunk: [
+                (task_results, elapsed, peak_rss, pid)
+                for task_results, _, peak_rss, pid in propagate_chunk(chunk)
+            ],
+        )
+
+        metrics = []
+
+        mtp.propagate_muons(
+            output=False,
+            histogram=True,
+            multi_depth=True,
+            metrics_callback=metrics.append,
+            slant_depths=[1, 2, 3],
+            backend="numpy",
+        )
+
+        assert all(m["muons_per_second"] == rate for m in metrics)
+
+    mtc.clear()
+
+
+def test_lab_slant_depths(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+    (tmp_path / "survival_probabilities").mkdir()
+
+    mtc.set_vertical_depth(3)
+
+    # Without a tensor for the slant depths of the lab, the default tensor is used
+
+    assert np.array_equal(
+        mtp.get_survival_probability_tensor_slant_depths(), mtc.SLANT_DEPTHS
+    )
+
+    # A tensor for the slant depths of the lab is used once it exists
+
+    lab_depths = np.array(mtc.slant_depths)
+
+    mtp._save_survival(
+        mtp._survival_file_name("Probabilities", slant_depths=lab_depths),
+        np.zeros((len(mtc.ENERGIES), len(lab_depths), len(mtc.ENERGIES))),
+        lab_depths,
+        {},
+    )
+
+    assert np.array_equal(
+        mtp.get_survival_probability_tensor_slant_depths(), lab_depths
+    )
+
+    # A tensor left over from another vertical depth of the same lab is not used
+
+    mtc.set_vertical_depth(3.5)
+
+    assert np.array_equal(
+        mtp.get_survival_probability_tensor_slant_depths(), mtc.SLANT_DEPTHS
+    )
+
+    mtc.clear()
+
+
+def test_resume(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+
+    mtc.set_verbose(0)
+    mtc.set_n_muon(50)
+
+    settings = {"slant_depths": [1, 2, 3], "backend": "numpy", "force": True}
+
+    u_energies = mtp.propagate_muons(output=False, **settings)
+
+    # Interrupt a run after some of its bins have been flushed to the checkpoint
+
+    propagate_chunk = mtp._propagate_chunk
+    calls = []
+
+    def interrupted_chunk(chunk):
+
+        if len(calls) == 20:
+            raise KeyboardInterrupt
+
+        calls.append(chunk)
+
+        return propagate_chunk(chunk)
+
+    monkeypatch.setattr(mtp, "_propagate_chunk", interrupted_chunk)
+
+    with pytest.raises(KeyboardInterrupt):
+        mtp.propagate_muons(output=False, checkpoint_every=5, **settings)
+
+    # A checkpoint is not resumed with other slant depths or other requested bins
+
+    monkeypatch.setattr(mtp, "_propagate_chunk", propagate_chunk)
+
+    with pytest.raises(ValueError, match="slant_depths"):
+        mtp.propagate_muons(
+            output=False, resume=True, **dict(settings, slant_depths=[1, 2, 4])
+        )
+
+    with pytest.raises(ValueError, match="bin_mask"):
+        mtp.propagate_muons(
+            output=False,
+            resume=True,
+            bins=mtp._calc_feasible_bins([2, 3, 4]),
+            **settings
+        )
+
+    # The resumed run only propagates the bins that are not in the checkpoint, and gives the same underground energies as an uninterrupted run
+
+    calls.clear()
+
+    def counted_chunk(chunk):
+
+        calls.append(chunk)
+
+        return propagate_chunk(chunk)
+
+    monkeypatch.setattr(mtp, "_propagate_chunk", counted_chunk)
+
+    u_energies_resumed = mtp.propagate_muons(
+        output=False, checkpoint_every=5, resume=True, **settings
+    )
+
+    assert len(calls) == len(mtc.ENERGIES) * 3 - 20
+    assert all(
+        np.array_equal(u_energies[i], u_energies_resumed[i])
+        for i in np.ndindex(u_energies.shape)
+    )
+    assert not list((tmp_path / "underground_energies").glob("*_Checkpoint"))
+
+    mtc.clear()
+
+
+def test_prune(monkeypatch):
+
+    mtc.clear()
+
+    mtc.set_verbose(0)
+    mtc.set_n_muon(50)
+
+    slant_depths = [1, 5, 10]
+    feasible = mtp._calc_feasible_bins(slant_depths)
+
+    assert not np.all(feasible) and np.any(feasible)
+
+    # The maximum ranges are upper bounds, so no muon survives a bin that is pruned, and the other bins are not changed
+
+    propagate_chunk = mtp._propagate_chunk
+    calls = []
+
+    def counted_chunk(chunk):
+
+        calls.append(chunk)
+
+        return propagate_chunk(chunk)
+
+    monkeypatch.setattr(mtp, "_propagate_chunk", counted_chunk)
+
+    u_counts = [
+        mtp.propagate_muons(
+            output=False,
+            histogram=True,
+            prune=prune,
+            slant_depths=slant_depths,
+            backend="numpy",
+        )
+        for prune in [True, False]
+    ]
+
+    assert len(calls) == np.sum(feasible) + feasible.size
+    assert np.array_equal(u_counts[0], u_counts[1])
+    assert not np.any(u_counts[0][~feasible])
+
+    mtc.clear()
+
+
+def test_refine(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+
+    mtc.set_verbose(0)
+    mtc.set_n_muon(50)
+
+    settings = {
+        "histogram": True,
+        "slant_depths": [1, 2, 3],
+        "backend": "numpy",
+        "force": True,
+    }
+
+    survival = mtp.calc_survival_probability_tensor(seed=0, output=True, **settings)
+    survival_new = mtp.calc_survival_probability_tensor(
+        seed=1, output=False, **settings
+    )
+
+    # Refining the tensor with the same number of new muons averages the two tensors, and doubles the number of muons thrown in every bin
+
+    survival_refined = mtp.calc_survival_probability_tensor(
+        seed=1, output=True, refine=True, **settings
+    )
+
+    assert np.allclose(survival_refined, (survival + survival_new) / 2)
+    assert np.all(mtp._load_n_thrown(slant_depths=[1, 2, 3], backend="numpy") == 100)
+
+    # The refined tensor replaces the existing one, with the variances of the combined number of muons
+
+    survival_read, variances = mtp.load_survival_probability_tensor_from_file(
+        return_variances=True, slant_depths=[1, 2, 3], backend="numpy"
+    )
+
+    assert np.allclose(survival_read, survival_refined)
+    assert np.allclose(variances, survival_refined * (1 - survival_refined) / 100)
+
+    mtc.clear()
+
+
+def test_muon_allocation(monkeypatch):
+
+    mtc.clear()
+
+    mtc.set_verbose(0)
+
+    # Use a power-law surface flux that does not depend on the zenith angle
+
+    monkeypatch.setattr(
+        mts,
+        "load_s_fluxes_from_file",
+        lambda *args, **kwargs: np.outer(
+            mtc.ENERGIES ** -3.7, np.ones(len(mtc.ANGLES_FOR_S_FLUXES))
+        ),
+    )
+
+    slant_depths = [1, 2, 3]
+    feasible = mtp._calc_feasible_bins(slant_depths)
+
+    # If only one surface energy survives, the muons left after min_muons go to its bins, split evenly over the slant depths
+
+    survival = np.zeros((len(mtc.ENERGIES), len(slant_depths), len(mtc.ENERGIES)))
+    survival[80, :, 0] = 1
+
+    n_muons = mtp.calc_muon_allocation(
+        10 * np.sum(feasible) + 3000,
+        survival=survival,
+        min_muons=10,
+        slant_depths=slant_depths,
+    )
+
+    expected = np.full(feasible.shape, 10)
+    expected[80] += 1000
+
+    assert np.array_equal(n_muons, expected)
+
+    # A pilot run hands out the whole budget, with at least min_muons muons in every feasible bin
+
+    n_muons = mtp.calc_muon_allocation(
+        100000,
+        pilot_muons=20,
+        min_muons=10,
+        slant_depths=slant_depths,
+        backend="numpy",
+    )
+
+    assert np.all(n_muons[feasible] >= 10)
+    assert 100000 - np.sum(feasible) < np.sum(n_muons[feasible]) <= 100000
+
+    mtc.clear()
+
+
+def test_refine_density(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+
+    mtc.set_verbose(0)
+
+    slant_depths = [1, 2]
+    rng = np.random.default_rng(0)
+
+    # Write an existing tensor with a different number of muons thrown in every bin
+
+    u_counts = rng.integers(0, 5, (len(mtc.ENERGIES), 2, len(mtc.ENERGIES)))
+    n_thrown = np.sum(u_counts, axis=2) + rng.integers(1, 100, (len(mtc.ENERGIES), 2))
+
+    mtp._write_survival(
+        u_counts / n_thrown[:, :, np.newaxis],
+        n_thrown,
+        slant_depths,
+        "numpy",
+        force=True,
+    )
+
+    # The counts of the existing tensor are recovered with its own number of muons thrown, from the store and from its files
+
+    u_counts_new = np.ones(u_counts.shape, dtype=np.int64)
+    n_thrown_new = np.full(n_thrown.shape, 50)
+
+    for source in ["store", "files"]:
+
+        if source == "files":
+            store._remove(os.listdir(tmp_path / "store")[0])
+
+        u_counts_refined, n_thrown_refined = mtp._add_existing_u_counts(
+            u_counts_new, n_thrown_new, slant_depths, "numpy"
+        )
+
+        assert np.array_equal(u_counts_refined, u_counts + 1)
+        assert np.array_equal(n_thrown_refined, n_thrown + 50)
+
+    # A tensor for another density within the density tolerance is not refined
+
+    mtc.set_density(2.7)
+    mtc.set_density_tolerance(0.02)
+
+    with pytest.raises(ValueError, match="cannot be refined"):
+        mtp._add_existing_u_counts(u_counts_new, n_thrown_new, slant_depths, "numpy")
+
+    mtc.clear()
+
+
+def test_find_density(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+
+    mtc.set_verbose(0)
+
+    slant_depths = [1, 2]
+
+    survival = np.random.default_rng(0).uniform(
+        0, 1, (len(mtc.ENERGIES), 2, len(mtc.ENERGIES))
+    )
+    survival = np.tril(survival)
+
+    mtp._write_survival(
+        survival, np.full((len(mtc.ENERGIES), 2), 10), slant_depths, "numpy", force=True
+    )
+
+    # A tensor at 2.65 g/cm^3 is used for 2.7 g/cm^3 within a tolerance of 0.02
+
+    mtc.set_density(2.7)
+    mtc.set_density_tolerance(0.02)
+
+    file_name, density = mtp._find_survival_file(slant_depths, "numpy")
+
+    assert float(density) == 2.65 and os.path.isfile(file_name)
+    assert np.allclose(
+        mtp.load_survival_probability_tensor_from_file(
+            slant_depths=slant_depths, backend="numpy"
+        ),
+        survival,
+    )
+
+    # It is not used without a tolerance
+
+    mtc.set_density_tolerance(0)
+
+    file_name, density = mtp._find_survival_file(slant_depths, "numpy")
+
+    assert density == 2.7 and not os.path.isfile(file_name)
+
+    mtc.clear()
+
+
+class _FakeState:
+
+    energy = 0
+    position = None
+    direction = None
+    propagated_distance = 0
+
+
+class _FakePropagator:
+
+    # Stands in for a PROPOSAL propagator: every step loses a random fraction of the energy, and some muons stop early
+
+    def __init__(self, seed):
+
+        self.rng = np.random.default_rng(seed)
+
+    def propagate(self, state, distance):
+
+        final = _FakeState()
+        final.energy = max(state.energy * self.rng.uniform(0, 1), mtc.MU_MASS)
+        final.propagated_distance = distance * (self.rng.uniform() > 0.1)
+
+        return types.SimpleNamespace(final_state=lambda: final)
+
+
+def test_propagation_loop_histogram(monkeypatch):
+
+    mtc.clear()
+
+    mtc.set_n_muon(200)
+
+    fake_pp = types.SimpleNamespace(
+        particle=types.SimpleNamespace(ParticleState=_FakeState),
+        Cartesian3D=lambda *args: args,
+    )
+
+    monkeypatch.setattr(mtp, "pp", fake_pp, raising=False)
+
+    # The histograms counted while propagating match the histograms of the underground energies of the same muons
+
+    for histogram in [False, True]:
+
+        monkeypatch.setattr(mtp, "propagator", _FakePropagator(0), raising=False)
+
+        single = mtp._propagation_loop(1e6, 1, histogram=histogram)
+
+        monkeypatch.setattr(mtp, "propagator", _FakePropagator(0), raising=False)
+
+        multi = mtp._propagation_loop_multi_depth(1e6, [1, 2, 3], histogram=histogram)
+
+        if histogram:
+
+            assert single.dtype == np.int64
+            assert np.array_equal(single, np.histogram(u_energies, bins=mtc.E_BINS)[0])
+            assert np.array_equal(
+                multi,
+                [
+                    np.histogram(u_energies_x, bins=mtc.E_BINS)[0]
+                    for u_energies_x in u_energies_multi
+                ],
+            )
+
+        else:
+
+            u_energies = single
+            u_energies_multi = multi
+
+            assert 0 < len(u_energies) < 200
+
+    mtc.clear()
+
+
+def test_merge_shards(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+
+    mtc.set_verbose(0)
+    mtc.set_n_muon(50)
+
+    settings = {"slant_depths": [1, 2, 3], "backend": "numpy", "force": True}
+
+    u_counts = [
+        mtp.propagate_muons(seed=seed, output=False, histogram=True, **settings)
+        for seed in [0, 1]
+    ]
+
+    # Write two shards of a run with seed 0, and a run with seed 1 that covers all bins
+
+    for shard in [0, 1]:
+        mtp.propagate_muons(seed=0, output=True, shard=shard, n_shards=2, **settings)
+
+    mtp.propagate_muons(seed=1, job_array_number=1, output=True, **settings)
+
+    directory = tmp_path / "underground_energies"
+
+    shards = sorted(str(f) for f in directory.glob("*_Shard_*.json"))
+    (other,) = [str(f) for f in directory.glob("*_Energies_1.json")]
+
+    assert len(shards) == 2
+
+    del settings["force"]
+
+    # The shards add up to the unsharded run, and runs with different seeds add up
+
+    u_counts_merged, n_thrown = mtp.merge_u_energies_files(shards, **settings)
+
+    assert np.array_equal(u_counts_merged, u_counts[0])
+    assert np.all(n_thrown == 50)
+
+    u_counts_merged, n_thrown = mtp.merge_u_energies_files(shards + [other], **settings)
+
+    assert np.array_equal(u_counts_merged, u_counts[0] + u_counts[1])
+    assert np.all(n_thrown == 100)
+
+    # A missing shard and a shard merged twice are errors
+
+    with pytest.raises(ValueError, match="missing"):
+        mtp.merge_u_energies_files(shards[:1], **settings)
+
+    with pytest.raises(ValueError, match="more than once"):
+        mtp.merge_u_energies_files(shards + shards[:1], **settings)
+
+    mtc.clear()
+
+
+def test_adaptive_stopping(tmp_path, monkeypatch):
+
+    mtc.clear()
+
+    monkeypatch.setattr(mtc, "_directory", str(tmp_path))
+
+    mtc.set_verbose(0)
+
+    settings = {"slant_depths": [1, 2, 3], "backend": "numpy"}
+
+    u_counts = mtp.propagate_muons(
+        output=True,
+        force=True,
+        histogram=True,
+        target_precision=0.3,
+        min_muons=50,
+        max_muons=1000,
+        **settings
+    )
+
+    (file_name,) = (tmp_path / "underground_energies").glob("*_Counts_0.json")
+    file_name = str(file_name)[: -len(".json")]
+
+    with open(file_name + ".json") as file_in:
+
+        n_thrown = np.array(json.load(file_in)["n_thrown"])
+
+    precision = np.load(file_name + "_Precision.npy")
+    feasible = mtp._calc_feasible_bins([1, 2, 3])
+
+    # Every bin is propagated in batches of min_muons muons, and stops once it is precise enough or reaches max_muons
+
+    assert np.all(n_thrown[feasible] % 50 == 0)
+    assert np.all(n_thrown[feasible] <= 1000)
+    assert np.any(n_thrown[feasible] < 1000) and np.any(n_thrown[feasible] == 1000)
+
+    stopped = feasible & (n_thrown < 1000)
+
+    assert np.all(precision[stopped] <= 0.3)
+    assert np.all(n_thrown[feasible & (precision > 0.3)] == 1000)
+
+    # The survival probabilities of every bin are normalised by its own number of muons
+
+    survival = mtp.calc_survival_probability_tensor(
+        file_names=[file_name], output=False, **settings
+    )
+
+    assert np.allclose(
+        survival[feasible], u_counts[feasible] / n_thrown[feasible][:, np.newaxis]
+    )
+
+    mtc.clear()
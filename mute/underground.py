@@ -31,6 +31,8 @@ def calc_u_fluxes(
     atmosphere="CORSIKA",
     output=None,
     force=False,
+    return_variances=False,
+    variance_method="binomial",
 ):
 
     """
@@ -70,10 +72,16 @@ def calc_u_fluxes(
     force : bool
         If True, force the calculation of a new surface flux matrix and survival probability tensor if required.
 
+    return_variances : bool, optional (default: False)
+        If True, the statistical variances of the underground fluxes that come from the finite number of muons in the survival probability tensor are also returned. They are propagated through the interpolations and the sum over surface energies, which are all linear in the survival probabilities.
+
+    variance_method : {"binomial", "poisson"}, optional (default: "binomial")
+        The statistical model for the variances of the survival probabilities. See mtp.calc_survival_probability_tensor().
+
     Returns
     -------
     u_fluxes : tuple of NumPy ndarray
-        A two-element tuple. The first element is a two-dimensional array containing the underground fluxes. The second element is a two-dimensional array containing the underground fluxes calculated with an angle of zero degrees for use in calculation of the true vertical intensities.
+        A two-element tuple. The first element is a two-dimensional array containing the underground fluxes. The second element is a two-dimensional array containing the underground fluxes calculated with an angle of zero degrees for use in calculation of the true vertical intensities. If return_variances is True, a four-element tuple, where the third and fourth elements are the variances of the first and second elements.
     """
 
     # Import packages
@@ -95,7 +103,52 @@ def calc_u_fluxes(
     s_fluxes = surface.load_s_fluxes_from_file(
         location, month, interaction_model, primary_model, atmosphere, force=force
     )
-    survival = propagation.load_survival_probability_tensor_from_file(force=force)
+
+    # If a survival probability tensor has been calculated for only the slant depths of the set lab, it is used instead of the default tensor
+    # The tensor is memory-mapped in packed form, so only the slant depths that are used are read from disk, and the bins a muon cannot reach are left out
+    # First index  = Slant depth in the tensor
+    # Second index = Pair of underground energy and surface energy, see mtp.load_survival_probability_tensor_from_file()
+
+    tensor_depths = propagation.get_survival_probability_tensor_slant_depths()
+
+    # Define a function that loads the survival probabilities in packed or full form, with their variances if return_variances is True
+
+    def load_survival(packed):
+
+        loaded = propagation.load_survival_probability_tensor_from_file(
+            force=force,
+            return_variances=return_variances,
+            variance_method=variance_method,
+            slant_depths=tensor_depths,
+            mmap=packed,
+            packed=packed,
+        )
+
+        return loaded if return_variances else (loaded, None)
+
+    # Find the surface and underground energy bins of the packed survival probabilities
+    # The bins of every underground energy are contiguous, so a sum over surface energies is a sum over a segment
+
+    try:
+
+        survival, variances = load_survival(packed=True)
+        u_indices, i_indices = np.triu_indices(len(constants.ENERGIES))
+
+    except ValueError:
+
+        # A tensor with a bin above the diagonal that is not empty cannot be packed, so it is read in full, and laid out the same way over every pair of underground and surface energies
+
+        survival, variances = (
+            None
+            if array is None
+            else np.reshape(np.transpose(array, (1, 2, 0)), (len(tensor_depths), -1))
+            for array in load_survival(packed=False)
+        )
+        u_indices, i_indices = np.divmod(
+            np.arange(len(constants.ENERGIES) ** 2), len(constants.ENERGIES)
+        )
+
+    segments = np.flatnonzero(np.diff(u_indices, prepend=-1))
 
     if (s_fluxes is None or survival is None) and constants.get_verbose() > 1:
 
@@ -115,9 +168,29 @@ def calc_u_fluxes(
         constants.ENERGIES, interp_at_angles, interp_s_fluxes
     )(constants.ENERGIES, constants.angles)
 
-    interp_survival = scii.interp1d(
-        constants.SLANT_DEPTHS, survival, axis=1, kind="cubic"
-    )(constants.slant_depths)
+    # The interpolation is linear in the survival probabilities, so interpolating the identity matrix gives the weight of every slant depth in the tensor at every slant depth in slant_depths
+    # A tensor for the slant depths of the set lab does not need to be interpolated in slant depth
+    # The slant depths are compared by value, with the tolerance used to select the tensor in mtp.get_survival_probability_tensor_slant_depths()
+    # First index  = Slant depth in the tensor
+    # Second index = Slant depth in slant_depths
+
+    depth_weights = np.identity(len(tensor_depths))
+
+    if len(tensor_depths) != len(constants.slant_depths) or not np.allclose(
+        tensor_depths, constants.slant_depths
+    ):
+
+        depth_weights = scii.interp1d(
+            tensor_depths, depth_weights, axis=1, kind="cubic"
+        )(constants.slant_depths)
+
+    # Add up the slices of the tensor one slant depth at a time, skipping the slant depths without a weight, so the tensor is never read into memory as a whole
+
+    interp_survival = np.zeros((len(depth_weights[0]), len(survival[0])))
+
+    for x in np.flatnonzero(np.max(np.abs(depth_weights), axis=1) > 1e-12):
+
+        interp_survival += depth_weights[x, :, np.newaxis] * survival[x, np.newaxis, :]
 
     # Reshape the matrices
 
@@ -125,58 +198,58 @@ def calc_u_fluxes(
         np.reshape(interp_s_fluxes, (len(constants.ENERGIES), len(constants.angles)))
     )
     interp_survival = np.nan_to_num(
-        np.reshape(
-            interp_survival,
-            (
-                len(constants.ENERGIES),
-                len(constants.slant_depths),
-                len(constants.ENERGIES),
-            ),
-        )
+        np.reshape(interp_survival, (len(constants.slant_depths), len(u_indices)))
     )
 
     # Calculate the underground fluxes for a flat overburden
 
     if constants.get_overburden() == "flat":
 
-        # Initialise the underground flux matrices
-        # First index  = Surface energy
-        # Second index = Zenith angle
-        # Third index  = Underground energy
+        # Calculate the underground fluxes for every packed bin, and sum over the surface energy grid axis
+        # First index = Zenith angle
+        # Second index  = Underground energy
+
+        ratios = constants.E_WIDTHS[i_indices] / constants.E_WIDTHS[u_indices]
 
-        u_fluxes = np.zeros(
-            (len(constants.ENERGIES), len(constants.angles), len(constants.ENERGIES))
+        u_fluxes = np.add.reduceat(
+            interp_survival * np.transpose(interp_s_fluxes[i_indices]) * ratios,
+            segments,
+            axis=1,
         )
-        u_fluxes_tr = np.zeros(
-            (len(constants.ENERGIES), len(constants.angles), len(constants.ENERGIES))
+        u_fluxes_tr = np.add.reduceat(
+            interp_survival * (interp_s_fluxes[i_indices, 0] * ratios),
+            segments,
+            axis=1,
         )
 
-        # Calculate the underground fluxes
-
-        for i in range(len(constants.ENERGIES)):
-
-            for j in range(len(constants.angles)):
+        # Define a function that propagates the variances of the survival probabilities to the underground fluxes
+        # Every underground flux is a weighted sum of survival probabilities over surface energies and slant depths in the tensor
+        # The bins of the survival probability tensor are statistically independent, so the variance is the same sum with squared weights
+        # angle_weights gives the weights of the angles in constants.angles at the output angles
 
-                for u in range(len(constants.ENERGIES)):
+        def calc_u_fluxes_variances(angle_weights):
 
-                    u_fluxes[i, j, u] = (
-                        interp_survival[i, j, u]
-                        * interp_s_fluxes[i, j]
-                        * (constants.E_WIDTHS[i] / constants.E_WIDTHS[u])
-                    )
-                    u_fluxes_tr[i, j, u] = (
-                        interp_survival[i, j, u]
-                        * interp_s_fluxes[i, 0]
-                        * (constants.E_WIDTHS[i] / constants.E_WIDTHS[u])
-                    )
-
-        # Sum over the surface energy grid axis
-        # This reduces the number of axes down to two
-        # First index = Zenith angle
-        # Second index  = Underground energy
+            weights = np.einsum(
+                "aj,xj,ij->aix", angle_weights, depth_weights, interp_s_fluxes
+            )
+            weights_tr = np.einsum(
+                "aj,xj,i->aix", angle_weights, depth_weights, interp_s_fluxes[:, 0]
+            )
 
-        u_fluxes = np.sum(u_fluxes, axis=0)
-        u_fluxes_tr = np.sum(u_fluxes_tr, axis=0)
+            return [
+                np.add.reduceat(
+                    np.einsum(
+                        "akx,xk,k->ak",
+                        w[:, i_indices] ** 2,
+                        variances,
+                        ratios ** 2,
+                        optimize=True,
+                    ),
+                    segments,
+                    axis=1,
+                )
+                for w in [weights, weights_tr]
+            ]
 
         # Set the angles to default values
         # If user has input singular angle, turn into an array
@@ -193,6 +266,12 @@ def calc_u_fluxes(
             angles, constants.ANGLES
         ):
 
+            if return_variances:
+
+                u_fluxes_variances, u_fluxes_tr_variances = calc_u_fluxes_variances(
+                    np.identity(len(constants.angles))
+                )
+
             if constants.get_verbose() > 1:
                 print("Finished calculating underground fluxes.")
 
@@ -226,41 +305,56 @@ def calc_u_fluxes(
                 if constants.get_verbose() > 1:
                     print("Underground fluxes written to " + file_name + ".")
 
+            if return_variances:
+
+                return u_fluxes, u_fluxes_tr, u_fluxes_variances, u_fluxes_tr_variances
+
             return u_fluxes, u_fluxes_tr
 
         else:
 
             # Interpolate at the angles the user has requested
 
-            interp_at_angles = np.linspace(
-                np.min(constants.angles), np.max(constants.angles), 300
-            )
-            interp_u_fluxes = scii.interp1d(
-                constants.angles, u_fluxes, axis=0, kind="cubic"
-            )(interp_at_angles)
-            interp_u_fluxes = scii.RectBivariateSpline(
-                interp_at_angles, constants.ENERGIES, interp_u_fluxes
-            )(angles, constants.ENERGIES)
-            interp_u_fluxes_tr = scii.interp1d(
-                constants.angles, u_fluxes_tr, axis=0, kind="cubic"
-            )(interp_at_angles)
-            interp_u_fluxes_tr = scii.RectBivariateSpline(
-                interp_at_angles, constants.ENERGIES, interp_u_fluxes_tr
-            )(angles, constants.ENERGIES)
-
-            # Reshape into a matrix of zeroth dimension len(angles)
-
-            interp_u_fluxes = np.nan_to_num(
-                np.reshape(interp_u_fluxes, (len(angles), len(constants.ENERGIES)))
-            )
-            interp_u_fluxes_tr = np.nan_to_num(
-                np.reshape(interp_u_fluxes_tr, (len(angles), len(constants.ENERGIES)))
-            )
+            def interp_u_fluxes(u_fluxes):
+
+                interp_at_angles = np.linspace(
+                    np.min(constants.angles), np.max(constants.angles), 300
+                )
+                interp_u_fluxes = scii.interp1d(
+                    constants.angles, u_fluxes, axis=0, kind="cubic"
+                )(interp_at_angles)
+                interp_u_fluxes = scii.RectBivariateSpline(
+                    interp_at_angles, constants.ENERGIES, interp_u_fluxes
+                )(angles, constants.ENERGIES)
+
+                # Reshape into a matrix of zeroth dimension len(angles)
+
+                return np.nan_to_num(
+                    np.reshape(interp_u_fluxes, (len(angles), len(constants.ENERGIES)))
+                )
 
             # Set the global variables
 
-            u_fluxes = interp_u_fluxes
-            u_fluxes_tr = interp_u_fluxes_tr
+            u_fluxes = interp_u_fluxes(u_fluxes)
+            u_fluxes_tr = interp_u_fluxes(u_fluxes_tr)
+
+            # Propagate the variances to the requested angles
+            # The spline over underground energies passes through the grid points, so an underground flux that is constant in energy gives the weights of the angles in constants.angles at the requested angles
+
+            if return_variances:
+
+                angle_weights = np.transpose(
+                    [
+                        interp_u_fluxes(
+                            np.outer(unit, np.ones(len(constants.ENERGIES)))
+                        )[:, 0]
+                        for unit in np.identity(len(constants.angles))
+                    ]
+                )
+
+                u_fluxes_variances, u_fluxes_tr_variances = calc_u_fluxes_variances(
+                    angle_weights
+                )
 
             if constants.get_verbose() > 1:
                 print("Finished calculating underground fluxes.")
@@ -296,6 +390,10 @@ def calc_u_fluxes(
                 if constants.get_verbose() > 1:
                     print("Underground fluxes written to " + file_name + ".")
 
+            if return_variances:
+
+                return u_fluxes, u_fluxes_tr, u_fluxes_variances, u_fluxes_tr_variances
+
             return u_fluxes, u_fluxes_tr
 
     # Calculate the underground fluxes for a non-flat overburden
@@ -381,6 +479,8 @@ def calc_u_intensities(
     atmosphere="CORSIKA",
     output=None,
     force=False,
+    return_variances=False,
+    variance_method="binomial",
 ):
 
     """
@@ -418,10 +518,19 @@ def calc_u_intensities(
     force : bool
         If True, force the calculation of new matrices if required.
 
+    return_variances : bool, optional (default: False)
+        If True, the statistical variances of the underground intensities that come from the finite number of muons in the survival probability tensor are also returned. See calc_u_fluxes().
+
+    variance_method : {"binomial", "poisson"}, optional (default: "binomial")
+        The statistical model for the variances of the survival probabilities.
+
     Returns
     -------
     u_intensities : NumPy array
         An array containing the underground intensities.
+
+    u_intensities_variances : NumPy array
+        An array containing the variances of the underground intensities. Only returned if return_variances is True.
     """
 
     # Check values
@@ -452,6 +561,8 @@ def calc_u_intensities(
             atmosphere,
             output,
             force=force,
+            return_variances=return_variances,
+            variance_method=variance_method,
         )
 
         if u_fluxes is None and constants.get_verbose() > 1:
@@ -460,6 +571,14 @@ def calc_u_intensities(
 
             return
 
+        # The intensities are linear in the underground fluxes, and the underground fluxes in different underground energy bins are treated as independent
+
+        if return_variances:
+
+            u_intensities_variances = (
+                u_fluxes[2] @ _calc_simpson_weights(constants.ENERGIES) ** 2
+            )
+
         u_fluxes = u_fluxes[0]
 
         # Initialise the underground intensities array
@@ -503,6 +622,10 @@ def calc_u_intensities(
             if constants.get_verbose() > 1:
                 print("Underground intensities written to " + file_name + ".")
 
+        if return_variances:
+
+            return u_intensities, u_intensities_variances
+
         return u_intensities
 
     # Calculate the underground intensities for a non-flat overburden
@@ -540,6 +663,8 @@ def calc_u_intensities_tr(
     atmosphere="CORSIKA",
     output=None,
     force=False,
+    return_variances=False,
+    variance_method="binomial",
 ):
 
     """
@@ -577,10 +702,19 @@ def calc_u_intensities_tr(
     force : bool
         If True, force the calculation of new matrices if required.
 
+    return_variances : bool, optional (default: False)
+        If True, the statistical variances of the true vertical underground intensities that come from the finite number of muons in the survival probability tensor are also returned. See calc_u_fluxes().
+
+    variance_method : {"binomial", "poisson"}, optional (default: "binomial")
+        The statistical model for the variances of the survival probabilities.
+
     Returns
     -------
     u_intensities_tr : NumPy array
         An array containing the true vertical underground intensities.
+
+    u_intensities_tr_variances : NumPy array
+        An array containing the variances of the true vertical underground intensities. Only returned if return_variances is True.
     """
 
     # Check values
@@ -612,6 +746,8 @@ def calc_u_intensities_tr(
             atmosphere,
             output,
             force=force,
+            return_variances=return_variances,
+            variance_method=variance_method,
         )
 
         if u_fluxes is None and constants.get_verbose() > 1:
@@ -620,6 +756,12 @@ def calc_u_intensities_tr(
 
             return
 
+        if return_variances:
+
+            u_intensities_tr_variances = (
+                u_fluxes[3] @ _calc_simpson_weights(constants.ENERGIES) ** 2
+            )
+
         u_fluxes_tr = u_fluxes[1]
 
         # Initialise the underground intensity arrays
@@ -668,6 +810,10 @@ def calc_u_intensities_tr(
                     + "."
                 )
 
+        if return_variances:
+
+            return u_intensities_tr, u_intensities_tr_variances
+
         return u_intensities_tr
 
     # Calculate the true vertical underground intensities for a non-flat overburden
@@ -705,6 +851,8 @@ def calc_u_intensities_eq(
     atmosphere="CORSIKA",
     output=None,
     force=False,
+    return_variances=False,
+    variance_method="binomial",
 ):
 
     """
@@ -742,10 +890,19 @@ def calc_u_intensities_eq(
     force : bool
         If True, force the calculation of new matrices if required.
 
+    return_variances : bool, optional (default: False)
+        If True, the statistical variances of the vertical-equivalent underground intensities that come from the finite number of muons in the survival probability tensor are also returned. See calc_u_fluxes().
+
+    variance_method : {"binomial", "poisson"}, optional (default: "binomial")
+        The statistical model for the variances of the survival probabilities.
+
     Returns
     -------
     u_intensities_eq : NumPy array
         An array containing the vertical-equivalent underground intensities.
+
+    u_intensities_eq_variances : NumPy array
+        An array containing the variances of the vertical-equivalent underground intensities. Only returned if return_variances is True.
     """
 
     # Check values
@@ -776,6 +933,8 @@ def calc_u_intensities_eq(
             atmosphere,
             output,
             force=force,
+            return_variances=return_variances,
+            variance_method=variance_method,
         )
 
         if u_fluxes is None and constants.get_verbose() > 1:
@@ -784,6 +943,14 @@ def calc_u_intensities_eq(
 
             return
 
+        if return_variances:
+
+            u_intensities_eq_variances = (
+                u_fluxes[2]
+                @ _calc_simpson_weights(constants.ENERGIES) ** 2
+                * np.cos(np.radians(angles)) ** 2
+            )
+
         u_fluxes = u_fluxes[0]
 
         # Initialise the vertical-equivalent underground intensity array
@@ -836,6 +1003,10 @@ def calc_u_intensities_eq(
                     + "."
                 )
 
+        if return_variances:
+
+            return u_intensities_eq, u_intensities_eq_variances
+
         return u_intensities_eq
 
     # Calculate the vertical-equivalent underground intensities for a non-flat overburden
@@ -872,6 +1043,8 @@ def calc_u_tot_flux(
     primary_model="GSF",
     atmosphere="CORSIKA",
     force=False,
+    return_variances=False,
+    variance_method="binomial",
 ):
 
     """
@@ -906,10 +1079,19 @@ def calc_u_tot_flux(
     force : bool
         If True, force the calculation of new matrices if required.
 
+    return_variances : bool, optional (default: False)
+        If True, the statistical variances of the total underground flux that come from the finite number of muons in the survival probability tensor are also returned. See calc_u_fluxes().
+
+    variance_method : {"binomial", "poisson"}, optional (default: "binomial")
+        The statistical model for the variances of the survival probabilities.
+
     Returns
     -------
     u_tot_flux : float
         The total underground flux in units of [cm^(-2) s^(-1)].
+
+    u_tot_flux_variance : float
+        The variance of the total underground flux. The underground intensities at different angles share survival probabilities, so they are treated as fully correlated, which gives an upper bound on the variance. Only returned if return_variances is True.
     """
 
     # Calculate the total underground flux for a flat overburden
@@ -932,6 +1114,8 @@ def calc_u_tot_flux(
             primary_model,
             atmosphere,
             force=force,
+            return_variances=return_variances,
+            variance_method=variance_method,
         )
 
         if u_intensities is None and constants.get_verbose() > 1:
@@ -940,6 +1124,10 @@ def calc_u_tot_flux(
 
             return
 
+        if return_variances:
+
+            u_intensities, u_intensities_variances = u_intensities
+
         # Calculate the total underground flux
         # Because angles goes (0..89), cos(angles) goes (1..0)
         # cos(angles) is decreasing, but scii.simpson() wants an increasing array
@@ -952,10 +1140,37 @@ def calc_u_tot_flux(
             * scii.simpson(u_intensities[::-1], np.cos(np.radians(angles[::-1])))
         )
 
+        # Add the standard deviations of the intensities linearly, assuming full correlation between the angles
+
+        if return_variances:
+
+            u_tot_flux_variance = (
+                2
+                * np.pi
+                * np.sum(
+                    np.abs(_calc_simpson_weights(np.cos(np.radians(angles[::-1]))))
+                    * np.sqrt(u_intensities_variances[::-1])
+                )
+            ) ** 2
+
     # Calculate the total underground flux for a non-flat overburden
 
     else:
 
         raise NotImplementedError("Non-flat overburdens are not yet implemented.")
 
+    if return_variances:
+
+        return u_tot_flux, u_tot_flux_variance
+
     return u_tot_flux
+
+
+# Calculate the weights of Simpson's rule
+
+
+def _calc_simpson_weights(x):
+
+    """Return the weights w of Simpson's rule on the grid x, so that scii.simpson(y, x) is equal to np.sum(w * y)."""
+
+    return scii.simpson(np.identity(len(x)), x)